@@ -0,0 +1,75 @@
+"""Eval loop of the CIFAR VoT with and without the positional attention cache
+
+Builds the VoT of `VoT_config` (CIFAR-10, 32x32 images pooled to an 8x8
+token grid) with Gaussian attention and times forward-only passes under
+`torch.no_grad()`, recomputing the attention probabilities every forward
+(`cache_attention=False`) or reusing them.
+
+    python benchmarks/bench_attention_cache.py --batches=20
+"""
+import argparse
+import time
+import torch
+from common import QuietLogger
+from models.VoT import VoT, VoT_config
+from models.VoT.gaussian import GaussianSelfAttention
+
+
+def build(args):
+    torch.manual_seed(0)
+    config = dict(VoT_config)
+    config['use_attention'] = "gaussian"
+    config['INPUT_W'] = config['INPUT_H'] = 32 // config['pooling_concatenate_size']
+    config['positional_encoding'] = ""
+    config['logger'] = QuietLogger()
+    if args.layers:
+        config['num_hidden_layers'] = args.layers
+    return VoT(config, num_classes=10).eval()
+
+
+def evaluate(model, batches):
+    with torch.no_grad():
+        for x in batches:
+            model(x)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VoT attention cache benchmark')
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--layers', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    model = build(args)
+    layers = [m for m in model.modules() if isinstance(m, GaussianSelfAttention)]
+    batches = [torch.randn(args.batch_size, 3, 32, 32) for _ in range(args.batches)]
+    computed = [0]
+    for layer in layers:
+        compute = layer.compute_attention_probs
+        def counted(*size, compute=compute):
+            computed[0] += 1
+            return compute(*size)
+        layer.compute_attention_probs = counted
+
+    base = None
+    for cache in (False, True):
+        for layer in layers:
+            layer.cache_attention = cache
+        evaluate(model, batches[:1])
+        best = float("inf")
+        for _ in range(args.repeat):
+            computed[0] = 0
+            t0 = time.time()
+            evaluate(model, batches)
+            best = min(best, time.time() - t0)
+        base = base or best
+        print(f"cache {str(cache):5s}  {len(layers)} layers  eval {best*1000:8.1f} ms"
+              f" ({best*1000/args.batches:6.2f} ms/batch, x{base/best:4.2f})"
+              f"   attention maps computed {computed[0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Eigen refresh, preconditioning and factor memory vs. diagonal block count
+
+Uses a model with `--width` wide Linear layers, split into k blocks with
+`diag_blocks={'Linear': k}`. The refresh should scale as n^3 / k^2.
+
+    python benchmarks/bench_block_diag.py --width=1024 --blocks 1 2 4 8
+"""
+import argparse
+import torch
+import torch.nn as nn
+from common import kfac, timeit
+
+
+def run(args, blocks):
+    torch.manual_seed(0)
+    layers = []
+    for _ in range(args.layers):
+        layers += [nn.Linear(args.width, args.width), nn.GELU()]
+    model = nn.Sequential(*layers, nn.Linear(args.width, 10))
+    preconditioner = kfac.KFAC(model, fac_update_freq=1, kfac_update_freq=1000,
+                               diag_blocks={'Linear': blocks},
+                               distribute_layer_factors=False, gradient_clip="kl")
+    model.zero_grad()
+    model(torch.randn(args.batch_size, args.width)).logsumexp(1).sum().backward()
+    preconditioner.step()
+
+    t_refresh = timeit(lambda: preconditioner._update_eigen(1), repeat=args.repeat)
+    grads = [(m, preconditioner._get_grad(m)) for m in preconditioner.modules]
+    t_precon = timeit(lambda: [preconditioner._get_preconditioned_grad(m, g)
+                               for m, g in grads], repeat=args.repeat)
+    stored = sum(s for _, _, s in preconditioner.factor_memory_report())
+    return t_refresh, t_precon, stored
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC block diagonal benchmark')
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--blocks', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    base = None
+    for blocks in args.blocks:
+        t_refresh, t_precon, stored = run(args, blocks)
+        base = base or t_refresh
+        print(f"width {args.width}: {blocks:3d} blocks   refresh {t_refresh*1000:9.1f} ms"
+              f" (x{base/t_refresh:6.1f})   precondition {t_precon*1000:7.2f} ms"
+              f"   factors {stored/2**20:7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""CG_KFAC solves: legacy per-layer loop vs. batched (preconditioned) CG
+
+Trains a few steps of an MLP with `--layers` square Linear layers so the
+factors evolve between the refreshes, then times one solve of all layers
+with the former loop (one CG per layer, one host sync per iteration) and
+with the batched `CG_KFAC._solve_modules` for each `cg_precond`.
+
+    python benchmarks/bench_cg.py --width=256 --layers=8
+"""
+import argparse
+import torch
+import torch.nn as nn
+from common import kfac, timeit
+
+
+def legacy_cg(a, g, b, damping, max_iters, tol):
+    """The per-layer CG of the former `CG_KFAC.CG_m`"""
+    x = torch.zeros_like(b)
+    r = b
+    p = r
+    rou_0 = res_0 = torch.sum(r * r)
+    m = 0
+    while m < max_iters:
+        u = g @ p @ a + damping * p
+        alpha = rou_0 / torch.sum(p * u)
+        x = x + alpha * p
+        r = r - alpha * u
+        rou_1 = torch.sum(r * r)
+        m += 1
+        if rou_1 / res_0 < tol:
+            break
+        p = r + rou_1 / rou_0 * p
+        rou_0 = rou_1
+    return x, m
+
+
+def train(args, precond):
+    torch.manual_seed(0)
+    layers = []
+    for _ in range(args.layers):
+        layers += [nn.Linear(args.width, args.width), nn.Tanh()]
+    model = nn.Sequential(*layers, nn.Linear(args.width, 10))
+    preconditioner = kfac.CG_KFAC(model, fac_update_freq=1, kfac_update_freq=args.refresh,
+                                  damping=args.damping, cg_max_iters=args.iters,
+                                  cg_tol=args.tol, cg_check_freq=args.check_freq,
+                                  cg_precond=precond,
+                                  distribute_layer_factors=False)
+    for _ in range(args.steps):
+        model.zero_grad()
+        model(torch.randn(args.batch_size, args.width)).logsumexp(1).sum().backward()
+        preconditioner.step()
+    model.zero_grad()
+    model(torch.randn(args.batch_size, args.width)).logsumexp(1).sum().backward()
+    return preconditioner
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CG_KFAC solve benchmark')
+    parser.add_argument('--width', type=int, default=256)
+    parser.add_argument('--layers', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--steps', type=int, default=6)
+    parser.add_argument('--refresh', type=int, default=4)
+    parser.add_argument('--damping', type=float, default=0.001)
+    parser.add_argument('--iters', type=int, default=100)
+    parser.add_argument('--tol', type=float, default=1e-4)
+    parser.add_argument('--check-freq', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    preconditioner = train(args, None)
+    systems = [(preconditioner.m_A[m], preconditioner.m_G[m], preconditioner._get_grad(m))
+               for m in preconditioner.modules]
+    iterations = [legacy_cg(a, g, b, args.damping, args.iters, args.tol)[1]
+                  for a, g, b in systems]
+    t = timeit(lambda: [legacy_cg(a, g, b, args.damping, args.iters, args.tol)
+                        for a, g, b in systems], repeat=args.repeat)
+    base = t
+    print(f"{'legacy loop':14s} iterations {sum(iterations)/len(iterations):6.1f}"
+          f"   solve {t*1000:8.2f} ms")
+
+    for precond in (None, 'jacobi', 'eigen'):
+        preconditioner = train(args, precond)
+
+        def solve():
+            preconditioner.nIter = preconditioner.n_1 = 0
+            preconditioner._solve_modules(preconditioner.modules, {})
+        t = timeit(solve, repeat=args.repeat)
+        print(f"{'batched ' + str(precond):14s} iterations "
+              f"{preconditioner.nIter/preconditioner.n_1:6.1f}   solve {t*1000:8.2f} ms"
+              f" (x{base/t:5.1f})")
+
+
+if __name__ == "__main__":
+    main()
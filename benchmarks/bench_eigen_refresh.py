@@ -0,0 +1,43 @@
+"""Eigen refresh time: batched `torch.linalg.eigh` vs per-module loop
+
+    python benchmarks/bench_eigen_refresh.py --model=resnet110
+"""
+import argparse
+import torch
+from common import kfac, build_model, forward_backward, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC eigen refresh benchmark')
+    parser.add_argument('--model', type=str, default='resnet110')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    model, input_shape = build_model(args.model)
+    preconditioner = kfac.KFAC(model, distribute_layer_factors=False)
+    forward_backward(model, input_shape, args.batch_size)
+    preconditioner._update_A()
+    preconditioner._update_G()
+
+    shapes = set()
+    for module in preconditioner.modules:
+        shapes.add(tuple(preconditioner.m_A[module].shape))
+        shapes.add(tuple(preconditioner.m_G[module].shape))
+    print(f"{args.model}: {len(preconditioner.modules)} modules, "
+          f"{2*len(preconditioner.modules)} factors, {len(shapes)} shapes")
+
+    results = {}
+    for batched in (False, True):
+        preconditioner.batched_eigen = batched
+        results[batched] = timeit(lambda: preconditioner._update_eigen(1),
+                                  repeat=args.repeat)
+    print(f"per-module loop: {results[False]*1000:.1f} ms")
+    print(f"batched eigh:    {results[True]*1000:.1f} ms "
+          f"(x{results[False]/results[True]:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Training throughput vs. `fac_update_freq`, against plain SGD
+
+KFAC only hooks the layers on the steps that update the factors, so the
+other steps should run close to plain SGD speed.
+
+    python benchmarks/bench_hooks.py --model=resnet32 --freq 1 10 100
+"""
+import argparse
+import torch
+from common import kfac, build_model, forward_backward, timeit
+
+
+def throughput(args, fac_update_freq=None):
+    torch.manual_seed(0)
+    model, input_shape = build_model(args.model)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    preconditioner = None
+    if fac_update_freq is not None:
+        # no eigen refresh after the first (warmup) step
+        preconditioner = kfac.KFAC(model, fac_update_freq=fac_update_freq,
+                                   kfac_update_freq=100000,
+                                   distribute_layer_factors=False,
+                                   gradient_clip="kl")
+
+    def step():
+        forward_backward(model, input_shape, args.batch_size)
+        if preconditioner is not None:
+            preconditioner.step()
+        optimizer.step()
+
+    step()  # initializes the factors and eigendecompositions
+    t = timeit(lambda: [step() for _ in range(args.steps)], repeat=1, warmup=0)
+    return args.steps * args.batch_size / t
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC hook overhead benchmark')
+    parser.add_argument('--model', type=str, default='resnet32')
+    parser.add_argument('--freq', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    sgd = throughput(args)
+    print(f"{args.model} SGD                     {sgd:8.1f} img/s")
+    for freq in args.freq:
+        images = throughput(args, freq)
+        print(f"{args.model} KFAC fac_update_freq={freq:<4d} {images:8.1f} img/s"
+              f"   ({images / sgd * 100:5.1f}% of SGD)")
+
+
+if __name__ == "__main__":
+    main()
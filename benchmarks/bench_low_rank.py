@@ -0,0 +1,68 @@
+"""Eigen refresh of wide Linear layers: full `eigh` vs randomized low rank
+
+Times the refresh of an MLP of `--width` wide layers, like the transformer
+FFNs, and reports the relative error of the preconditioned gradients.
+
+    python benchmarks/bench_low_rank.py --width=2048 --rank=128
+"""
+import argparse
+import torch
+import torch.nn as nn
+from common import kfac, timeit
+
+
+def refresh(args, **kwargs):
+    torch.manual_seed(0)
+    layers = []
+    for _ in range(args.layers):
+        layers += [nn.Linear(args.width, args.width), nn.GELU()]
+    model = nn.Sequential(*layers, nn.Linear(args.width, 10))
+    # factors are averaged over `steps` batches, then refreshed once
+    preconditioner = kfac.KFAC(model, fac_update_freq=1,
+                               kfac_update_freq=args.steps + 1,
+                               damping=args.damping,
+                               distribute_layer_factors=False,
+                               gradient_clip="kl", **kwargs)
+    # inputs with a power-law spectrum, like the features of trained models
+    scale = torch.arange(1, args.width + 1, dtype=torch.float) ** -0.75
+    mixing, _ = torch.linalg.qr(torch.randn(args.width, args.width))
+    for _ in range(args.steps):
+        model.zero_grad()
+        data = (torch.randn(args.batch_size, args.width) * scale) @ mixing
+        model(data).logsumexp(1).sum().backward()
+        preconditioner.step()
+
+    t_refresh = timeit(lambda: preconditioner._update_eigen(1), repeat=args.repeat)
+    grads = [preconditioner._get_preconditioned_grad(m, preconditioner._get_grad(m))[0]
+             for m in preconditioner.modules]
+    return t_refresh, grads
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC low-rank eigen benchmark')
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--rank', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--damping', type=float, default=0.003)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    t_full, exact = refresh(args)
+    print(f"width {args.width}: full eigh refresh {t_full*1000:9.1f} ms")
+    for rank in args.rank:
+        t_low, approx = refresh(args, low_rank=rank, low_rank_min_dim=args.width)
+        error = max((torch.norm(a - e) / torch.norm(e)).item()
+                    for a, e in zip(approx, exact))
+        cosine = min(torch.nn.functional.cosine_similarity(a.flatten(), e.flatten(), 0).item()
+                     for a, e in zip(approx, exact))
+        print(f"width {args.width}: rank {rank:4d} refresh {t_low*1000:9.1f} ms"
+              f"   x{t_full/t_low:5.2f}   max rel. error {error:.2e}"
+              f"   min cosine {cosine:.3f}")
+
+
+if __name__ == "__main__":
+    main()
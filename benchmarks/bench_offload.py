@@ -0,0 +1,51 @@
+"""KFAC step time and resident factor memory with the offload tier
+
+    python benchmarks/bench_offload.py --model=resnet32 --resident-mb 0 4 16
+"""
+import argparse
+import torch
+from common import kfac, build_model, forward_backward, timeit
+
+
+def run(args, offload=None, resident_mb=0.):
+    torch.manual_seed(0)
+    model, input_shape = build_model(args.model)
+    preconditioner = kfac.KFAC(model, fac_update_freq=1, kfac_update_freq=args.kfac_update_freq,
+                               gradient_clip="kl", offload=offload,
+                               offload_resident_mb=resident_mb)
+
+    def step():
+        forward_backward(model, input_shape, args.batch_size)
+        preconditioner.step()
+
+    step()  # initializes the factors and eigendecompositions
+    t = timeit(step, repeat=args.steps, warmup=0)
+    memory = sum(getattr(preconditioner, name)[m].numel() * 4
+                 for name in kfac.offload.OFFLOAD_DICTS
+                 for m in preconditioner.modules if m in getattr(preconditioner, name))
+    peak = memory if offload is None else preconditioner.offload.peak_bytes
+    return t, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC offload benchmark')
+    parser.add_argument('--model', type=str, default='resnet32')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--kfac-update-freq', type=int, default=5)
+    parser.add_argument('--resident-mb', type=float, nargs='+', default=[0, 4, 16])
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    t, peak = run(args)
+    print(f"{args.model} resident         {t * 1e3:8.1f} ms/step {peak / 2 ** 20:8.2f} MB")
+    for tier in ('cpu', 'memmap'):
+        for budget in args.resident_mb:
+            t, peak = run(args, tier, budget)
+            print(f"{args.model} {tier:<6} {budget:5.1f} MB {t * 1e3:8.1f} ms/step "
+                  f"{peak / 2 ** 20:8.2f} MB peak resident")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Refresh and per-step cost of the `eigen`, `inverse` and `newton`
+preconditioning modes
+
+The `newton` refresh is timed from the cold start, and once warm-started
+from the inverses of the previous factors after one more factor update.
+
+    python benchmarks/bench_precondition_mode.py --model=resnet32 --newton-p 1
+"""
+import argparse
+import torch
+from common import kfac, build_model, forward_backward, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC preconditioning mode benchmark')
+    parser.add_argument('--model', type=str, default='resnet32')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--factored-damping', action='store_true', default=False)
+    parser.add_argument('--newton-p', type=int, default=1)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    for mode in ("eigen", "inverse", "newton"):
+        torch.manual_seed(0)
+        model, input_shape = build_model(args.model)
+        preconditioner = kfac.KFAC(model, distribute_layer_factors=False,
+                                   precondition_mode=mode,
+                                   factored_damping=args.factored_damping,
+                                   newton_p=args.newton_p)
+        forward_backward(model, input_shape, args.batch_size)
+        preconditioner.damping = preconditioner.param_groups[0]['damping']
+        preconditioner._update_A()
+        preconditioner._update_G()
+
+        if mode == "inverse":
+            refresh = preconditioner._update_inverse
+        elif mode == "newton":
+            def refresh():
+                for inverses in (preconditioner.m_iA, preconditioner.m_iG):
+                    for inverse in inverses.values():
+                        inverse.zero_()
+                preconditioner._update_inverse()
+        else:
+            refresh = lambda: preconditioner._update_eigen(1)
+
+        def precondition():
+            for module in preconditioner.modules:
+                grad = preconditioner._get_grad(module)
+                preconditioner._get_preconditioned_grad(module, grad)
+
+        t_refresh = timeit(refresh, repeat=args.repeat)
+        t_step = timeit(precondition, repeat=args.repeat)
+        print(f"{args.model} {mode:8s} refresh: {t_refresh*1000:8.1f} ms"
+              f"   precondition/step: {t_step*1000:7.2f} ms")
+        if mode == "newton":
+            forward_backward(model, input_shape, args.batch_size)
+            preconditioner._update_A()
+            preconditioner._update_G()
+            stats = dict(preconditioner.newton_stats)
+            t_warm = timeit(preconditioner._update_inverse, repeat=1, warmup=0)
+            iterations = (preconditioner.newton_stats['iterations'] - stats['iterations']) / \
+                         (preconditioner.newton_stats['solves'] - stats['solves'])
+            print(f"{args.model} newton   warm refresh: {t_warm*1000:5.1f} ms"
+                  f"   ({iterations:.1f} iterations per bucket)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Step overhead of the gradient scaling/clipping of KFAC
+
+Times `_update_scale_grad` (kl-clip scaling and AGC) and a whole `step()`
+that neither updates the factors nor refreshes the eigendecompositions.
+
+    python benchmarks/bench_scale_grad.py --model resnet110 vot
+"""
+import argparse
+import torch
+from common import kfac, build_model, forward_backward, timeit
+
+
+def run(args, name, gradient_clip):
+    torch.manual_seed(0)
+    model, input_shape = build_model(name)
+    preconditioner = kfac.KFAC(model, fac_update_freq=1000, kfac_update_freq=1000,
+                               distribute_layer_factors=False,
+                               gradient_clip=gradient_clip)
+    forward_backward(model, input_shape, args.batch_size)
+    preconditioner.step()
+    updates = {m: preconditioner._get_preconditioned_grad(m, preconditioner._get_grad(m))
+               for m in preconditioner.modules}
+    t_scale = timeit(lambda: preconditioner._update_scale_grad(updates),
+                     repeat=args.repeat)
+    t_step = timeit(preconditioner.step, repeat=args.repeat)
+    return len(preconditioner.modules), t_scale, t_step
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC gradient scaling benchmark')
+    parser.add_argument('--model', type=str, nargs='+', default=['resnet110', 'vot'])
+    parser.add_argument('--clip', type=str, nargs='+', default=['kl', 'agc'])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    for name in args.model:
+        for clip in args.clip:
+            try:
+                layers, t_scale, t_step = run(args, name, clip)
+            except Exception as e:
+                print(f"{name:10s} {clip:4s} failed: {e!r}")
+                continue
+            print(f"{name:10s} {clip:4s} {layers:4d} layers   scale_grad {t_scale*1000:8.2f} ms"
+                  f"   step {t_step*1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
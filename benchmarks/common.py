@@ -0,0 +1,75 @@
+"""Shared helpers for the KFAC micro-benchmarks
+
+The benchmarks run on CPU with random data so they can be executed on any
+host, e.g.
+
+    python benchmarks/bench_eigen_refresh.py --model=resnet110
+"""
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+from os.path import dirname, abspath
+
+root_path = dirname(dirname(abspath(__file__)))
+sys.path.append(root_path)
+sys.path.append(os.path.join(root_path, "examples"))
+
+import kfac
+import cifar_resnet as resnet
+from models.VoT import VoT, VoT_config
+
+IMAGE_W, IMAGE_H = 64, 64
+
+
+class QuietLogger:
+    """Minimal stand-in for `DeepLogger` so VoT layers never plot"""
+    epoch = 0
+    batch_idx = 0
+
+    def isPlot(self):
+        return False
+
+
+def build_model(name, num_classes=10):
+    """Build one of the example models by name
+
+    Returns:
+      (model, input_shape) with `input_shape` = (C, H, W)
+    """
+    name = name.lower()
+    if name.startswith("resnet"):
+        return getattr(resnet, name)(), (3, 32, 32)
+    if name == "vot":
+        config = dict(VoT_config)
+        config['use_attention'] = "gabor"
+        config['gradient_clip'] = "agc"
+        config['INPUT_W'] = IMAGE_W // config['pooling_concatenate_size']
+        config['INPUT_H'] = IMAGE_H // config['pooling_concatenate_size']
+        config['positional_encoding'] = ""
+        config['logger'] = QuietLogger()
+        return VoT(config, num_classes=num_classes), (3, IMAGE_W, IMAGE_H)
+    raise ValueError("Unknown model: {}".format(name))
+
+
+def forward_backward(model, input_shape, batch_size=32, num_classes=10):
+    """One training forward/backward pass on random data"""
+    data = torch.randn(batch_size, *input_shape)
+    target = torch.randint(0, num_classes, (batch_size,))
+    model.zero_grad()
+    loss = nn.CrossEntropyLoss()(model(data), target)
+    loss.backward()
+    return loss
+
+
+def timeit(fn, repeat=5, warmup=1):
+    """Return the best wall time of `fn()` over `repeat` runs in seconds"""
+    for _ in range(warmup):
+        fn()
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.time()
+        fn()
+        best = min(best, time.time() - t0)
+    return best
@@ -0,0 +1,91 @@
+"""SGD vs. KFAC vs. EKFAC on a subset of CIFAR-10 with resnet20, on CPU
+
+    python benchmarks/compare_ekfac.py --train-subset 2048 --test-subset 1000 --epochs 3
+
+Downloads CIFAR-10 to `--data-dir` on the first run.
+"""
+import argparse
+import time
+import torch
+import torch.nn as nn
+from torchvision import datasets, transforms
+from common import kfac, build_model
+
+
+def loaders(args):
+    normalize = transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+    train = datasets.CIFAR10(args.data_dir, train=True, download=True,
+                             transform=transforms.Compose([
+                                 transforms.RandomCrop(32, padding=4),
+                                 transforms.RandomHorizontalFlip(),
+                                 transforms.ToTensor(), normalize]))
+    test = datasets.CIFAR10(args.data_dir, train=False, download=True,
+                            transform=transforms.Compose([transforms.ToTensor(), normalize]))
+    generator = torch.Generator().manual_seed(0)
+    train = torch.utils.data.Subset(train, torch.randperm(len(train), generator=generator)[:args.train_subset])
+    test = torch.utils.data.Subset(test, range(args.test_subset))
+    return (torch.utils.data.DataLoader(train, batch_size=args.batch_size, shuffle=True,
+                                        generator=generator),
+            torch.utils.data.DataLoader(test, batch_size=256))
+
+
+def evaluate(model, loader):
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for data, target in loader:
+            correct += (model(data).argmax(1) == target).sum().item()
+    model.train()
+    return correct / len(loader.dataset)
+
+
+def train(args, variant, train_loader, test_loader):
+    torch.manual_seed(0)
+    model, _ = build_model('resnet20')
+    optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=0.9,
+                                weight_decay=5e-4)
+    preconditioner = None
+    if variant != 'sgd':
+        preconditioner = (kfac.EKFAC if variant == 'ekfac' else kfac.KFAC)(
+            model, lr=args.lr, damping=args.damping, gradient_clip="kl",
+            fac_update_freq=args.fac_update_freq, kfac_update_freq=args.kfac_update_freq)
+    criterion = nn.CrossEntropyLoss()
+    for epoch in range(args.epochs):
+        t0, total, count = time.time(), 0., 0
+        for data, target in train_loader:
+            optimizer.zero_grad()
+            loss = criterion(model(data), target)
+            loss.backward()
+            if preconditioner is not None:
+                preconditioner.step()
+            optimizer.step()
+            total += loss.item() * len(data)
+            count += len(data)
+        print(f"{variant:<6} epoch {epoch + 1}: loss {total / count:.4f}  "
+              f"test acc {evaluate(model, test_loader) * 100:5.1f}%  "
+              f"{time.time() - t0:6.1f} s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EKFAC vs. KFAC on CIFAR-10 resnet20')
+    parser.add_argument('--data-dir', type=str, default='/tmp/cifar10')
+    parser.add_argument('--train-subset', type=int, default=2048)
+    parser.add_argument('--test-subset', type=int, default=1000)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--lr', type=float, default=0.05)
+    parser.add_argument('--damping', type=float, default=0.003)
+    parser.add_argument('--fac-update-freq', type=int, default=1)
+    parser.add_argument('--kfac-update-freq', type=int, default=10)
+    parser.add_argument('--variants', type=str, nargs='+', default=['sgd', 'kfac', 'ekfac'])
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    train_loader, test_loader = loaders(args)
+    for variant in args.variants:
+        train(args, variant, train_loader, test_loader)
+
+
+if __name__ == "__main__":
+    main()
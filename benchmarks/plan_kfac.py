@@ -0,0 +1,32 @@
+"""Per-layer K-FAC memory/FLOP report and the plan for a budget
+
+    python benchmarks/plan_kfac.py --model=vot --memory-mb=64 --time-ms=20
+"""
+import argparse
+import torch
+from common import kfac, build_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC memory and time planner')
+    parser.add_argument('--model', type=str, default='vot')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--memory-mb', type=float, default=None)
+    parser.add_argument('--time-ms', type=float, default=None)
+    parser.add_argument('--gflops', type=float, default=10.)
+    parser.add_argument('--fac-update-freq', type=int, default=10)
+    parser.add_argument('--kfac-update-freq', type=int, default=100)
+    args = parser.parse_args()
+
+    model, input_shape = build_model(args.model)
+    plan = kfac.plan_kfac(model, input_shape, batch_size=args.batch_size,
+                          memory_budget_mb=args.memory_mb,
+                          time_budget_ms=args.time_ms, gflops=args.gflops,
+                          fac_update_freq=args.fac_update_freq,
+                          kfac_update_freq=args.kfac_update_freq)
+    print(plan)
+    print("\nKFAC(model, **{})".format(plan.kfac_kwargs()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Per-phase KFAC profile of a model, and the cost of the disabled profiler
+
+    python benchmarks/profile_kfac.py --model=resnet32 --steps=20
+"""
+import argparse
+import torch
+from common import kfac, build_model, forward_backward, timeit
+
+
+def run(args, profile):
+    torch.manual_seed(0)
+    model, input_shape = build_model(args.model)
+    preconditioner = kfac.KFAC(model, fac_update_freq=1, kfac_update_freq=10,
+                               distribute_layer_factors=False,
+                               gradient_clip="kl", profile=profile)
+
+    def step():
+        forward_backward(model, input_shape, args.batch_size)
+        preconditioner.step()
+
+    t_step = timeit(lambda: [step() for _ in range(args.steps)], repeat=1, warmup=0)
+    return preconditioner, t_step / args.steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC phase profile')
+    parser.add_argument('--model', type=str, default='resnet32')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    _, t_off = run(args, profile=False)
+    preconditioner, t_on = run(args, profile=True)
+    print(preconditioner.profiler)
+    print(f"\n{args.model} step: {t_off*1000:.1f} ms (profile off)"
+          f"   {t_on*1000:.1f} ms (profile on)")
+
+    print("\nslowest modules to precondition:")
+    by_module = preconditioner.profiler.by_module('precondition')
+    for name, stats in sorted(by_module.items(), key=lambda kv: -kv[1]['time'])[:5]:
+        print(f"  {name:30s} {stats['time']*1000:8.2f} ms {stats['flops']/1e6:10.1f} MFLOP")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Per-layer bytes of the KFAC factors A and G for a storage layout
+
+    python benchmarks/report_factor_memory.py --model=vot --packed --dtype=bfloat16
+"""
+import argparse
+import torch
+from common import kfac, build_model, forward_backward
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KFAC factor memory report')
+    parser.add_argument('--model', type=str, default='vot')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--packed', action='store_true', default=False)
+    parser.add_argument('--dtype', type=str, default=None,
+                        help='storage dtype [float16, bfloat16] (default: float32)')
+    args = parser.parse_args()
+
+    model, input_shape = build_model(args.model)
+    dtype = getattr(torch, args.dtype) if args.dtype else None
+    preconditioner = kfac.KFAC(model, distribute_layer_factors=False,
+                               packed_factors=args.packed, factor_dtype=dtype)
+    forward_backward(model, input_shape, args.batch_size)
+    preconditioner._update_A()
+    preconditioner._update_G()
+
+    total_dense, total_stored = 0, 0
+    print(f"{'layer':48s} {'dense KB':>10s} {'stored KB':>10s} {'saved KB':>10s}")
+    for name, dense_bytes, stored_bytes in preconditioner.factor_memory_report():
+        total_dense += dense_bytes
+        total_stored += stored_bytes
+        print(f"{name:48s} {dense_bytes/1024:10.1f} {stored_bytes/1024:10.1f} "
+              f"{(dense_bytes-stored_bytes)/1024:10.1f}")
+    print(f"{'total':48s} {total_dense/1024:10.1f} {total_stored/1024:10.1f} "
+          f"{(total_dense-total_stored)/1024:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
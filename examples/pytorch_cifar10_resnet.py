@@ -31,6 +31,7 @@ sys.path.append(root_path)
 import kfac     #export PYTHONPATH=$PYTHONPATH:/home/cys/net-help/kfac_distribute/
 from models import config
 from models.VoT import *
+from models.VoT.gaussian import register_attention_cache_hook
 from vit_pytorch import ViT
 from torchvision.models import resnet50
 from vit_pytorch.distill import DistillableViT, DistillWrapper
@@ -139,38 +140,17 @@ class DeepLogger(SummaryWriter):
         #return self.batch_idx==2
          
 def clip_grad(model,eps = 1.e-3,clip=0.02,method="agc"):   
+    #   adaptive_grad_clip of the Linear weights, batched over layers of the same shape
     known_modules = {'Linear'} 
+    grads, weights = [], []
     for module in model.modules():
         classname = module.__class__.__name__   
-        if classname not in known_modules:
+        if classname not in known_modules or module.weight.grad is None:
             continue
-        if classname == 'Conv2d':
-            assert(False)
-            grad = None            
-        elif classname == 'BertLayerNorm':
-            grad = None
-        else:
-            grad = module.weight.grad.data       
-            W = module.weight.data 
-
-        #   adaptive_grad_clip
-        assert len(grad.shape)==2
-        nR,nC = grad.shape
-        axis = 1 if nR>nC else 0
-        g_norm = unitwise_norm(grad,axis=axis)
-        W_norm = unitwise_norm(W,axis=axis)
-        W_norm[W_norm<eps] = eps
-        # clipped_grad = grad * (W_norm / g_norm)       
-        s = torch.squeeze(clip*W_norm / (g_norm+1.0e-6))     
-        s = torch.clamp(s, max=1)
-        if s.numel()==nC:       #nC                
-            grad = grad*s                
-        else:                   #nR           
-            grad = torch.einsum('rc,r->rc', grad, s)
-        module.weight.grad.data.copy_(grad)
-
-        if module.bias is not None:
-            pass    #grad = torch.cat([grad, module.bias.grad.data.view(-1, 1)], 1)
+        grads.append(module.weight.grad.data)
+        weights.append(module.weight.data)
+    if grads:
+        kfac.utils.adaptive_clip_grads_(grads, weights, clip=clip, eps=eps)
 
 def train(epoch):
     log_writer.epoch = epoch
@@ -236,6 +216,8 @@ def train(epoch):
         if batch_idx % report_frequency == 0:
             print(f"\rEpoch {epoch + 1:3d}/{config.epochs:3d}\t{batch_idx}/{len(train_loader)} \tlr={lr_opt:.3f}, loss: {train_loss.avg.item():.4f}, acc: {100*acc:.2f}%, {x_info},T={time.time()-t0:.1f}",end="")
     print(f"")
+    if use_kfac:
+        preconditioner.dump_epoch(epoch + 1, log_writer)
 
     if not STEP_FIRST:
         for scheduler in lr_scheduler:
@@ -411,9 +393,11 @@ if __name__ == "__main__":
     if model_name == "jaggi":
         optimizer, lrs = Jaggi_get_optimizer(train_loader,model.named_parameters(),VoT_config)
         # lr_scheduler.append(lrs)
+    # the cached positional attention of the Gaussian layers is stale after a step
+    register_attention_cache_hook(optimizer, model)
 
     if use_kfac:
-        kfac_core = kfac.CG_KFAC if False else kfac.KFAC
+        kfac_core = kfac.EKFAC if args.kfac_variant == 'ekfac' else kfac.KFAC
         # preconditioner = kfac.KFAC(model, lr=args.base_lr, factor_decay=args.stat_decay, 
         #                            damping=args.damping, kl_clip=args.kl_clip, 
         #                            fac_update_freq=args.kfac_cov_update_freq, 
@@ -426,16 +410,35 @@ if __name__ == "__main__":
                                 gradient_clip = config.gradient_clip,
                                 fac_update_freq=args.kfac_cov_update_freq, 
                                 kfac_update_freq=args.kfac_update_freq,
-                                diag_blocks=args.diag_blocks,
+                                diag_blocks=args.diag_blocks if args.diag_blocks_linear is None else
+                                            {'Conv2d': args.diag_blocks, 'Linear': args.diag_blocks_linear},
                                 diag_warmup=args.diag_warmup,
-                                distribute_layer_factors=args.distribute_layer_factors)
+                                distribute_layer_factors=args.distribute_layer_factors,
+                                precondition_mode=args.precondition_mode,
+                                newton_p=args.kfac_newton_p,
+                                num_workers=args.kfac_workers,
+                                threads_per_worker=args.kfac_worker_threads,
+                                streaming_factors=args.kfac_streaming_factors,
+                                patch_budget_mb=args.kfac_patch_budget_mb,
+                                patch_subsample=args.kfac_patch_subsample,
+                                packed_factors=args.kfac_packed_factors,
+                                factor_dtype=getattr(torch, args.kfac_factor_dtype) if args.kfac_factor_dtype else None,
+                                async_eigen=args.kfac_async_eigen,
+                                max_staleness=args.kfac_max_staleness,
+                                refresh_drift=args.kfac_refresh_drift,
+                                max_refresh_age=args.kfac_max_refresh_age,
+                                low_rank=args.kfac_low_rank,
+                                low_rank_min_dim=args.kfac_low_rank_min_dim,
+                                offload=args.kfac_offload,
+                                offload_dir=args.kfac_offload_dir,
+                                offload_resident_mb=args.kfac_offload_resident_mb)
         kfac_param_scheduler = kfac.KFACParamScheduler(preconditioner,
                 damping_alpha=args.damping_alpha,
                 damping_schedule=args.damping_schedule,
                 update_freq_alpha=args.kfac_update_freq_alpha,
                 update_freq_schedule=args.kfac_update_freq_schedule)
     else:
-        preconditioner = None
+        preconditioner = kfac_param_scheduler = None
 
     print(f"======== optimizer={optimizer}\n\n======== MODEL={model.name_()}\n======== preconditioner={preconditioner}")
     # KFAC guarentees grads are equal across ranks before opt.step() is called
@@ -458,11 +461,30 @@ if __name__ == "__main__":
         lr_scheduler.append(LambdaLR(preconditioner, lrs))
     for ls in lr_scheduler:
         print(f"======== lr_scheduler={ls.state_dict()}")
+    start_epoch = 0
+    if args.resume is not None:
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        for scheduler, state in zip(lr_scheduler, checkpoint['lr_scheduler']):
+            scheduler.load_state_dict(state)
+        if preconditioner is not None and 'preconditioner' in checkpoint:
+            preconditioner.load_state_dict(checkpoint['preconditioner'])
+            kfac_param_scheduler.load_state_dict(checkpoint['kfac_scheduler'])
+        start_epoch = checkpoint['epoch'] + 1
     start = time.time()
 
-    for epoch in range(config.epochs):
+    for epoch in range(start_epoch, config.epochs):
         train(epoch)
         test(epoch)
+        if args.checkpoint is not None and (not isHVD or hvd.rank() == 0):
+            state = dict(epoch=epoch, model=model.state_dict(),
+                         optimizer=optimizer.state_dict(),
+                         lr_scheduler=[scheduler.state_dict() for scheduler in lr_scheduler])
+            if preconditioner is not None:
+                state['preconditioner'] = preconditioner.state_dict()
+                state['kfac_scheduler'] = kfac_param_scheduler.state_dict()
+            torch.save(state, args.checkpoint)
 
     if verbose:
         print("\nTraining time:", str(datetime.timedelta(seconds=time.time() - start)))
@@ -98,6 +98,9 @@ def initialize():
                         help='Compute A and G for a single layer on different workers. '
                               'None to determine automatically based on worker and '
                               'layer count.')
+    parser.add_argument('--kfac-streaming-factors', action='store_true', default=False,
+                        help='Accumulate KFAC factors inside the hooks over all '
+                             'micro-batches instead of keeping the activations')
 
     parser.add_argument('--no-cuda', action='store_true', default=False,
                         help='disables CUDA training')
@@ -229,7 +232,8 @@ def get_model(args):
                 kfac_update_freq=args.kfac_update_freq,
                 diag_blocks=args.diag_blocks,
                 diag_warmup=args.diag_warmup,
-                distribute_layer_factors=args.distribute_layer_factors)
+                distribute_layer_factors=args.distribute_layer_factors,
+                streaming_factors=args.kfac_streaming_factors)
         kfac_param_scheduler = kfac.KFACParamScheduler(
                 preconditioner,
                 damping_alpha=args.damping_alpha,
@@ -238,7 +242,7 @@ def get_model(args):
                 update_freq_schedule=args.kfac_update_freq_decay,
                 start_epoch=args.resume_from_epoch)
     else:
-        preconditioner = None
+        preconditioner = kfac_param_scheduler = None
 
     compression = hvd.Compression.fp16 if args.fp16_allreduce \
                                        else hvd.Compression.none
@@ -255,6 +259,13 @@ def get_model(args):
         checkpoint = torch.load(filepath)
         model.load_state_dict(checkpoint['model'])
         optimizer.load_state_dict(checkpoint['optimizer'])
+    # the K-FAC factors are not broadcast, every worker loads them
+    if args.resume_from_epoch > 0 and preconditioner is not None:
+        filepath = args.checkpoint_format.format(epoch=args.resume_from_epoch)
+        checkpoint = torch.load(filepath, map_location='cpu')
+        if 'preconditioner' in checkpoint:
+            preconditioner.load_state_dict(checkpoint['preconditioner'])
+            kfac_param_scheduler.load_state_dict(checkpoint['kfac_scheduler'])
 
     # Horovod: broadcast parameters & optimizer state.
     hvd.broadcast_parameters(model.state_dict(), root_rank=0)
@@ -367,7 +378,8 @@ if __name__ == '__main__':
         train(epoch, model, opt, preconditioner, lr_schedules, lrs,
              loss_func, train_sampler, train_loader, args)
         validate(epoch, model, loss_func, val_loader, args)
-        save_checkpoint(model, opt, args.checkpoint_format, epoch)
+        save_checkpoint(model, opt, args.checkpoint_format, epoch,
+                        preconditioner, kfac_param_scheduler)
 
     if args.verbose:
         print("\nTraining time:", str(timedelta(seconds=time.time() - start)))
@@ -193,11 +193,13 @@ def get_model(args):
                           momentum=args.momentum, weight_decay=args.wd)
 
     if args.kfac_update_freq > 0:
+        # the Embedding encoder, the LSTM/GRU layers and the decoder are all
+        # preconditioned, a tied encoder is left to the decoder
         preconditioner = kfac.KFAC(
-                model, lr=args.base_lr, stat_decay=args.stat_decay,
+                model, lr=args.base_lr, factor_decay=args.stat_decay,
                 damping=args.damping, kl_clip=args.kl_clip,
-                TCov=args.kfac_cov_update_freq,
-                TInv=args.kfac_update_freq,
+                fac_update_freq=args.kfac_cov_update_freq,
+                kfac_update_freq=args.kfac_update_freq,
                 diag_blocks=args.diag_blocks,
                 diag_warmup=args.diag_warmup)
     else:
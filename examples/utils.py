@@ -7,13 +7,18 @@ def accuracy(output, target):
     pred = output.max(1, keepdim=True)[1]
     return pred.eq(target.view_as(pred)).cpu().float().mean()
 
-def save_checkpoint(model, optimizer, checkpoint_format, epoch):
+def save_checkpoint(model, optimizer, checkpoint_format, epoch,
+                    preconditioner=None, kfac_scheduler=None):
     if hvd.rank() == 0:
         filepath = checkpoint_format.format(epoch=epoch + 1)
         state = {
             'model': model.state_dict(),
             'optimizer': optimizer.state_dict(),
         }
+        if preconditioner is not None:
+            state['preconditioner'] = preconditioner.state_dict()
+        if kfac_scheduler is not None:
+            state['kfac_scheduler'] = kfac_scheduler.state_dict()
         torch.save(state, filepath)
 
 class LabelSmoothLoss(torch.nn.Module):
@@ -2,9 +2,57 @@ import math
 import torch
 import time
 import multiprocessing
+import torch.nn as nn
 from .kfac_preconditioner import *
+from kfac.utils import conjugate_gradient, _group_by_shape, _extract_patches, \
+                       RecurrentWeights
 
 class CG_KFAC(KFAC):
+    """KFAC that solves (G (x) A + damping I) v = grad with conjugate gradient
+
+    Instead of inverting the factors, the preconditioned gradient of every
+    layer is found with a few CG iterations on the Kronecker factored
+    Fisher-vector product G V A + damping V. The layers whose gradients
+    have the same shape are stacked and solved together by the batched
+    `kfac.utils.conjugate_gradient`.
+
+    Args:
+      model, lr, factor_decay, damping, kl_clip, fac_update_freq,
+      kfac_update_freq, batch_averaged, diag_blocks, diag_warmup,
+      distribute_layer_factors, comm, profile: see `KFAC`
+      cg_max_iters (int, optional): maximum CG iterations (default: 10)
+      cg_tol (float, optional): relative squared residual at which CG stops
+          (default: 0.01)
+      cg_check_freq (int, optional): iterations between the convergence
+          checks, each syncs with the device once (default: 5)
+      cg_precond (str, optional): `'jacobi'` preconditions CG with the
+          diagonal diag(G) diag(A)^T + damping of the system. `'eigen'` with
+          the K-FAC inverse built from the eigendecompositions `m_QA`,
+          `m_dA`, `m_QG` and `m_dG`, refreshed every `kfac_update_freq`
+          steps, so CG only corrects for the factor updates since the last
+          refresh. `None` runs plain CG (default: None)
+      cg_warm_start (bool, optional): start CG from the last solution of
+          the layer. Failed solves are not kept as warm starts
+          (default: False)
+      cg_mode (str or dict, optional): `'module'` solves every layer on its
+          own Kronecker factored block. `'global'` solves all the layers
+          together with the empirical Fisher of the examples of the last
+          factor update, including the blocks between the layers, computed
+          from the saved inputs `m_a` and output gradients `m_g`. These are
+          only gathered on the factor update steps, every `fac_update_freq`
+          steps, the other steps solve the layers in `'module'` mode. A dict
+          selects the mode per layer name or class name, e.g.
+          `{'Linear': 'global'}`, the other layers use `'module'`
+          (default: 'module')
+      cg_time_limit (float, optional): wall-clock seconds after which the
+          global solve of a step stops, checked every `cg_check_freq`
+          iterations (default: None)
+
+    The iterations of the global solve are also capped by a budget adapted
+    from the residual decrease per iteration observed in the last solves,
+    i.e. the iterations expected to reach `cg_tol` with some slack. Its vectors
+    live in one flat buffer that is only reallocated if the layers change.
+    """
     def __init__(self,
                  model,
                  lr=0.1,
@@ -16,9 +64,34 @@ class CG_KFAC(KFAC):
                  batch_averaged=True,
                  diag_blocks=1,
                  diag_warmup=0,
-                 distribute_layer_factors=None):
+                 distribute_layer_factors=None,
+                 comm=None,
+                 profile=False,
+                 cg_max_iters=10,
+                 cg_tol=0.01,
+                 cg_check_freq=5,
+                 cg_precond=None,
+                 cg_warm_start=False,
+                 cg_mode='module',
+                 cg_time_limit=None):
+        if not 0 < cg_max_iters:
+            raise ValueError("Invalid CG iterations: {}".format(cg_max_iters))
+        if not 0.0 < cg_tol:
+            raise ValueError("Invalid CG tolerance: {}".format(cg_tol))
+        if not 0 < cg_check_freq:
+            raise ValueError("Invalid CG check frequency: {}".format(cg_check_freq))
+        if cg_precond not in (None, "jacobi", "eigen"):
+            raise ValueError("Invalid CG preconditioner: {}".format(cg_precond))
+        modes = cg_mode.values() if isinstance(cg_mode, dict) else [cg_mode]
+        if any(mode not in ("module", "global") for mode in modes):
+            raise ValueError("Invalid CG mode: {}".format(cg_mode))
+        if cg_time_limit is not None and not 0.0 < cg_time_limit:
+            raise ValueError("Invalid CG time limit: {}".format(cg_time_limit))
+        # read by `_init_A`/`_init_G` during the base initialization
+        self.cg_precond = cg_precond
         super(CG_KFAC,self).__init__(model,lr,factor_decay,damping,kl_clip,fac_update_freq,
-            kfac_update_freq,batch_averaged,diag_blocks,diag_warmup,distribute_layer_factors)
+            kfac_update_freq,batch_averaged,diag_blocks,diag_warmup,distribute_layer_factors,
+            comm=comm,profile=profile)
 
         group = self.param_groups[0]
         self.lr = group['lr']
@@ -29,21 +102,32 @@ class CG_KFAC(KFAC):
         self.fac_update_freq = group['fac_update_freq']
         self.kfac_update_freq = group['kfac_update_freq']
 
+        # last CG solution of each layer, see `cg_warm_start`
         self.last_x0 = {}
-        for module in self.modules:
-            self.last_x0[module] = None
-        self.use_last_x0 = False
+        self.use_last_x0 = cg_warm_start
         self.adaptive_damping = True
 
-        self.T_r = 0.01
-        self.T_m = 10
+        self.T_r = cg_tol
+        self.T_m = cg_max_iters
+        self.cg_check_freq = cg_check_freq
         self.nIter = 0
         self.n_1 = 0
         self.n_2 = 0
         self.n_3 = 0
         self.T_all = 0
 
-        self.mog_info = {}
+        self.cg_mode = cg_mode
+        self.cg_time_limit = cg_time_limit
+        self.global_modules = [m for m in self.modules if self._get_cg_mode(m) == "global"]
+        # iteration budget of the global solve and the smoothed log decrease
+        # of the squared residual per iteration it is derived from
+        self.cg_budget = self.T_m
+        self.cg_rate = None
+        # rows b, x, r, p, u (and z) of the global solve
+        self.cg_buffer = None
+        self._cg_warm = False
+        self._global_shapes = None
+        self._global_stats = self._global_preconds = None
 
     def __repr__(self):
         return f"lr={self.lr:.4f} damping={self.damping},adaptive_damping={self.adaptive_damping},fac_update_freq={self.fac_update_freq},\n \
@@ -55,13 +139,30 @@ class CG_KFAC(KFAC):
         return info
     
     def _init_A(self, factor, module):
-        self.m_A[module] = torch.diag(factor.new(factor.shape[0]).fill_(1))
+        if self.cg_precond == "eigen":
+            return super(CG_KFAC, self)._init_A(factor, module)
+        self.m_A[module] = self.factor_storage.eye(factor)
 
     def _init_G(self, factor, module):
-        self.m_G[module] = torch.diag(factor.new(factor.shape[0]).fill_(1))
+        if self.cg_precond == "eigen":
+            return super(CG_KFAC, self)._init_G(factor, module)
+        self.m_G[module] = self.factor_storage.eye(factor)
     
     def _clear_eigen(self):
         return
+
+    def _get_diag_blocks(self, module, diag_blocks):
+        # CG multiplies with the full factors
+        return 1
+
+    def _get_cg_mode(self, module):
+        """`cg_mode` of module, see `_get_diag_blocks` for the dict lookup"""
+        if not isinstance(self.cg_mode, dict):
+            return self.cg_mode
+        name = self.module_names.get(module)
+        if name in self.cg_mode:
+            return self.cg_mode[name]
+        return self.cg_mode.get(module.__class__.__name__, "module")
     
     def _update_scale_grad(self, updates):
         # vg_sum = 0
@@ -72,13 +173,16 @@ class CG_KFAC(KFAC):
         #         vg_sum += (v[1] * module.bias.grad.data * self.lr ** 2).sum().item()
         # nu = min(1.0, math.sqrt(self.kl_clip / abs(vg_sum)))
 
-        for module in self.modules:
+        grads, precon_grads = [], []
+        for module in self.modules + self.diag_modules:
             v = updates[module]
-            module.weight.grad.data.copy_(v[0])
-            module.weight.grad.data.mul_(self.nu)
-            if module.bias is not None:
-                module.bias.grad.data.copy_(v[1])
-                module.bias.grad.data.mul_(self.nu)
+            grads.append(module.weight.grad.data)
+            precon_grads.append(v[0])
+            if getattr(module, 'bias', None) is not None:
+                grads.append(module.bias.grad.data)
+                precon_grads.append(v[1])
+        torch._foreach_copy_(grads, precon_grads)
+        torch._foreach_mul_(grads, self.nu)
 
     
     def step(self, closure=None, epoch=None,accuracy=0):
@@ -99,12 +203,26 @@ class CG_KFAC(KFAC):
         else:
             diag_blocks = self.diag_blocks if epoch >= self.diag_warmup else 1
 
-        if self.steps % self.fac_update_freq == 0:
-            self._update_A()
-            self._update_G()
-            if hvd.size() > 1:
-                self._allreduce_factors()
-            
+        # the global solve needs the statistics of this step's examples
+        factor_step = self._factor_step()
+        if factor_step:
+            with self.profiler.span('factor_A'):
+                self._update_A()
+            handles = self._allreduce_factors(self.m_A)
+            with self.profiler.span('factor_G'):
+                self._update_G()
+            handles += self._allreduce_factors(self.m_G)
+            if self.diag_modules:
+                with self.profiler.span('factor_diag'):
+                    self._update_diagonal()
+                handles += self._allreduce_diagonal()
+            self.comm.synchronize(handles)
+
+        if self.cg_precond == "eigen":
+            modules = self._get_refresh_modules()
+            if modules:
+                self._update_eigen(1, modules=modules)
+        self._refresh_diagonal()
 
         # if we are switching from no diag approx to approx, we need to clear
         # off-block-diagonal elements
@@ -135,20 +253,23 @@ class CG_KFAC(KFAC):
             #     self._update_eigen_A(module, ranks_a)
             #     self._update_eigen_G(module, ranks_g)
 
-            # if hvd.size() > 1:
-            #     self._allreduce_eigendecomp()
+            # if self.comm_size > 1:
+            #     self._allgather_results()
         self.isFail = False
-        if False:        
-            self.cys_grad(updates)
-        else:
-            for module in self.modules:     #To use CUDA with multiprocessing, you must use the 'spawn' start method
-                # grad = self._get_grad(module)            
-                self._get_preconditioned_grad(module,updates)            
-                # updates[module] = precon_grad            
+        with self.profiler.span('precondition'):
+            global_modules = self.global_modules if factor_step else []
+            self._solve_modules([m for m in self.modules if m not in global_modules],
+                                updates)
+            if global_modules:
+                self._solve_global(global_modules, updates)
+            for module in self.diag_modules:
+                updates[module] = self._get_diagonal_preconditioned_grad(module)
 
-        self._update_scale_grad(updates)
+        with self.profiler.span('scale_grad'):
+            self._update_scale_grad(updates)
 
         self.steps += 1
+        self._arm_hooks()
         #damping would be very SMALL(1.1e-06!!!)
         # if self.isFail:
         #     self.damping = self.damping*2
@@ -162,140 +283,223 @@ class CG_KFAC(KFAC):
         else:
             self.nu = self.nu*1.01
 
-    def FV(self,a,g,v):          
-        v1 = g.t()@ v @ a
-        # v2 = g @ v1 @ a.t() + self.damping*v
-        # return v2
-        
-        return v1+self.damping*v
-    
-    def CG_m(self,a,g,x0,b):
-        # print(f"a={a.shape}\tg={g.shape}\tx0={x0.shape}")
-        
-        if x0 is None:
-            r = b
-            x = None
-        else:
-            r = b-self.FV(a,g,x0)
-            x = x0
-        p = r             
- 
-        rou_0 = torch.sum(r*r)            
-        res_0 = rou_0
-        m = 0  
-        t0=time.time() 
-        while m<self.T_m:            
-            u = self.FV(a,g,p)
-            s = torch.sum(p*u)
-            alpha = rou_0/s
-            x = alpha*p if x is None else x+alpha*p
-            r = r-alpha*u
-            rou_1 = torch.sum(r*r)
-            if(rou_1/res_0<self.T_r):
-                self.n_2=self.n_2;    break #return x,m+1
-
-            beta = rou_1/rou_0
-            p = r + beta*p
-            rou_0 = rou_1
-            m=m+1
-        
-            self.T_all += time.time()-t0   
-        # print(f"res={res_0:.3f}->{rou_1.item():.6f}\talpha={alpha.item():.3f}\tbeta={beta.item():.3f}")
-        if(rou_1>res_0 or rou_1<=0):    
-            self.isFail = True        
-            self.n_3=self.n_3+1;    return b,m+1
-        return x,m+1
-
-    def _get_preconditioned_grad(self, module,updates):           # 
-        grad = self._get_grad(module)  
-        self.n_1=self.n_1+1
-        if self.use_last_x0 and self.last_x0[module] is None:
-            self.last_x0[module] = torch.zeros_like(grad)     
-            
-        v,nIter = self.CG_m(self.m_A[module],self.m_G[module],self.last_x0[module],grad)
-        
-        if self.use_last_x0:
-            self.last_x0[module] = v
-        self.nIter=self.nIter+nIter
+    def FV(self,a,g,v):
+        """Fisher-vector product (G (x) A + damping I) v of the stacked
+        factors `a`, `g` and gradients `v` (A and G are symmetric)"""
+        return g @ v @ a + self.damping * v
+
+    def _cg_preconditioner(self, modules, a, g):
+        """Function applying the `cg_precond` preconditioner of the stacked
+        `modules` with factors `a` and `g`, or `None`"""
+        if self.cg_precond == "jacobi":
+            diagonal = g.diagonal(dim1=-2, dim2=-1).unsqueeze(2) * \
+                       a.diagonal(dim1=-2, dim2=-1).unsqueeze(1) + self.damping
+            return lambda r: r / diagonal
+        if self.cg_precond == "eigen":
+            QA = torch.stack([self.m_QA[m] for m in modules])
+            QG = torch.stack([self.m_QG[m] for m in modules])
+            scale = 1. / (torch.stack([self.m_dG[m] for m in modules]).unsqueeze(2) *
+                          torch.stack([self.m_dA[m] for m in modules]).unsqueeze(1) +
+                          self.damping)
+            return lambda r: QG @ ((QG.mT @ r @ QA) * scale) @ QA.mT
+        return None
+
+    def _solve_modules(self, modules, updates):
+        """Precondition the gradients of `modules` with batched CG
+
+        The layers are grouped by gradient shape and every group is solved
+        as one stack. A failed solve keeps the gradient of its layer.
+        """
+        grads = [self._get_grad(module) for module in modules]
+        for group in _group_by_shape(grads):
+            group_modules = [modules[i] for i in group]
+            b = torch.stack([grads[i] for i in group])
+            a = torch.stack([self.factor_storage.dense(self.m_A[m]) for m in group_modules])
+            g = torch.stack([self.factor_storage.dense(self.m_G[m]) for m in group_modules])
+            x0 = None
+            if self.use_last_x0 and any(m in self.last_x0 for m in group_modules):
+                x0 = torch.stack([self.last_x0.get(m, torch.zeros_like(grads[i]))
+                                  for m, i in zip(group_modules, group)])
+            t0 = time.time()
+            x, iterations, failed = conjugate_gradient(
+                    lambda v: self.FV(a, g, v), b, x0,
+                    self._cg_preconditioner(group_modules, a, g),
+                    self.T_m, self.T_r, self.cg_check_freq)
+            x = torch.where(failed.view(-1, 1, 1), b, x)
+            self.T_all += time.time() - t0
+            self.n_1 += len(group)
+            self.nIter += int(iterations.sum())
+            failed = failed.tolist()
+            self.n_3 += sum(failed)
+            self.isFail = self.isFail or any(failed)
+            for j, module in enumerate(group_modules):
+                if self.use_last_x0:
+                    if failed[j]:
+                        self.last_x0.pop(module, None)
+                    else:
+                        self.last_x0[module] = x[j]
+                updates[module] = self._split_update(module, x[j])
+
+    def _split_update(self, module, v):
+        """Weight (and bias) update of module from its (out, in [+1]) `v`"""
         if module.bias is not None:
             v = [v[:, :-1], v[:, -1:]]
             v[0] = v[0].view(module.weight.grad.data.size()) # weight
             v[1] = v[1].view(module.bias.grad.data.size())   # bias
         else:
             v = [v.view(module.weight.grad.data.size())]
-        updates[module] = v
-        return   
-
-    def FV_all(self,v000):    
-        for module in self.modules:
-            g=self.m_G[module]
-            a=self.m_A[module]
-            info = self.mog_info[module]
-            v = v000[info[1]:info[2]].view(info[0])      
-            v1 = g.t()@ v @ a+self.damping*v
-            self.cg_u[info[1]:info[2]] = v1.view(-1)
-            assert(torch.numel(v1)==info[2]-info[1])
-
-        return self.cg_u
-
-    def CG_all(self,b):
-        # print(f"a={a.shape}\tg={g.shape}\tx0={x0.shape}")
-        r = b
-        x = None
-        p = r             
- 
-        rou_0 = torch.sum(r*r)            
-        res_0 = rou_0
-        m = 0  
-        t0=time.time() 
-        while m<self.T_m:            
-            u = self.FV_all(p)
-            s = torch.sum(p*u)
-            alpha = rou_0/s
-            x = alpha*p if x is None else x+alpha*p
-            r = r-alpha*u
-            rou_1 = torch.sum(r*r)
-            if(rou_1/res_0<self.T_r):
-                self.n_2=self.n_2;    break #return x,m+1
-
-            beta = rou_1/rou_0
-            p = r + beta*p
-            rou_0 = rou_1
-            m=m+1
-        
-        self.T_all += time.time()-t0   
-        # print(f"res={res_0:.3f}->{rou_1.item():.6f}\talpha={alpha.item():.3f}\tbeta={beta.item():.3f}")
-        if(rou_1>res_0 or rou_1<=0):            
-            self.n_3=self.n_3+1;    return b,m+1
-        return x,m+1
-
-    def cys_grad(self,updates):
-        self.n_1=self.n_1+1    
-        grad_ = []
-        nz = 0
-        for module in self.modules:     #To use CUDA with multiprocessing, you must use the 'spawn' start method
-            g_ = self._get_grad(module)
-            n = torch.numel(g_)
-            self.mog_info[module]=[g_.shape,nz,nz+n]
-            grad_.append(g_.view(-1))
-            nz = nz+n
-        grad = torch.cat(grad_, dim=0)
-        self.cg_u = torch.zeros_like(grad)
-        
-        
-        x,nIter = self.CG_all(grad)   
-        self.nIter=self.nIter+nIter
-        
-        k0,k1=0,0
-        for module in self.modules:
-            info = self.mog_info[module]
-            v = x[info[1]:info[2]].view(info[0])
-            if module.bias is not None:
-                v = [v[:, :-1], v[:, -1:]]
-                v[0] = v[0].view(module.weight.grad.data.size()) # weight
-                v[1] = v[1].view(module.bias.grad.data.size())   # bias
-            else:
-                v = [v.view(module.weight.grad.data.size())]
-            updates[module] = v
+        return v
+
+    def _get_global_stats(self, module):
+        """Per-example inputs a (N, L, in [+1]) and output gradients
+        g (N, L, out) of module from the `m_a`/`m_g` of this step, a factor
+        update step, L being the positions (conv) or timesteps whose products
+        g a^T add up to the gradient of an example. g is scaled to the loss
+        of a single example."""
+        a, g = self.m_a[module], self.m_g[module]
+        if isinstance(module, nn.Conv2d):
+            a = _extract_patches(a, module.kernel_size, module.stride, module.padding)
+            g = g.flatten(2).transpose(1, 2)
+        elif isinstance(module, RecurrentWeights):
+            a, g = a.transpose(0, 1), g.transpose(0, 1)
+        a = a.reshape(a.size(0), -1, a.size(-1))
+        g = g.reshape(g.size(0), -1, g.size(-1))
+        if module.bias is not None:
+            a = torch.cat([a, a.new_ones(a.size(0), a.size(1), 1)], 2)
+        if self.batch_averaged:
+            g = g * g.size(0)
+        return a, g
+
+    def _global_views(self, flat):
+        """Views of the flat vector `flat` as the gradients of the global layers"""
+        views, start = [], 0
+        for shape in self._global_shapes:
+            n = shape[0] * shape[1]
+            views.append(flat[start:start + n].view(shape))
+            start += n
+        return views
+
+    def FV_all(self, p, out):
+        """Fisher-vector product (F + damping I) p of the flat vector `p`
+        of the global layers into `out`
+
+        F = 1/N sum_n J_n J_n^T is the empirical Fisher of the N examples
+        of the last factor update, J_n being the gradient of example n
+        over all the global layers.
+        """
+        s = 0
+        for (a, g), v in zip(self._global_stats, self._global_views(p)):
+            s = s + ((g @ v) * a).sum((1, 2))
+        s = s / s.numel()
+        for (a, g), v, u in zip(self._global_stats, self._global_views(p),
+                                self._global_views(out)):
+            torch.mm((g * s[:, None, None]).flatten(0, 1).t(), a.flatten(0, 1), out=u)
+            u.add_(v, alpha=self.damping)
+        return out
+
+    def _global_precondition(self, r, z):
+        """z = M^-1 r with the `cg_precond` of every global layer"""
+        for precond, r_m, z_m in zip(self._global_preconds, self._global_views(r),
+                                     self._global_views(z)):
+            z_m.copy_(precond(r_m.unsqueeze(0))[0])
+
+    def _global_budget(self, target):
+        """Iterations expected to reduce the squared residual by the factor
+        `target` at the observed rate with a quarter of slack, at most
+        `cg_max_iters`"""
+        if self.cg_rate is None or self.cg_rate >= 0:
+            return self.T_m
+        return max(1, min(self.T_m, math.ceil(1.25 * math.log(target) / self.cg_rate)))
+
+    def CG_all(self, b):
+        """Preconditioned CG on (F + damping I) x = b for the global layers
+
+        All vectors are rows of `cg_buffer`, updated in place. Returns the
+        solution (`b` if CG failed), the iterations and if CG failed.
+        """
+        x, r, p, u = self.cg_buffer[1:5]
+        z = self.cg_buffer[5] if self.cg_precond is not None else r
+        b_norm = b.dot(b)
+        if self.use_last_x0 and self._cg_warm:
+            torch.sub(b, self.FV_all(x, u), out=r)
+            if not bool(r.dot(r) < b_norm):
+                x.zero_()
+                r.copy_(b)
+        else:
+            x.zero_()
+            r.copy_(b)
+        if self.cg_precond is not None:
+            self._global_precondition(r, z)
+        p.copy_(z)
+        rz = r.dot(z)
+        r_norm_0 = float(r.dot(r))
+        target = self.T_r * float(b_norm)
+        self.cg_budget = self._global_budget(target / r_norm_0) if r_norm_0 > 0 else 0
+        r_norm, m, bad = r_norm_0, 0, torch.zeros((), dtype=torch.bool, device=b.device)
+        t0 = time.time()
+        while r_norm > target and m < self.cg_budget:
+            self.FV_all(p, u)
+            s = p.dot(u)
+            alpha = rz / s
+            x.addcmul_(p, alpha)
+            r.addcmul_(u, alpha, value=-1)
+            if self.cg_precond is not None:
+                self._global_precondition(r, z)
+            rz_next = r.dot(z)
+            bad |= ~(s > 0) | ~torch.isfinite(rz_next)
+            p.mul_(rz_next / rz).add_(z)
+            rz = rz_next
+            m += 1
+            if m % self.cg_check_freq == 0 or m == self.cg_budget:
+                if bool(bad):
+                    break
+                r_norm = float(r.dot(r))
+                if self.cg_time_limit is not None and time.time() - t0 > self.cg_time_limit:
+                    break
+        self.T_all += time.time() - t0
+        failed = bool(bad) or not r_norm <= float(b_norm)
+        if m > 0 and not failed and 0 < r_norm < r_norm_0:
+            rate = math.log(r_norm / r_norm_0) / m
+            self.cg_rate = rate if self.cg_rate is None else (self.cg_rate + rate) / 2
+        self._cg_warm = not failed
+        return (b if failed else x), m, failed
+
+    def _solve_global(self, modules, updates):
+        """Precondition the gradients of `modules` with one CG on the
+        Fisher of all of them, see `cg_mode`"""
+        self._global_stats = [self._get_global_stats(module) for module in modules]
+        examples = {a.size(0) for a, _ in self._global_stats}
+        if len(examples) > 1:
+            raise ValueError("Global CG needs the statistics of the same examples "
+                             "for every layer, got batch sizes {}".format(sorted(examples)))
+        grads = [self._get_grad(module) for module in modules]
+        shapes = [grad.shape for grad in grads]
+        numel = sum(grad.numel() for grad in grads)
+        rows = 5 if self.cg_precond is None else 6
+        if self.cg_buffer is None or self._global_shapes != shapes or \
+                self.cg_buffer.shape != (rows, numel) or \
+                self.cg_buffer.dtype != grads[0].dtype or \
+                self.cg_buffer.device != grads[0].device:
+            self.cg_buffer = grads[0].new_zeros(rows, numel)
+            self._global_shapes = shapes
+            self._cg_warm = False
+        b = self.cg_buffer[0]
+        for view, grad in zip(self._global_views(b), grads):
+            view.copy_(grad)
+        if self.cg_precond is not None:
+            self._global_preconds = [self._cg_preconditioner(
+                    [module], self.factor_storage.dense(self.m_A[module]).unsqueeze(0),
+                    self.factor_storage.dense(self.m_G[module]).unsqueeze(0))
+                    for module in modules]
+
+        x, iterations, failed = self.CG_all(b)
+        self._global_stats = self._global_preconds = None
+        self.n_1 += 1
+        self.nIter += iterations
+        if failed:
+            self.n_3 += 1
+            self.isFail = True
+        for module, v in zip(modules, self._global_views(x)):
+            updates[module] = self._split_update(module, v)
 
          
@@ -1,4 +1,8 @@
 from kfac.kfac_preconditioner import KFAC
 from kfac.kfac_preconditioner import KFACParamScheduler
 from kfac.CG_KFAC import CG_KFAC
+from kfac.ekfac import EKFAC
+from kfac.comm import Comm, TorchDistributedComm
+from kfac.profiler import KFACProfiler
 from kfac.utils import seed_everything
+from kfac.planner import plan_kfac, KFACPlan
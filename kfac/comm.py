@@ -0,0 +1,133 @@
+import torch
+import torch.distributed as dist
+
+
+class Comm:
+    """Single process communication backend
+
+    Base class of the pluggable communication backends used by `KFAC`. With
+    one process every collective is a no-op.
+    """
+
+    def size(self):
+        return 1
+
+    def rank(self):
+        return 0
+
+    def allreduce_async_(self, tensors, average=True):
+        """Start an in-place allreduce of `tensors`
+
+        Returns:
+          list of handles to pass to `synchronize()`
+        """
+        return []
+
+    def synchronize(self, handles):
+        """Wait for the handles of `allreduce_async_()` to complete"""
+        pass
+
+    def allgather_(self, parts):
+        """Share tensors that were computed by a single rank with all ranks
+
+        Args:
+          parts (list): list of `(owner, tensors)`, identical on all ranks.
+              After the call, every rank holds the values of `tensors` that
+              rank `owner` had before the call.
+        """
+        pass
+
+
+class TorchDistributedComm(Comm):
+    """Communication backend built on `torch.distributed`
+
+    Works with any initialized process group, e.g. gloo on a single host:
+
+      torch.distributed.init_process_group('gloo', ...)
+      preconditioner = KFAC(model, comm=TorchDistributedComm())
+
+    Args:
+      group (ProcessGroup, optional): process group to communicate in
+          (default: the world group)
+      bucket_cap_mb (float, optional): tensors are flattened into buckets of
+          at most this size before being allreduced (default: 25)
+    """
+
+    def __init__(self, group=None, bucket_cap_mb=25):
+        if not (dist.is_available() and dist.is_initialized()):
+            raise RuntimeError("torch.distributed must be initialized before "
+                               "creating a TorchDistributedComm")
+        self.group = group
+        self.bucket_cap = int(bucket_cap_mb * 1024 * 1024)
+
+    def size(self):
+        return dist.get_world_size(self.group)
+
+    def rank(self):
+        return dist.get_rank(self.group)
+
+    def _buckets(self, tensors):
+        """Group tensors by dtype/device into buckets of at most `bucket_cap` bytes"""
+        buckets, open_buckets = [], {}
+        for tensor in tensors:
+            key = (tensor.dtype, tensor.device)
+            nbytes = tensor.numel() * tensor.element_size()
+            bucket = open_buckets.get(key)
+            if bucket is None or bucket[1] + nbytes > self.bucket_cap:
+                bucket = open_buckets[key] = [[], 0]
+                buckets.append(bucket[0])
+            bucket[0].append(tensor)
+            bucket[1] += nbytes
+        return buckets
+
+    def allreduce_async_(self, tensors, average=True):
+        handles = []
+        for bucket in self._buckets(tensors):
+            flat = torch.cat([t.reshape(-1) for t in bucket])
+            work = dist.all_reduce(flat, group=self.group, async_op=True)
+            handles.append((work, flat, bucket, average))
+        return handles
+
+    def synchronize(self, handles):
+        for work, flat, bucket, average in handles:
+            work.wait()
+            if average:
+                flat.div_(self.size())
+            offset = 0
+            for tensor in bucket:
+                n = tensor.numel()
+                tensor.copy_(flat[offset:offset + n].view_as(tensor))
+                offset += n
+
+    def allgather_(self, parts):
+        if len(parts) == 0:
+            return
+        size, rank = self.size(), self.rank()
+        owned = [[] for _ in range(size)]
+        for owner, tensors in parts:
+            owned[owner].extend(tensors)
+        numels = [sum(t.numel() for t in tensors) for tensors in owned]
+        reference = parts[0][1][0]
+
+        send = reference.new_zeros(max(numels))
+        if numels[rank] > 0:
+            torch.cat([t.reshape(-1) for t in owned[rank]], out=send[:numels[rank]])
+        recv = [torch.empty_like(send) for _ in range(size)]
+        dist.all_gather(recv, send, group=self.group)
+
+        for r in range(size):
+            if r == rank:
+                continue
+            offset = 0
+            for tensor in owned[r]:
+                n = tensor.numel()
+                tensor.copy_(recv[r][offset:offset + n].view_as(tensor))
+                offset += n
+
+
+def get_comm():
+    """Default backend: `TorchDistributedComm` if a process group is
+    initialized, else the single process `Comm`"""
+    if dist.is_available() and dist.is_initialized():
+        return TorchDistributedComm()
+    return Comm()
@@ -0,0 +1,123 @@
+import inspect
+import torch
+import torch.nn as nn
+
+from kfac.kfac_preconditioner import KFAC
+from kfac.utils import _extract_patches, update_running_avg
+
+
+def _projected_grad_sq(module, a, g, QA, QG, batch_averaged):
+    """Mean over examples of the squared per-example gradients of `module`
+    in the eigenbasis (QG, QA), i.e. mean_i (QG^T grad_i QA)^2
+
+    Conv2d per-example gradients sum the outer products of all output
+    positions. For Linear layers (and token inputs, whose rows are the
+    examples as in `ComputeA.linear`) the square of an outer product is the
+    outer product of the squares, so no per-example gradient is formed.
+    """
+    if isinstance(module, nn.Conv2d):
+        a = _extract_patches(a, module.kernel_size, module.stride, module.padding)
+        a = a.reshape(a.size(0), -1, a.size(-1))
+        g = g.permute(0, 2, 3, 1).reshape(g.size(0), -1, g.size(1))
+    else:
+        a = a.reshape(-1, 1, a.size(-1))
+        g = g.reshape(-1, 1, g.size(-1))
+    if module.bias is not None:
+        a = torch.cat([a, a.new_ones(*a.shape[:2], 1)], 2)
+    batch_size = a.size(0)
+    if batch_averaged:
+        g = g * batch_size
+    u = g @ QG
+    v = a @ QA
+    if u.size(1) == 1:
+        return (u[:, 0] ** 2).t() @ (v[:, 0] ** 2) / batch_size
+    return (torch.einsum('ntp,ntq->npq', u, v) ** 2).mean(0)
+
+
+class EKFAC(KFAC):
+    """Eigenvalue-corrected KFAC (George et al., 2018)
+
+    Preconditions in the eigenbasis (QG, QA) of the Kronecker factors like
+    `KFAC`, but divides by a running average `m_S` of the squared
+    per-example gradients projected into that basis instead of the
+    Kronecker product of the eigenvalues dG dA^T. `m_S` is updated with
+    every factor update (every `fac_update_freq` steps) from the layer
+    inputs and output gradients saved by the hooks, and re-estimated from
+    scratch whenever the eigenbasis of a layer is refreshed. The eigenbasis
+    is still refreshed every `kfac_update_freq` steps.
+
+    Takes the same arguments as `KFAC`. Requires `precondition_mode='eigen'`
+    and does not support `streaming_factors`, `async_eigen`, `low_rank`,
+    `diag_blocks > 1` or `gradient_clip='KNormal'`.
+    """
+    def __init__(self, model, *args, **kwargs):
+        options = inspect.signature(KFAC.__init__).bind(self, model, *args, **kwargs)
+        options.apply_defaults()
+        options = options.arguments
+        if options['precondition_mode'] != "eigen":
+            raise ValueError("EKFAC requires precondition_mode=eigen")
+        for name in ('streaming_factors', 'async_eigen', 'low_rank'):
+            if options[name]:
+                raise ValueError("EKFAC does not support {}".format(name))
+        diag_blocks = options['diag_blocks']
+        if any(count != 1 for count in (diag_blocks.values()
+                                        if isinstance(diag_blocks, dict) else [diag_blocks])):
+            raise ValueError("EKFAC does not support diag_blocks > 1")
+        if options['gradient_clip'] == "KNormal":
+            raise ValueError("EKFAC does not support gradient_clip=KNormal")
+        super(EKFAC, self).__init__(model, *args, **kwargs)
+        # running average of the squared projected per-example gradients
+        self.m_S = {}
+
+    def _prepare_precondition(self):
+        """Update `m_S` of all modules with the statistics of this step
+
+        The scales of all modules are averaged across ranks with one bucketed
+        allreduce, like the factors, before any gradient is preconditioned.
+        """
+        scales = {}
+        for module in self.modules:
+            refreshed = self.m_refresh_step.get(module) == self.steps
+            if not self._hook_handles or module not in self.m_g:
+                # no statistics this step, start from the K-FAC scale on refresh
+                if refreshed or module not in self.m_S:
+                    self.m_S[module] = torch.outer(self.m_dG[module], self.m_dA[module])
+                continue
+            self._fetch(module)
+            with self.profiler.span('ekfac_scale', self.module_names[module]):
+                with torch.no_grad():
+                    scales[module] = _projected_grad_sq(
+                            module, self.m_a[module], self.m_g[module],
+                            self.m_QA[module], self.m_QG[module], self.batch_averaged)
+        if self.comm_size > 1:
+            self.comm.synchronize(self.comm.allreduce_async_(list(scales.values())))
+        for module, s in scales.items():
+            if self.m_refresh_step.get(module) == self.steps or module not in self.m_S:
+                self.m_S[module] = s
+            else:
+                update_running_avg(s, self.m_S[module], self.factor_decay)
+
+    def _save_module_state(self, module, state):
+        if module in self.m_S:
+            state['S'] = self.m_S[module]
+
+    def _load_module_state(self, module, state):
+        if 'S' in state:
+            self.m_S[module] = state['S'].to(self.m_dA[module])
+        else:
+            self.m_S.pop(module, None)
+
+    def _get_preconditioned_grad(self, module, grad):
+        """Precondition `grad` with the eigenbasis and the scale `m_S` of this
+        step, see `_prepare_precondition`"""
+        v1 = self.m_QG[module].t() @ grad @ self.m_QA[module]
+        v2 = v1 / (self.m_S[module] + self.damping)
+        v = self.m_QG[module] @ v2 @ self.m_QA[module].t()
+
+        if module.bias is not None:
+            v = [v[:, :-1], v[:, -1:]]
+            v[0] = v[0].view(module.weight.grad.data.size()) # weight
+            v[1] = v[1].view(module.bias.grad.data.size())   # bias
+        else:
+            v = [v.view(module.weight.grad.data.size())]
+        return v
@@ -1,13 +1,26 @@
+import functools
 import math
+import time
+import types
 import torch
 import torch.optim as optim
-# import horovod.torch as hvd
-
+from concurrent.futures import ThreadPoolExecutor
+
+from kfac.comm import get_comm
+from kfac.offload import FactorOffload
+from kfac.profiler import KFACProfiler
+from kfac.profiler import (covariance_flops, eigh_flops, inverse_flops,
+                           newton_flops, precondition_flops, randomized_eigh_flops)
+from kfac.storage import FactorStorage
 from kfac.utils import (ComputeA, ComputeG)
 from kfac.utils import update_running_avg
 from kfac.utils import try_contiguous
 from kfac.utils import cycle
 from kfac.utils import get_block_boundary
+from kfac.utils import extract_blocks, block_index
+from kfac.utils import randomized_eigh, inverse_root
+from kfac.utils import RecurrentWeights, recurrent_forward
+from kfac.utils import kl_clip_scale, adaptive_clip_grads_
 from models.VoT import *
 
 class KFAC(optim.Optimizer):
@@ -15,11 +28,22 @@ class KFAC(optim.Optimizer):
 
     Computes the natural gradient of a model in place with a layer-wise
     FIM approximation. Layer computations are distributed across workers
-    using Horovod.
+    using the communication backend `comm` (see `kfac.comm`).
+
+    Linear and Conv2d layers use Kronecker factored blocks A (x) G. So do
+    the input-to-hidden and hidden-to-hidden weights of every layer of
+    unidirectional LSTM/GRU modules, with factors pooled over all timesteps
+    as if each one was a row of a Linear layer; on factor update steps
+    their output is recomputed unrolled over time to expose the gates.
+    Embedding layers use a diagonal A of token frequencies with a full G,
+    and the affine parameters of LayerNorm layers the diagonal of their
+    Fisher. These diagonal layers are updated and preconditioned on every
+    rank.
 
     Usage:
+      torch.distributed.init_process_group('gloo', ...)
+      model = torch.nn.parallel.DistributedDataParallel(model)
       optimizer = optim.SGD(model.parameters(), ...)
-      optimizer = hvd.DistributedOptimizer(optimizer, ...)
       preconditioner = KFAC(model, ...)
       ... 
       for i, (data, target) in enumerate(train_loader):
@@ -27,10 +51,8 @@ class KFAC(optim.Optimizer):
           output = model(data)
           loss = criterion(output, target)
           loss.backward()
-          optimizer.synchronize()
           preconditioner.step()
-          with optimizer.skip_synchronize():
-              optimizer.step()
+          optimizer.step()
 
     Args:
       model (nn): Torch model to precondition
@@ -46,17 +68,139 @@ class KFAC(optim.Optimizer):
           preconditioning (default: 100)
       batch_averaged (bool, optional): boolean representing if the gradient
           is alrady averaged across the batches (default: True)
-      diag_blocks (int, optional): Experimental: number of diagonal blocks to
-          approximate the Kronecker factor eigendecomposition with. 
-          `diag_blocks=1` computes the eigendecomposition of the entire factor
-          (default: 1)
+      diag_blocks (int or dict, optional): Experimental: number of diagonal
+          blocks to approximate the Kronecker factors of Conv2d layers with.
+          A dict sets the count per layer name or type, e.g. `{'Conv2d': 4,
+          'Linear': 2, 'head.fc': 8}`, names taking precedence. With k > 1 blocks only the k diagonal blocks of A
+          and G are stored (as a (k, b, b) stack), each block is decomposed
+          or inverted on its own, at 1/k^2 of the cost of the full factor, and
+          the gradient is preconditioned with batched block matmuls.
+          `diag_blocks=1` keeps the entire factor (default: 1)
       diag_warmup (int, optional): number of epochs to wait before starting
           the block diagonal factor approximation (default: 0)
       distribute_layer_factors (bool, optional): if `True`, computes factors A
           and G on different workers else computes A and G for a single layer
           on the same worker. If `None`, determines best value based on layer
           count (default: None)
+      batched_eigen (bool, optional): if `True`, factors that are not block
+          diagonalized are grouped by shape and each group is eigendecomposed
+          with a single batched `torch.linalg.eigh` call during the refresh.
+          Else every factor is decomposed on its own (default: True)
+      precondition_mode (str, optional): `'eigen'` preconditions with the
+          eigendecompositions of A and G. `'inverse'` instead builds the
+          damped inverses (A + sqrt(damping)I)^-1 and (G + sqrt(damping)I)^-1
+          with a Cholesky factorization at refresh time so preconditioning
+          a layer only needs two matmuls. `'newton'` builds the damped inverse
+          roots (A + sqrt(damping)I)^(-1/newton_p) and
+          (G + sqrt(damping)I)^(-1/newton_p) with coupled Newton iterations,
+          using matmuls only (default: 'eigen')
+      newton_p (int, optional): with `precondition_mode='newton'`, root of the
+          damped factors. 1 is K-FAC, 4 the Shampoo preconditioner
+          G^(-1/4) grad A^(-1/4). With p = 1 the previous inverse warm-starts
+          the iteration (default: 1)
+      newton_iters (int, optional): maximum Newton iterations per refresh
+          (default: 40)
+      newton_tol (float, optional): Newton convergence tolerance, see
+          `kfac.utils.inverse_root` (default: 1e-4)
+      factored_damping (bool, optional): only used with
+          `precondition_mode='inverse'` or `'newton'`. If `True`, sqrt(damping) is split
+          between A and G with the factored Tikhonov ratio
+          pi = sqrt((tr(A)/dim(A)) / (tr(G)/dim(G))) (default: False)
+      num_workers (int, optional): number of threads used to compute the
+          per-module factors and eigendecompositions/inverses in parallel.
+          Modules are dealt to the workers round-robin in registration order,
+          so every worker always computes the same modules and results match
+          the serial path (default: 1)
+      threads_per_worker (int, optional): intra-op threads of each worker
+          set with `torch.set_num_threads`. If `None`, the current thread
+          count is split evenly between the workers (default: None)
+      comm (kfac.comm.Comm, optional): communication backend used to
+          allreduce the factors and to share the eigendecompositions that
+          each rank computed. If `None`, uses `TorchDistributedComm` when
+          torch.distributed is initialized, else the single process `Comm`
+          (default: None)
+      streaming_factors (bool, optional): if `True`, the hooks reduce each
+          layer input/output gradient to its covariance right away and add it
+          to a running sum, instead of keeping the tensor alive until
+          `step()`. All forward/backward passes between two factor updates
+          (e.g. micro-batches) then contribute to the factors, which are the
+          mean of the accumulated covariances. Else only the last pass is
+          used (default: False)
+      patch_budget_mb (float, optional): memory budget of the conv patch
+          matrix used to compute factor A of Conv2d layers. If set, a^T a is
+          accumulated over tiles of samples and output positions that fit the
+          budget instead of unfolding the whole batch at once (default: None)
+      patch_subsample (float, optional): fraction of the conv output
+          positions randomly sampled to estimate factor A of Conv2d layers.
+          `None` uses all positions (default: None)
+      packed_factors (bool, optional): store factors A and G as the packed
+          upper triangle of the symmetric matrix (default: False)
+      factor_dtype (torch.dtype, optional): storage dtype of the running
+          averages of A and G, e.g. `torch.bfloat16`. Eigendecompositions and
+          inverses are still computed in float32. If `None`, factors are kept
+          in the dtype they are computed in (default: None)
+      async_eigen (bool, optional): if `True`, the eigen refresh runs on a
+          background thread on a snapshot of the factors while the following
+          steps keep preconditioning with the previous (stale) eigenbasis.
+          The new basis is swapped in at the start of the first step after it
+          is ready. Requires `precondition_mode='eigen'` (default: False)
+      max_staleness (int, optional): with `async_eigen`, number of steps a
+          refresh may run in the background before `step()` waits for it.
+          In distributed runs the basis is always swapped exactly
+          `max_staleness` steps after the refresh started, so that all ranks
+          allgather the results at the same step. If `None`, uses
+          `kfac_update_freq` (default: None)
+      refresh_drift (float, optional): if set, every `kfac_update_freq`
+          steps only the layers whose factor A or G drifted by more than
+          this relative Frobenius norm ||F - F_last|| / ||F_last|| since their
+          last eigendecomposition/inverse are refreshed. Else all layers are
+          refreshed (default: None)
+      max_refresh_age (int, optional): with `refresh_drift`, a layer is
+          refreshed regardless of its drift once its last refresh is this
+          many steps old (default: None)
+      profile (bool, optional): record the wall time and the memory and
+          FLOP estimates of every phase and module in `self.profiler`, see
+          `kfac.profiler.KFACProfiler` (default: False)
+      low_rank (int, optional): with `precondition_mode='eigen'`, factors of
+          at least `low_rank_min_dim` rows only keep their `low_rank` leading
+          eigenpairs, found with a randomized range finder. The rest of the
+          spectrum is replaced by its mean, so the orthogonal complement is
+          preconditioned as a damped isotropic remainder. If `None`, all
+          factors are fully decomposed (default: None)
+      low_rank_oversample (int, optional): extra random vectors of the range
+          finder (default: 10)
+      low_rank_iters (int, optional): subspace (power) iterations of the
+          range finder (default: 2)
+      low_rank_min_dim (int, optional): smallest factor size that uses the
+          low-rank eigendecomposition (default: 1024)
+      exclude_modules (list, optional): names of layers (as in
+          `model.named_modules()`) that are not preconditioned and keep their
+          gradient (default: None)
+      module_update_freq (dict, optional): iterations between the
+          eigendecomposition/inverse refreshes of the named layers, instead
+          of `kfac_update_freq`. See `kfac.planner.plan_kfac` (default: None)
+      offload (str, optional): storage tier of the factors and
+          eigendecompositions/inverses of the offloaded layers. `'cpu'` keeps
+          them in pinned host memory, `'memmap'` in `numpy.memmap` files under
+          `offload_dir`. A layer is brought to the compute device only for its
+          factor update, refresh and preconditioning while the next layer is
+          prefetched in the background, and the least recently used layers
+          are evicted beyond `offload_resident_mb`. Refreshes are then not
+          batched across layers. Requires a single process, `num_workers=1`
+          and no `async_eigen`. If `None`, everything stays on the device
+          (default: None)
+      offload_dir (str, optional): directory of the memmap files. If `None`,
+          a temporary directory is used (default: None)
+      offload_resident_mb (float, optional): memory budget in MB of the
+          offloaded layers kept resident. The layer in use is always
+          resident (default: 0)
+      offload_modules (list, optional): names of the layers to offload. If
+          `None`, all layers are offloaded (default: None)
     """
+
+    # layer types preconditioned by KFAC, see `find_layers`
+    known_modules = {'Linear', 'Conv2d', 'Embedding', 'LayerNorm', 'LSTM', 'GRU'}
+
     def __init__(self,
                  model,
                  lr=0.1,
@@ -69,7 +213,36 @@ class KFAC(optim.Optimizer):
                  diag_blocks=1,
                  diag_warmup=0,
                  distribute_layer_factors=None,
-                 gradient_clip = "agc"):
+                 gradient_clip = "agc",
+                 batched_eigen=True,
+                 precondition_mode="eigen",
+                 factored_damping=False,
+                 newton_p=1,
+                 newton_iters=40,
+                 newton_tol=1e-4,
+                 num_workers=1,
+                 threads_per_worker=None,
+                 comm=None,
+                 streaming_factors=False,
+                 patch_budget_mb=None,
+                 patch_subsample=None,
+                 packed_factors=False,
+                 factor_dtype=None,
+                 async_eigen=False,
+                 max_staleness=None,
+                 refresh_drift=None,
+                 max_refresh_age=None,
+                 profile=False,
+                 low_rank=None,
+                 low_rank_oversample=10,
+                 low_rank_iters=2,
+                 low_rank_min_dim=1024,
+                 exclude_modules=None,
+                 module_update_freq=None,
+                 offload=None,
+                 offload_dir=None,
+                 offload_resident_mb=0.,
+                 offload_modules=None):
 
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -85,12 +258,54 @@ class KFAC(optim.Optimizer):
             raise ValueError("Invalid K-FAC update frequency: {}".format(kfac_update_freq))
         if not 0 == kfac_update_freq % fac_update_freq:
             print("WARNING: it is suggested that kfac_update_freq be a multiple of fac_update_freq")
-        if not 0 < diag_blocks:
-            raise ValueError("Invalid diagonal block approx count: {}".format(diag_blocks))
-        if not 0 <= diag_blocks:
-            raise ValueError("Invalid diagonal block approx count: {}".format(diag_blocks))
-        if not 1 == diag_blocks:
+        block_counts = list(diag_blocks.values()) if isinstance(diag_blocks, dict) \
+                                                    else [diag_blocks]
+        for count in block_counts:
+            if not 0 < count:
+                raise ValueError("Invalid diagonal block approx count: {}".format(count))
+        if any(count != 1 for count in block_counts):
             print("WARNING: diag_blocks > 1 is experimental and may give poor results.")
+        if any(count != 1 for count in block_counts) and gradient_clip == "KNormal":
+            raise ValueError("gradient_clip=KNormal does not support diag_blocks > 1")
+        if precondition_mode not in ("eigen", "inverse", "newton"):
+            raise ValueError("Invalid preconditioning mode: {}".format(precondition_mode))
+        if precondition_mode != "eigen" and gradient_clip == "KNormal":
+            raise ValueError("gradient_clip=KNormal requires precondition_mode=eigen")
+        if not (isinstance(newton_p, int) and 0 < newton_p):
+            raise ValueError("Invalid Newton root: {}".format(newton_p))
+        if not 0 < newton_iters:
+            raise ValueError("Invalid Newton iterations: {}".format(newton_iters))
+        if not 0.0 < newton_tol:
+            raise ValueError("Invalid Newton tolerance: {}".format(newton_tol))
+        if not 0 < num_workers:
+            raise ValueError("Invalid number of workers: {}".format(num_workers))
+        if patch_budget_mb is not None and not 0 < patch_budget_mb:
+            raise ValueError("Invalid patch memory budget: {}".format(patch_budget_mb))
+        if patch_subsample is not None and not 0 < patch_subsample <= 1:
+            raise ValueError("Invalid patch subsample fraction: {}".format(patch_subsample))
+        if async_eigen and precondition_mode != "eigen":
+            raise ValueError("async_eigen requires precondition_mode=eigen")
+        if max_staleness is not None and not 0 <= max_staleness:
+            raise ValueError("Invalid maximum staleness: {}".format(max_staleness))
+        if refresh_drift is not None and not 0.0 <= refresh_drift:
+            raise ValueError("Invalid refresh drift threshold: {}".format(refresh_drift))
+        if max_refresh_age is not None and not 0 < max_refresh_age:
+            raise ValueError("Invalid maximum refresh age: {}".format(max_refresh_age))
+        if low_rank is not None and not 0 < low_rank:
+            raise ValueError("Invalid low rank: {}".format(low_rank))
+        if low_rank is not None and gradient_clip == "KNormal":
+            raise ValueError("gradient_clip=KNormal does not support low_rank")
+        if precondition_mode != "eigen" and low_rank is not None:
+            print("WARNING: low_rank is ignored with precondition_mode={}".format(precondition_mode))
+        for freq in (module_update_freq or {}).values():
+            if not 0 < freq:
+                raise ValueError("Invalid module update frequency: {}".format(freq))
+        if offload not in (None, "cpu", "memmap"):
+            raise ValueError("Invalid offload tier: {}".format(offload))
+        if offload is not None and not 0 <= offload_resident_mb:
+            raise ValueError("Invalid offload resident budget: {}".format(offload_resident_mb))
+        if offload is not None and (async_eigen or num_workers > 1):
+            raise ValueError("offload does not support async_eigen or num_workers > 1")
 
         # For compatibility with `KFACParamScheduler`
         #   defaults – (dict): a dict containing default values of optimization options (used when a parameter group doesn’t specify them).
@@ -103,10 +318,20 @@ class KFAC(optim.Optimizer):
 
         super(KFAC, self).__init__(model.parameters(), defaults)
 
-        self.computeA = ComputeA()
+        patch_budget = None if patch_budget_mb is None \
+                            else int(patch_budget_mb * 1024 * 1024)
+        self.computeA = ComputeA(patch_budget=patch_budget,
+                                 patch_subsample=patch_subsample)
         self.computeG = ComputeG()
-        self.known_modules = {'Linear', 'Conv2d','BertLayerNorm0'}
+        # Kronecker factored layers, incl. the `RecurrentWeights` of LSTM/GRU layers
         self.modules = []
+        # Embedding and LayerNorm layers, preconditioned with diagonal factors
+        self.diag_modules = []
+        # `RecurrentWeights` of each LSTM/GRU keyed by (layer, kind)
+        self.recurrent_modules = {}
+        self.module_names = {}
+        self.exclude_modules = set(exclude_modules or [])
+        self.module_update_freq = dict(module_update_freq or {})
         self._register_modules(model)
 
         self.steps = 0
@@ -115,9 +340,20 @@ class KFAC(optim.Optimizer):
         # Dictionaries keyed by `module` to storing the factors and
         # eigendecompositions
         self.m_a, self.m_g = {}, {}
+        # number of covariances summed in `m_a`/`m_g` with `streaming_factors`
+        self.m_a_count, self.m_g_count = {}, {}
         self.m_A, self.m_G = {}, {}
         self.m_QA, self.m_QG = {}, {}
         self.m_dA, self.m_dG = {}, {}
+        self.m_iA, self.m_iG = {}, {}
+        # number of diagonal blocks of the factor layout of each module
+        self.m_blocks = {}
+        # mean eigenvalue outside the leading eigenpairs of low-rank factors
+        self.m_rA, self.m_rG = {}, {}
+        # diagonal factors of `diag_modules`: the token frequencies (A) of
+        # Embedding layers, whose G is kept in `m_G`, and the diagonal
+        # Fisher of the LayerNorm weight and bias
+        self.m_D = {}
 
         self.factor_decay = factor_decay
         self.kl_clip = kl_clip
@@ -126,20 +362,97 @@ class KFAC(optim.Optimizer):
         self.diag_blocks = diag_blocks
         self.diag_warmup = diag_warmup
         self.batch_averaged = batch_averaged
-        self.hvd_size = 1   #hvd.size()
+        self.batched_eigen = batched_eigen
+        self.low_rank = low_rank
+        self.low_rank_oversample = low_rank_oversample
+        self.low_rank_iters = low_rank_iters
+        self.low_rank_min_dim = low_rank_min_dim
+        self.factor_storage = FactorStorage(packed=packed_factors, dtype=factor_dtype)
+        self.streaming_factors = streaming_factors
+        self.precondition_mode = precondition_mode
+        self.factored_damping = factored_damping
+        self.newton_p = newton_p
+        self.newton_iters = newton_iters
+        self.newton_tol = newton_tol
+        # Newton refreshes (one per bucket of equally shaped factors), their
+        # iterations and the buckets warm-started from the previous roots
+        self.newton_stats = dict(solves=0, iterations=0, warm=0)
+        self.comm = get_comm() if comm is None else comm
+        self.comm_size = self.comm.size()
+        self.rank = self.comm.rank()
+        if offload is not None and self.comm_size > 1:
+            raise ValueError("offload requires a single process")
         
         # Compute ideal value for `distribute_layer_factors` based on
         # registered module count
         if distribute_layer_factors is None:
             self.distribute_layer_factors = True \
-                    if hvd.size() > len(self.modules) else False
+                    if self.comm_size > len(self.modules) else False
         else:
             self.distribute_layer_factors = distribute_layer_factors
 
         self.have_cleared_Q = True if self.diag_warmup == 0 else False
+        initial_blocks = self.diag_blocks if self.diag_warmup == 0 else 1
+        for module in self.modules:
+            self.m_blocks[module] = self._get_diag_blocks(module, initial_blocks)
         self.eps = 1e-10  # for numerical stability
-        self.rank_iter = cycle(list(range(self.hvd_size)))
+        self.rank_iter = cycle(list(range(self.comm_size)))
         self.T_all = 0
+
+        self.num_workers = num_workers
+        if num_workers > 1:
+            if threads_per_worker is None:
+                threads_per_worker = max(1, torch.get_num_threads() // num_workers)
+            self.executor = ThreadPoolExecutor(max_workers=num_workers,
+                                               initializer=torch.set_num_threads,
+                                               initargs=(threads_per_worker,))
+        else:
+            self.executor = None
+
+        # Eigendecompositions queued during a refresh, keyed by
+        # (shape, dtype, device). `None` outside of a batched refresh.
+        self._eigen_buckets = None
+        # (owner rank, tensors) computed during a distributed refresh
+        self._gather_parts = None
+
+        self.async_eigen = async_eigen
+        self.max_staleness = max_staleness
+        self._refresh_executor = ThreadPoolExecutor(max_workers=1) \
+                if async_eigen else None
+        # (future, start step) of the async refresh in flight
+        self._refresh = None
+        # `False` until an async refresh swapped in a basis, and after `_clear_eigen()`
+        self._have_basis = False
+        # async refreshes started, steps that waited for one and seconds waited
+        self.refresh_stats = dict(refreshes=0, waits=0, wait_time=0.)
+
+        self.refresh_drift = refresh_drift
+        self.max_refresh_age = max_refresh_age
+        # factors at the last refresh of each layer, kept for `refresh_drift`
+        self.m_A_last, self.m_G_last = {}, {}
+        # step of the last refresh and number of refreshes of each layer
+        self.m_refresh_step = {}
+        self.refresh_counts = {}
+
+        self.profiler = KFACProfiler(enabled=profile)
+        # numel of the last output gradient of each layer, used by the profiler
+        self._output_numel = {}
+
+        self.offload = None
+        if offload is not None:
+            names = {name: module for module, name in self.module_names.items()}
+            for name in set(offload_modules or []) - set(names):
+                print("WARNING: offload module {} is not preconditioned".format(name))
+            selected = None if offload_modules is None else \
+                    [names[name] for name in offload_modules if name in names]
+            self.offload = FactorOffload(self, offload, offload_dir,
+                                         offload_resident_mb, selected)
+        # next module of `self.modules`, prefetched while one is processed
+        self._next_module = dict(zip(self.modules, self.modules[1:]))
+
+        # handles of the hooks, attached while the next step updates the factors
+        self._hook_handles = []
+        self._set_hooks(True)
     
     def dump(self,nEpoch,log_writer):
         # info = "@"
@@ -149,6 +462,9 @@ class KFAC(optim.Optimizer):
         if log_writer:
             log_writer.add_scalar('KFAC/nu', self.nu,nEpoch)
             log_writer.add_scalar('KFAC/lr', self.lr,nEpoch)
+            if self.async_eigen:
+                log_writer.add_scalar('KFAC/refresh_waits', self.refresh_stats['waits'], nEpoch)
+                log_writer.add_scalar('KFAC/refresh_wait_time', self.refresh_stats['wait_time'], nEpoch)
             # log_writer.add_scalar('KFAC/damping', params['damping'],nEpoch)                                 #0.003
             # log_writer.add_scalar('KFAC/fac_update_freq', params['fac_update_freq'],nEpoch)               #1
             # log_writer.add_scalar('KFAC/kfac_update_freq', params['kfac_update_freq'],nEpoch)             #10
@@ -158,36 +474,505 @@ class KFAC(optim.Optimizer):
             # log_writer.add_scalar('KFAC/G_norm', self.G_norm,nEpoch)
         return info
 
-    def _save_input(self, module, input):
-        """Hook for saving layer input"""
-        if torch.is_grad_enabled() and self.steps % self.fac_update_freq == 0:
+    def dump_epoch(self, nEpoch, log_writer):
+        """Log the statistics aggregated over an epoch, once at its end
+
+        The refreshes of the eigen/inverse decompositions are logged as their
+        total over all layers and a histogram of the count of each layer. The
+        profiler is flushed and reset, so its totals are those of the epoch.
+        """
+        if not log_writer:
+            return
+        counts = [self.refresh_counts.get(module, 0) for module in self.modules]
+        log_writer.add_scalar('KFAC/refreshes', sum(counts), nEpoch)
+        if counts:
+            log_writer.add_histogram('KFAC/refreshes_per_layer', torch.tensor(counts), nEpoch)
+        if self.profiler.enabled:
+            self.profiler.write(log_writer, nEpoch)
+            self.profiler.reset()
+
+    def factor_memory_report(self):
+        """Bytes used by factors A and G of every layer
+
+        Returns:
+          list of `(name, dense_bytes, stored_bytes)` where `dense_bytes` is
+          the size of A and G as dense float32 matrices and `stored_bytes`
+          their size in the configured `factor_storage`
+        """
+        report = []
+        for module in self.modules:
+            if module not in self.m_A:
+                continue
+            factors = (self.m_A[module], self.m_G[module])
+            report.append((self.module_names[module],
+                           sum(self.factor_storage.dense_nbytes(f) for f in factors),
+                           sum(self.factor_storage.nbytes(f) for f in factors)))
+        return report
+
+    # decompositions saved by `state_dict`, by key and dict
+    _DECOMPOSITIONS = (('QA', 'm_QA'), ('QG', 'm_QG'), ('dA', 'm_dA'), ('dG', 'm_dG'),
+                       ('rA', 'm_rA'), ('rG', 'm_rG'), ('iA', 'm_iA'), ('iG', 'm_iG'))
+
+    def state_dict(self, factors_only=False):
+        """K-FAC state keyed by the qualified module names
+
+        Holds the hyperparameters, `steps`, and per module the block layout,
+        the factors A and G (dense, in the compute dtype) and, unless
+        `factors_only`, the eigendecompositions/inverses and the refresh
+        bookkeeping. An async refresh in flight is finished first. The
+        statistics saved by the hooks between two factor updates are not
+        included. Tensors may alias the live state, save or copy them.
+
+        Args:
+          factors_only (bool, optional): leave out the decompositions, which
+              `load_state_dict` then recomputes from the factors (default: False)
+        """
+        if self._refresh is not None:
+            self._finish_async_eigen()
+        modules = {}
+        for module in self.modules:
+            state = modules[self.module_names[module]] = dict(blocks=self.m_blocks[module])
+            if module not in self.m_A:
+                continue
+            state['A'] = self.factor_storage.dense(self.m_A[module])
+            state['G'] = self.factor_storage.dense(self.m_G[module])
+            if factors_only:
+                continue
+            for key, name in self._DECOMPOSITIONS:
+                if module in getattr(self, name):
+                    state[key] = getattr(self, name)[module]
+            if module in self.m_refresh_step:
+                state['refresh_step'] = self.m_refresh_step[module]
+                state['refresh_count'] = self.refresh_counts[module]
+            if module in self.m_A_last:
+                state['A_last'] = self.m_A_last[module]
+                state['G_last'] = self.m_G_last[module]
+            self._save_module_state(module, state)
+        for module in self.diag_modules:
+            # the diagonal factor D, and G with its eigendecomposition for Embedding
+            state = modules[self.module_names[module]] = {}
+            for key, factors in (('D', self.m_D), ('G', self.m_G),
+                                 ('QG', self.m_QG), ('dG', self.m_dG)):
+                if module in factors and (key in ('D', 'G') or not factors_only):
+                    state[key] = factors[module]
+        hyperparams = {k: v for k, v in self.param_groups[0].items() if k != 'params'}
+        return dict(steps=self.steps, param_groups=[hyperparams],
+                    precondition_mode=self.precondition_mode,
+                    have_cleared_Q=self.have_cleared_Q,
+                    factors_only=factors_only, modules=modules)
+
+    def load_state_dict(self, state_dict, strict=True, warm_start=False):
+        """Load a `state_dict()`, matching the modules by qualified name
+
+        Factors are moved to the device and dtype of their module and cut to
+        its current block layout. The decompositions are loaded if they were
+        saved with the same layout and `precondition_mode`, else they are
+        recomputed from the factors, as for a `factors_only` state.
+
+        Args:
+          state_dict (dict): state from `state_dict()`
+          strict (bool, optional): raise a ValueError if the registered and
+              saved modules differ or a factor does not fit its module. Else
+              these modules are skipped with a warning (default: True)
+          warm_start (bool, optional): only load the factors of the modules
+              whose name and factor sizes match, e.g. from a different model,
+              keeping `steps` and the hyperparameters. Implies
+              `strict=False` (default: False)
+        """
+        strict = strict and not warm_start
+        names = {name: module for module, name in self.module_names.items()}
+        saved = state_dict['modules']
+        if strict and set(saved) != set(names):
+            raise ValueError("KFAC state modules differ, missing: {}, unexpected: {}".format(
+                             sorted(set(names) - set(saved)), sorted(set(saved) - set(names))))
+        if self._refresh is not None:
+            self._finish_async_eigen()
+        if not warm_start:
+            self.param_groups[0].update(state_dict['param_groups'][0])
+            self.steps = state_dict['steps']
+            self.have_cleared_Q = state_dict['have_cleared_Q']
+        same_mode = state_dict['precondition_mode'] == self.precondition_mode
+
+        recompute = []
+        for name, state in saved.items():
+            module = names.get(name)
+            if module is None:
+                print("WARNING: KFAC state of unknown module {} is ignored".format(name))
+                continue
+            if module in self.diag_modules:
+                self._load_diagonal_state(module, state, strict, warm_start)
+                continue
+            if 'A' not in state:
+                continue
+            factors = self._load_factors(module, state, strict)
+            if factors is None:
+                continue
+            A, G = factors
+            self._init_A(A, module)
+            self._init_G(G, module)
+            self.m_A[module] = self.factor_storage.pack(A)
+            self.m_G[module] = self.factor_storage.pack(G)
+            self.m_A_last.pop(module, None)
+            self.m_G_last.pop(module, None)
+            if self.offload is not None:
+                self.offload.discard(module)
+            if warm_start or not same_mode or not self._load_decomposition(module, state):
+                recompute.append(module)
+                continue
+            if 'refresh_step' in state:
+                self.m_refresh_step[module] = state['refresh_step']
+                self.refresh_counts[module] = state['refresh_count']
+            if 'A_last' in state:
+                self.m_A_last[module] = state['A_last'].to(self.m_A[module])
+                self.m_G_last[module] = state['G_last'].to(self.m_G[module])
+            self._load_module_state(module, state)
+
+        if recompute:
+            self.damping = self.param_groups[0]['damping']
+            modules = self._get_refresh_modules(recompute, due=False)
+            if self.precondition_mode != "eigen":
+                self._update_inverse(modules)
+            else:
+                self._update_eigen(self.diag_blocks, modules=modules)
+        self._have_basis = True
+        self._refresh_diagonal([m for m in self.diag_modules
+                                if m in self.m_G and m not in self.m_QG])
+        self._arm_hooks()
+
+    @staticmethod
+    def _factor_dims(module):
+        """Sizes of factors A and G of a Linear or Conv2d module"""
+        bias = 1 if module.bias is not None else 0
+        return module.weight[0].numel() + bias, module.weight.shape[0]
+
+    def _load_factors(self, module, state, strict):
+        """Saved A and G of `module` in its current block layout, on its
+        device, or `None` if they do not fit it"""
+        blocks = self.m_blocks[module]
+        factors = []
+        for factor, n in zip((state['A'], state['G']), self._factor_dims(module)):
+            if factor.dim() == 2 and factor.shape[0] == n and blocks > 1:
+                factor = extract_blocks(factor, blocks)
+            expected = extract_blocks(factor.new_zeros(n, n), blocks).shape \
+                if blocks > 1 else (n, n)
+            if tuple(factor.shape) != tuple(expected):
+                message = "KFAC factor of shape {} does not fit module {} (expected {})".format(
+                          tuple(factor.shape), self.module_names[module], tuple(expected))
+                if strict:
+                    raise ValueError(message)
+                print("WARNING: " + message)
+                return None
+            factors.append(factor.to(device=module.weight.device,
+                                     dtype=self.factor_storage.compute_dtype))
+        return factors
+
+    def _load_diagonal_state(self, module, state, strict, warm_start):
+        """Load the saved factors of a layer of `diag_modules`, recomputing
+        the eigendecomposition of G unless it was saved"""
+        if 'D' not in state:
+            return
+        weight = module.weight
+        expected = {'D': (weight.shape[0],)} if isinstance(module, torch.nn.Embedding) else \
+                   {'D': (1 if module.bias is None else 2, weight.numel())}
+        if isinstance(module, torch.nn.Embedding):
+            expected['G'] = (weight.shape[1], weight.shape[1])
+        for key, shape in expected.items():
+            if key not in state or tuple(state[key].shape) != shape:
+                message = "KFAC factor {} of shape {} does not fit module {} (expected {})".format(
+                          key, tuple(state[key].shape) if key in state else None,
+                          self.module_names[module], shape)
+                if strict:
+                    raise ValueError(message)
+                print("WARNING: " + message)
+                return
+        options = dict(device=weight.device, dtype=weight.dtype)
+        self.m_D[module] = state['D'].to(**options)
+        if 'G' not in expected:
+            return
+        self.m_G[module] = state['G'].to(**options)
+        if 'QG' in state and not warm_start:
+            self.m_QG[module] = state['QG'].to(**options)
+            self.m_dG[module] = state['dG'].to(**options)
+        else:
+            self.m_QG.pop(module, None)
+
+    def _load_decomposition(self, module, state):
+        """Copy the saved decompositions of `module` into the ones allocated
+        for its factors. Returns `False` if any is missing or differs in shape"""
+        targets = [(key, getattr(self, name)[module]) for key, name in self._DECOMPOSITIONS
+                   if module in getattr(self, name)]
+        if any(key not in state or state[key].shape != target.shape
+               for key, target in targets):
+            return False
+        for key, target in targets:
+            target.copy_(state[key])
+        return True
+
+    def _save_module_state(self, module, state):
+        """Add state of subclasses to the `state_dict()` entry of `module`"""
+
+    def _load_module_state(self, module, state):
+        """Load the state added by `_save_module_state`"""
+
+    def _prepare_precondition(self):
+        """Called by `step()` before the gradients are preconditioned"""
+
+    def _save_input(self, module, input, output):
+        """Forward hook for saving layer input and hooking the gradient
+        w.r.t output"""
+        if not torch.is_grad_enabled():
+            return
+        # the LayerNorm statistic needs the input with the output gradient
+        if self.streaming_factors and not isinstance(module, torch.nn.LayerNorm):
+            with torch.no_grad():
+                a = self.computeA(input[0].data, module, self.m_blocks.get(module, 1),
+                                  self._patch_generator())
+            self._accumulate(self.m_a, self.m_a_count, module, a)
+        else:
             self.m_a[module] = input[0].data
+        if output.requires_grad:
+            output.register_hook(functools.partial(self._save_grad_output, module))
+
+    def _save_grad_output(self, module, grad_output):
+        """Tensor hook for saving gradient w.r.t output"""
+        if self.profiler.enabled:
+            self._output_numel[module] = grad_output.numel()
+        if self.streaming_factors:
+            with torch.no_grad():
+                if isinstance(module, torch.nn.LayerNorm):
+                    g = self.computeG.layer_norm(
+                            grad_output.data, module, self.batch_averaged,
+                            self.computeA(self.m_a.pop(module), module))
+                else:
+                    g = self.computeG(grad_output.data, module, self.batch_averaged,
+                                      self.m_blocks.get(module, 1))
+            self._accumulate(self.m_g, self.m_g_count, module, g)
+        else:
+            self.m_g[module] = grad_output.data
 
-    def _save_grad_output(self, module, grad_input, grad_output):
-        """Hook for saving gradient w.r.t output"""
-        if self.steps % self.fac_update_freq == 0:
-            self.m_g[module] = grad_output[0].data
+    def _save_recurrent_input(self, module, input, output):
+        """Forward hook of LSTM/GRU layers
 
-    def _register_modules(self, model):
-        """Register hooks to all supported layers in the model"""
-        for module in model.modules():
+        The fused op hides the per-timestep inputs and gates, so the output
+        is recomputed unrolled over time by `recurrent_forward`, which hands
+        the inputs and gate pre-activations of every layer to `_save_input`
+        of its `RecurrentWeights`, and replaces the output of the layer.
+        """
+        if not torch.is_grad_enabled():
+            return
+        if isinstance(input[0], torch.nn.utils.rnn.PackedSequence):
+            raise ValueError("KFAC does not support PackedSequence inputs of {}".format(
+                             module.__class__.__name__))
+        weights = self.recurrent_modules[module]
+
+        def save(layer, kind, a, z):
+            if (layer, kind) in weights:
+                self._save_input(weights[(layer, kind)], (a,), z)
+
+        hx = input[1] if len(input) > 1 else None
+        return recurrent_forward(module, input[0], hx, save)
+
+    def _set_hooks(self, active):
+        """Attach the hooks gathering the factor statistics, or remove them
+
+        The hooks are only attached for the forward/backward passes of the
+        steps that update the factors, so the other steps run without any
+        per-layer hook.
+        """
+        if active == bool(self._hook_handles):
+            return
+        if active:
+            self._hook_handles = [module.register_forward_hook(self._save_input)
+                                  for module in self.modules + self.diag_modules
+                                  if not isinstance(module, RecurrentWeights)]
+            self._hook_handles += [module.register_forward_hook(self._save_recurrent_input)
+                                   for module in self.recurrent_modules]
+        else:
+            for handle in self._hook_handles:
+                handle.remove()
+            self._hook_handles = []
+
+    def _arm_hooks(self):
+        """Attach the hooks if the next step updates the factors under the
+        current `fac_update_freq` of the param group, see `_factor_step`"""
+        self._set_hooks(self.steps % self.param_groups[0]['fac_update_freq'] == 0)
+
+    def _factor_step(self):
+        """Whether this step updates the factors
+
+        Decided from the `fac_update_freq` of this step, the value `step()`
+        read from the param group. The hooks were armed for it by
+        `_arm_hooks` at the end of the last step, or again by
+        `KFACParamScheduler.step()` if it changed the frequency. If the
+        frequency was changed in the param group directly, the step may have
+        no statistics and skips the update, or have statistics it no longer
+        needs, which are dropped.
+        """
+        update = self.steps % self.fac_update_freq == 0
+        if update and not self._hook_handles:
+            print("WARNING: fac_update_freq changed after the hooks were armed, "
+                  "no factor statistics at step {}".format(self.steps))
+            return False
+        if not update and self._hook_handles:
+            for stats in (self.m_a, self.m_g, self.m_a_count, self.m_g_count):
+                stats.clear()
+        return update
+
+    def _accumulate(self, sums, counts, module, factor):
+        """Add `factor` to the running sum of `module` in `sums`"""
+        if module in sums:
+            sums[module].add_(factor)
+            counts[module] += 1
+        else:
+            sums[module] = factor
+            counts[module] = 1
+
+    def _pop_accumulated(self, sums, counts, module):
+        """Mean of the covariances accumulated for `module`, resetting the sum"""
+        return sums.pop(module).div_(counts.pop(module))
+
+    @classmethod
+    def find_layers(cls, model, exclude_modules=()):
+        """Layers of `model` that `KFAC` preconditions, see `_register_modules`
+
+        The layers of a type in `known_modules` and not named in
+        `exclude_modules` are found. Every layer of an LSTM/GRU gives its
+        `'ih'` and `'hh'` weights as two `RecurrentWeights`, named like the
+        weights, e.g. `rnn.weight_hh_l0`. Embedding layers sharing their
+        weight with another preconditioned layer (tied weights) are left out.
+
+        Returns:
+          (modules, diag_modules, recurrent_modules, module_names, names):
+          the Kronecker factored and the diagonal layers, the
+          `RecurrentWeights` of each LSTM/GRU keyed by (layer, kind), the
+          name of every layer and the set of all names in `model`
+        """
+        modules, diag_modules, recurrent_modules, module_names = [], [], {}, {}
+        names = set()
+        for name, module in model.named_modules():
+            names.add(name)
             classname = module.__class__.__name__
-            if classname in self.known_modules:
-                self.modules.append(module)
-                module.register_forward_pre_hook(self._save_input)
-                module.register_backward_hook(self._save_grad_output)
+            if classname not in cls.known_modules or name in exclude_modules:
+                continue
+            if classname in ('LSTM', 'GRU'):
+                if module.bidirectional or getattr(module, 'proj_size', 0):
+                    print("WARNING: KFAC does not support bidirectional or projected "
+                          "recurrent layer {}".format(name))
+                    continue
+                weights = {}
+                for layer in range(module.num_layers):
+                    for kind in ('ih', 'hh'):
+                        weight_name = '{}.weight_{}_l{}'.format(name, kind, layer)
+                        names.add(weight_name)
+                        if weight_name in exclude_modules:
+                            continue
+                        weights[(layer, kind)] = RecurrentWeights(module, layer, kind)
+                        modules.append(weights[(layer, kind)])
+                        module_names[weights[(layer, kind)]] = weight_name
+                recurrent_modules[module] = weights
+            elif classname in ('Embedding', 'LayerNorm'):
+                if module.weight is None:
+                    continue
+                if classname == 'Embedding' and module.sparse:
+                    print("WARNING: KFAC does not support sparse Embedding {}".format(name))
+                    continue
+                diag_modules.append(module)
+                module_names[module] = name
+            else:
+                modules.append(module)
+                module_names[module] = name
+        weights = {id(module.weight) for module in modules}
+        for module in list(diag_modules):
+            if id(module.weight) in weights:
+                print("WARNING: KFAC does not precondition {}, its weight is tied "
+                      "to another layer".format(module_names[module]))
+                diag_modules.remove(module)
+                del module_names[module]
+        return modules, diag_modules, recurrent_modules, module_names, names
+
+    def _register_modules(self, model):
+        """Register all supported layers in the model, see `find_layers` and
+        `_set_hooks`"""
+        self.modules, self.diag_modules, self.recurrent_modules, self.module_names, names = \
+            self.find_layers(model, self.exclude_modules)
+        for name in (self.exclude_modules | set(self.module_update_freq)) - names:
+            print("WARNING: KFAC found no layer named {}".format(name))
+
+    def _eigen_rank(self, factor):
+        """Number of eigenpairs kept for `factor`"""
+        n = factor.shape[0]
+        if self.low_rank is None or n < self.low_rank_min_dim:
+            return n
+        return min(n, self.low_rank)
 
     def _init_A(self, factor, module):
-        """Initialize memory for factor A and its eigendecomp"""
-        self.m_A[module] = torch.diag(factor.new(factor.shape[0]).fill_(1))
-        self.m_dA[module] = factor.new_zeros(factor.shape[0])
-        self.m_QA[module] = factor.new_zeros(factor.shape)
+        """Initialize memory for factor A and its eigendecomp or inverse"""
+        self.m_A[module] = self.factor_storage.eye(factor)
+        self._init_decomposition(factor, module, self.m_iA, self.m_QA,
+                                 self.m_dA, self.m_rA)
 
     def _init_G(self, factor, module):
-        """Initialize memory for factor G and its eigendecomp"""
-        self.m_G[module] = torch.diag(factor.new(factor.shape[0]).fill_(1))
-        self.m_dG[module] = factor.new_zeros(factor.shape[0])
-        self.m_QG[module] = factor.new_zeros(factor.shape)
+        """Initialize memory for factor G and its eigendecomp or inverse"""
+        self.m_G[module] = self.factor_storage.eye(factor)
+        self._init_decomposition(factor, module, self.m_iG, self.m_QG,
+                                 self.m_dG, self.m_rG)
+
+    def _init_decomposition(self, factor, module, inverses, evectors, evalues,
+                            remainders):
+        """Allocate the inverse or eigendecomposition of `module` in the
+        layout of `factor`. Block diagonal factors are never low-rank."""
+        remainders.pop(module, None)
+        if self.precondition_mode != "eigen":
+            inverses[module] = factor.new_zeros(factor.shape)
+        elif factor.dim() == 3:
+            evalues[module] = factor.new_zeros(factor.shape[:2])
+            evectors[module] = factor.new_zeros(factor.shape)
+        else:
+            k = self._eigen_rank(factor)
+            evalues[module] = factor.new_zeros(k)
+            evectors[module] = factor.new_zeros(factor.shape[0], k)
+            if k < factor.shape[0]:
+                remainders[module] = factor.new_zeros(())
+
+    def _set_diag_blocks(self, diag_blocks):
+        """Switch the modules whose block count changed to the new layout
+
+        Happens at the end of `diag_warmup`. The factors (and the streamed
+        covariance sums) are cut to their diagonal blocks and the
+        eigendecompositions/inverses are reallocated, so the converted
+        modules must be refreshed right away. An async refresh in flight is
+        finished first as its results have the old layout.
+
+        Returns:
+          list of converted modules that have factors
+        """
+        changed = [module for module in self.modules
+                   if self._get_diag_blocks(module, diag_blocks) != self.m_blocks[module]]
+        if not changed:
+            return []
+        if self._refresh is not None:
+            self._finish_async_eigen()
+
+        converted = []
+        for module in changed:
+            blocks = self._get_diag_blocks(module, diag_blocks)
+            if self.m_blocks[module] > 1:
+                raise ValueError("Block diagonal factors cannot be merged back")
+            self.m_blocks[module] = blocks
+            for sums in (self.m_a, self.m_g):
+                if self.streaming_factors and module in sums:
+                    sums[module] = extract_blocks(sums[module], blocks)
+            self.m_A_last.pop(module, None)
+            self.m_G_last.pop(module, None)
+            if module not in self.m_A:
+                continue
+            self._fetch(module)
+            for factors, init in ((self.m_A, self._init_A), (self.m_G, self._init_G)):
+                factor = extract_blocks(self.factor_storage.dense(factors[module]), blocks)
+                init(factor, module)
+                factors[module] = self.factor_storage.pack(factor)
+            converted.append(module)
+        return converted
 
     def _clear_eigen(self):
         """Clear eigendecompositions
@@ -196,101 +981,681 @@ class KFAC(optim.Optimizer):
         because eigendecompositions saved in place and the off-diagonals must
         be cleared.
         """
+        if self.precondition_mode != "eigen":
+            return
+        self._have_basis = False
+        # the cleared layers must all be refreshed
+        self.m_A_last.clear()
+        self.m_G_last.clear()
         for module in self.modules:
             self.m_QA[module].fill_(0)
             self.m_QG[module].fill_(0)
             self.m_dA[module].fill_(0)
             self.m_dG[module].fill_(0)
+        for remainder in list(self.m_rA.values()) + list(self.m_rG.values()):
+            remainder.fill_(0)
+
+    def _parallel_map(self, fn, items):
+        """Call `fn(item)` for every item, spread over the worker pool
+
+        Items are dealt to the workers round-robin, starting over on every
+        call, so a given item is always computed by the same worker and each
+        worker processes its items in their original order. The iterator is
+        local to the call as the async eigen refresh maps from its own thread.
+        """
+        if self.executor is None:
+            for item in items:
+                fn(item)
+            return
+
+        worker_iter = cycle(list(range(self.num_workers)))
+        assignment = [[] for _ in range(self.num_workers)]
+        for item in items:
+            worker, = worker_iter.next(1)
+            assignment[worker].append(item)
+
+        def run(part):
+            for item in part:
+                fn(item)
+
+        futures = [self.executor.submit(run, part) for part in assignment if part]
+        for future in futures:
+            future.result()
+
+    def _fetch(self, module, next_module=None):
+        """Make the offloaded tensors of `module` resident, see `offload`"""
+        if self.offload is not None:
+            self.offload.fetch(module, next_module)
+
+    def _patch_generator(self):
+        """Generator of the conv positions kept with `patch_subsample`, seeded
+        from the step like the one of `randomized_eigh`"""
+        if self.computeA.patch_subsample is None:
+            return None
+        return torch.Generator().manual_seed(self.steps)
 
     def _update_A(self):
         """Compute and update factor A for all modules"""
-        for module in self.modules: 
-            a = self.computeA(self.m_a[module], module)
-            if self.steps == 0:
-                self._init_A(a, module)
-            update_running_avg(a, self.m_A[module], self.factor_decay)
+        def update(module):
+            with self.profiler.span('factor_A', self.module_names[module]):
+                if self.streaming_factors:
+                    a = self._pop_accumulated(self.m_a, self.m_a_count, module)
+                else:
+                    a = self.computeA(self.m_a[module], module, self.m_blocks[module],
+                                      self._patch_generator())
+                if module not in self.m_A:
+                    self._init_A(a, module)
+                self._fetch(module, self._next_module.get(module))
+                self.factor_storage.update_running_avg(a, self.m_A[module], self.factor_decay)
+            if self.profiler.enabled:
+                self._profile_factor('factor_A', module, a)
+        self._parallel_map(update, self.modules)
 
     def _update_G(self):
         """Compute and update factor G for all modules"""
-        for module in self.modules:
-            g = self.computeG(self.m_g[module], module, self.batch_averaged)
-            if self.steps == 0:
-                self._init_G(g, module)
-            update_running_avg(g, self.m_G[module], self.factor_decay)
+        def update(module):
+            with self.profiler.span('factor_G', self.module_names[module]):
+                if self.streaming_factors:
+                    g = self._pop_accumulated(self.m_g, self.m_g_count, module)
+                else:
+                    g = self.computeG(self.m_g[module], module, self.batch_averaged,
+                                      self.m_blocks[module])
+                if module not in self.m_G:
+                    self._init_G(g, module)
+                self._fetch(module, self._next_module.get(module))
+                self.factor_storage.update_running_avg(g, self.m_G[module], self.factor_decay)
+            if self.profiler.enabled:
+                self._profile_factor('factor_G', module, g)
+        self._parallel_map(update, self.modules)
+
+    def _update_diagonal(self):
+        """Compute and update the diagonal factors of `diag_modules`
+
+        Embedding layers update their token frequencies (diagonal A) in
+        `m_D` and their factor G in `m_G`, LayerNorm layers the diagonal
+        Fisher of their weight and bias in `m_D`. The factors start from
+        ones/identity like the Kronecker factors and are kept dense in the
+        compute dtype.
+        """
+        for module in self.diag_modules:
+            if module not in self.m_a and module not in self.m_g:
+                continue
+            with self.profiler.span('factor_diag', self.module_names[module]):
+                G = None
+                if self.streaming_factors and isinstance(module, torch.nn.LayerNorm):
+                    D = self._pop_accumulated(self.m_g, self.m_g_count, module)
+                elif isinstance(module, torch.nn.LayerNorm):
+                    D = self.computeG.layer_norm(self.m_g[module], module, self.batch_averaged,
+                                                 self.computeA(self.m_a[module], module))
+                elif self.streaming_factors:
+                    D = self._pop_accumulated(self.m_a, self.m_a_count, module)
+                    G = self._pop_accumulated(self.m_g, self.m_g_count, module)
+                else:
+                    D = self.computeA(self.m_a[module], module)
+                    G = self.computeG(self.m_g[module], module, self.batch_averaged)
+                if module not in self.m_D:
+                    self.m_D[module] = torch.ones_like(D)
+                update_running_avg(D, self.m_D[module], self.factor_decay)
+                if G is not None:
+                    if module not in self.m_G:
+                        self.m_G[module] = torch.eye(G.shape[0], dtype=G.dtype, device=G.device)
+                    update_running_avg(G, self.m_G[module], self.factor_decay)
+
+    def _allreduce_diagonal(self):
+        """Start the async allreduce (average) of the diagonal factors and
+        of G of the Embedding layers"""
+        if self.comm_size == 1:
+            return []
+        factors = [self.m_D[m] for m in self.diag_modules if m in self.m_D]
+        factors += [self.m_G[m] for m in self.diag_modules if m in self.m_G]
+        return self.comm.allreduce_async_(factors)
+
+    def _refresh_diagonal(self, modules=None):
+        """Eigendecompose G of the Embedding layers in `modules` (default:
+        those that are due or have no eigendecomposition yet)
+
+        G is small (embedding size) and decomposed on every rank, from the
+        allreduced factor, instead of being assigned to one rank.
+        """
+        if modules is None:
+            modules = [module for module in self.diag_modules if module in self.m_G and
+                       (module not in self.m_QG or self.steps % self._update_freq(module) == 0)]
+        for module in modules:
+            with self.profiler.span('eigen', self.module_names[module]):
+                dG, QG = torch.linalg.eigh(self.m_G[module])
+            self.m_dG[module], self.m_QG[module] = dG.clamp(min=0), QG
+            self.m_refresh_step[module] = self.steps
+            self.refresh_counts[module] = self.refresh_counts.get(module, 0) + 1
+
+    def _get_diagonal_preconditioned_grad(self, module):
+        """Precondition the gradient of an Embedding or LayerNorm layer
+
+        LayerNorm divides the weight and bias gradients by their diagonal
+        Fisher plus the damping. Embedding preconditions the (tokens, dim)
+        gradient with diag(A) (x) G: in the eigenbasis of G each entry is
+        divided by a_i dG_j + damping, or with `precondition_mode='inverse'`
+        or `'newton'` multiplied by the damped (roots of the) inverses
+        (a_i + pi sqrt(damping))^(-1/p) (dG_j + sqrt(damping)/pi)^(-1/p).
 
-    def _update_eigen_A(self, module, ranks):
+        Returns:
+          list of the preconditioned weight (and bias) gradient, the
+          gradients themselves if the layer has no factors yet
+        """
+        weight = module.weight.grad.data
+        bias = module.bias.grad.data if getattr(module, 'bias', None) is not None else None
+        if module not in self.m_D or (isinstance(module, torch.nn.Embedding) and
+                                      module not in self.m_QG):
+            return [weight.clone()] + ([] if bias is None else [bias.clone()])
+        D = self.m_D[module]
+        if isinstance(module, torch.nn.LayerNorm):
+            v = [weight / (D[0].view_as(weight) + self.damping)]
+            if bias is not None:
+                v.append(bias / (D[1].view_as(bias) + self.damping))
+            return v
+        QG, dG = self.m_QG[module], self.m_dG[module]
+        if self.precondition_mode == "eigen":
+            scale = 1. / (D.unsqueeze(1) * dG.unsqueeze(0) + self.damping)
+        else:
+            p = self.newton_p if self.precondition_mode == "newton" else 1
+            damping = math.sqrt(self.damping)
+            pi = torch.sqrt((D.mean() / dG.mean()).clamp(min=self.eps)) \
+                    if self.factored_damping else D.new_ones(())
+            scale = (D + damping * pi).pow(-1. / p).unsqueeze(1) * \
+                    (dG + damping / pi).pow(-1. / p).unsqueeze(0)
+        return [((weight @ QG) * scale) @ QG.t()]
+
+    def _profile_factor(self, phase, module, factor):
+        """Record the covariance FLOPs and memory of a new factor A or G
+
+        The number of rows (samples times conv output positions) is taken
+        from the last output gradient of the layer.
+        """
+        k, b = (factor.shape[0], factor.shape[1]) if factor.dim() == 3 \
+                                                  else (1, factor.shape[0])
+        rows = self._output_numel.get(module, 0) // module.weight.shape[0]
+        if phase == 'factor_A' and isinstance(module, torch.nn.Conv2d) and \
+                self.computeA.patch_subsample is not None:
+            rows = int(rows * self.computeA.patch_subsample)
+        self.profiler.add(phase, self.module_names[module],
+                          nbytes=(rows * k * b + k * b * b) * factor.element_size(),
+                          flops=k * covariance_flops(rows, b))
+
+    def _profile_decomposition(self, phase, module, factor, ranks, evectors=None):
+        """Record the FLOPs and memory of the diagonal blocks of `factor`
+        that this rank eigendecomposes or inverts, or of its low-rank
+        eigendecomposition if `evectors` has fewer columns than rows"""
+        n = self.factor_storage.dim(factor)
+        k = factor.shape[0] if factor.dim() == 3 else min(len(ranks), n)
+        owned = sum(1 for rank in ranks[:k] if rank == self.rank)
+        b = n // k
+        elem = torch.empty((), dtype=self.factor_storage.compute_dtype).element_size()
+        if evectors is not None and evectors.shape[1] < n:
+            size = min(n, evectors.shape[1] + self.low_rank_oversample)
+            owned = 1 if ranks[0] == self.rank else 0
+            nbytes = (2 * n * size + size * size) * elem
+            flops = randomized_eigh_flops(n, size, self.low_rank_iters)
+        elif phase == 'eigen':
+            nbytes, flops = (2 * b * b + b) * elem, eigh_flops(b)
+        elif self.precondition_mode == "newton":
+            nbytes, flops = 4 * b * b * elem, newton_flops(b, self.newton_p, self.newton_iters)
+        else:
+            nbytes, flops = 3 * b * b * elem, inverse_flops(b)
+        self.profiler.add(phase, self.module_names[module],
+                          nbytes=owned * nbytes, flops=owned * flops)
+
+    def _update_eigen_A(self, module, ranks, state=None):
         """Compute eigendecomposition of A for module on specified workers
 
         Note: all ranks will enter this function but only the ranks specified
-        in `ranks` will continue to actually compute the eigendecomposition.
-        All other ranks will simply zero out their buffer for the 
-        eigendecomposition for the current module. This is done so we can sum
-        the eigendecompositions across all ranks to communicate the results
-        of locally computed eigendecompositions.
+        in `ranks` will actually compute (blocks of) the eigendecomposition.
+        The results are shared with the other ranks by the allgather at the
+        end of `_update_eigen`.
 
         Args:
           module: module to compute eigendecomposition of A on
-          ranks: list of horovod ranks (i.e. workers) to use when computing
+          ranks: list of ranks (i.e. workers) to use when computing
               the eigendecomposition.
+          state (optional): holder of the factor and eigendecomposition
+              dicts to use (default: self)
         """
-        if self.hvd_size==1:        #hvd.rank() in ranks
-            self._distributed_compute_eigen(self.m_A[module], 
-                    self.m_QA[module], self.m_dA[module], ranks)
+        state = self if state is None else state
+        factor = self.factor_storage.dense(state.m_A[module])
+        if module in self.m_rA:
+            self._compute_low_rank_eigen(factor, state.m_QA[module],
+                    state.m_dA[module], state.m_rA[module], ranks[0])
         else:
-            self.m_QA[module].fill_(0)
-            self.m_dA[module].fill_(0)
+            self._distributed_compute_eigen(factor, 
+                    state.m_QA[module], state.m_dA[module], ranks)
 
-    def _update_eigen_G(self, module, ranks):
-        """Compute eigendecomposition of A for module on specified workers
+    def _update_eigen_G(self, module, ranks, state=None):
+        """Compute eigendecomposition of G for module on specified workers
 
         See `_update_eigen_A` for more info`
         """
-        if self.hvd_size==1:    #hvd.rank() in ranks:
-            self._distributed_compute_eigen(self.m_G[module], 
-                    self.m_QG[module], self.m_dG[module], ranks)
+        state = self if state is None else state
+        factor = self.factor_storage.dense(state.m_G[module])
+        if module in self.m_rG:
+            self._compute_low_rank_eigen(factor, state.m_QG[module],
+                    state.m_dG[module], state.m_rG[module], ranks[0])
         else:
-            self.m_QG[module].fill_(0)
-            self.m_dG[module].fill_(0)
+            self._distributed_compute_eigen(factor, 
+                    state.m_QG[module], state.m_dG[module], ranks)
 
     def _distributed_compute_eigen(self, factor, evectors, evalues, ranks):
         """Computes the eigendecomposition of a factor across ranks
         
-        Assigns each rank in `ranks` to enter this function to compute a
-        diagonal block of `factor`. Results are written to `evectors` and
-        `evalues`. If `len(ranks)==1`, then that rank computes the
-        eigendecomposition of the entire `factor`.
+        Diagonal block `i` of `factor` is computed by rank `ranks[i]`.
+        Results are written to `evectors` and `evalues`. If `len(ranks)==1`,
+        then that rank computes the eigendecomposition of the entire `factor`.
 
         Args:
-            factor (tensor): tensor to eigendecompose
+            factor (tensor): n x n tensor, or (k, b, b) stack of diagonal
+                blocks, to eigendecompose
             evectors (tensor): tensor to save eigenvectors of `factor` to
             evalues (tensor): tensor to save eigenvalues of `factor` to
             ranks (list): list of ranks that will enter this function
         """
-        i = 0   #ranks.index(hvd.rank())
+        if factor.dim() == 3:
+            self._distributed_compute_block_eigen(factor, evectors, evalues, ranks)
+            return
+
         n = len(ranks)
         if n > min(factor.shape):
             n = min(factor.shape)
 
-        if i < n:
+        for i in range(n):
             start, end = get_block_boundary(i, n, factor.shape)
+            evalues_block = evalues.data[start[0]:end[0]]
+            evectors_block = evectors.data[start[0]:end[0], start[1]:end[1]]
+            if self._gather_parts is not None:
+                self._gather_parts.append((ranks[i], [evalues_block, evectors_block]))
+            if ranks[i] != self.rank:
+                continue
+
+            if n == 1 and self._eigen_buckets is not None:
+                key = (tuple(factor.shape), factor.dtype, factor.device) \
+                        if self.batched_eigen else id(evectors)
+                self._eigen_buckets.setdefault(key, []).append(
+                        (factor, evectors, evalues))
+                continue
+
             block = factor[start[0]:end[0], start[1]:end[1]]
-            d, Q = torch.symeig(block, eigenvectors=True)
+            d, Q = torch.linalg.eigh(block)
             d = torch.mul(d, (d > self.eps).float())
-            evalues.data[start[0]:end[0]].copy_(d)
-            evectors.data[start[0]:end[0], start[1]:end[1]].copy_(Q)
+            evalues_block.copy_(d)
+            evectors_block.copy_(Q)
+
+    def _distributed_compute_block_eigen(self, factor, evectors, evalues, ranks):
+        """`_distributed_compute_eigen` of a (k, b, b) stack of blocks
+
+        A rank that owns all blocks queues the whole stack in the eigen
+        buckets (or solves it right away), so the k blocks are decomposed by
+        one batched `eigh`. Else every rank solves the blocks it owns.
+        """
+        k = factor.shape[0]
+        if self._gather_parts is not None:
+            for i in range(k):
+                self._gather_parts.append((ranks[i], [evalues.data[i], evectors.data[i]]))
+        owned = [i for i in range(k) if ranks[i] == self.rank]
+        if not owned:
+            return
+        if len(owned) == k and self._eigen_buckets is not None:
+            key = (tuple(factor.shape), factor.dtype, factor.device) \
+                    if self.batched_eigen else id(evectors)
+            self._eigen_buckets.setdefault(key, []).append(
+                    (factor, evectors, evalues))
+            return
+
+        d, Q = torch.linalg.eigh(factor[owned])
+        d = torch.mul(d, (d > self.eps).float())
+        evalues.data[owned] = d
+        evectors.data[owned] = Q
+
+    def _compute_low_rank_eigen(self, factor, evectors, evalues, remainder, rank):
+        """Leading eigenpairs of a large factor on rank `rank`
+
+        The `evalues.shape[0]` leading eigenpairs are found with
+        `randomized_eigh`, seeded with the step so every refresh draws new
+        vectors. `remainder` is set to the mean of the other eigenvalues,
+        (tr(F) - sum(evalues)) / (n - k). Low-rank factors are never block
+        diagonalized.
+
+        Args:
+            factor (tensor): n x n tensor to eigendecompose
+            evectors (tensor): n x k tensor to save the eigenvectors to
+            evalues (tensor): k tensor to save the eigenvalues to
+            remainder (tensor): scalar tensor to save the remainder to
+            rank (int): rank that computes the decomposition
+        """
+        if self._gather_parts is not None:
+            self._gather_parts.append((rank, [evalues.data, evectors.data,
+                                              remainder.data]))
+        if rank != self.rank:
+            return
+
+        generator = torch.Generator().manual_seed(self.steps)
+        d, Q = randomized_eigh(factor, evalues.shape[0],
+                               oversample=self.low_rank_oversample,
+                               n_iter=self.low_rank_iters,
+                               generator=generator)
+        d = torch.mul(d, (d > self.eps).float())
+        n, k = evectors.shape
+        r = (torch.trace(factor) - d.sum()) / (n - k)
+        evalues.data.copy_(d)
+        evectors.data.copy_(Q)
+        remainder.data.copy_(r.clamp(min=0))
+
+    def _compute_eigen_buckets(self):
+        """Eigendecompose all queued factors with one call per bucket
+
+        Factors queued by `_distributed_compute_eigen` are stacked per
+        (shape, dtype, device) bucket and solved with a single batched
+        `torch.linalg.eigh`. The results are scattered back into the
+        eigenvector/eigenvalue buffers of each factor. Buckets are spread
+        over the worker pool if `num_workers > 1`.
+        """
+        buckets, self._eigen_buckets = self._eigen_buckets, None
+
+        def solve(jobs):
+            factors = torch.stack([factor for factor, _, _ in jobs])
+            d, Q = torch.linalg.eigh(factors)
+            d = torch.mul(d, (d > self.eps).float())
+            for i, (_, evectors, evalues) in enumerate(jobs):
+                evalues.data.copy_(d[i])
+                evectors.data.copy_(Q[i])
+        self._parallel_map(solve, list(buckets.values()))
+
+    def _update_eigen(self, diag_blocks, state=None, allgather=True, modules=None):
+        """Refresh the eigendecompositions of A and G for all modules
+
+        Args:
+          diag_blocks (int): unused, the block layout of every module is
+              kept in `m_blocks`
+          state (optional): holder of the dicts `m_A`, `m_G`, `m_QA`, `m_dA`,
+              `m_QG` and `m_dG` to refresh (default: self)
+          allgather (bool, optional): if `False`, the results of other ranks
+              are not gathered and the parts are left in `_gather_parts`
+              (default: True)
+          modules (list, optional): modules to refresh (default: all)
+        """
+        with self.profiler.span('eigen'):
+            self._refresh_eigen(diag_blocks, state, allgather, modules)
+
+    def _refresh_eigen(self, diag_blocks, state, allgather, modules):
+        """Body of `_update_eigen`, timed as the `'eigen'` phase"""
+        # reset rank iter so device get the same layers
+        # to compute to take advantage of caching
+        self.rank_iter.reset() 
+
+        # an offloaded layer may be evicted before a bucket is solved
+        if (self.batched_eigen or self.executor is not None) and self.offload is None:
+            self._eigen_buckets = {}
+        if self.comm_size > 1:
+            self._gather_parts = []
+
+        modules = self.modules if modules is None else modules
+        for module, next_module in zip(modules, modules[1:] + [None]):
+            self._fetch(module, next_module)
+            # Get ranks to compute this layer on, one per block of its layout
+            n = self.m_blocks[module]
+            ranks_a = self.rank_iter.next(n)
+            ranks_g = self.rank_iter.next(n) if self.distribute_layer_factors \
+                                             else ranks_a
+
+            self._update_eigen_A(module, ranks_a, state)
+            self._update_eigen_G(module, ranks_g, state)
+            if self.profiler.enabled:
+                self._profile_decomposition('eigen', module, self.m_A[module],
+                                            ranks_a, self.m_QA[module])
+                self._profile_decomposition('eigen', module, self.m_G[module],
+                                            ranks_g, self.m_QG[module])
+
+        if self._eigen_buckets is not None:
+            self._compute_eigen_buckets()
+
+        if allgather and self._gather_parts is not None:
+            self._allgather_results()
+
+    def _staleness_limit(self):
+        return self.kfac_update_freq if self.max_staleness is None \
+                                     else self.max_staleness
+
+    def _start_async_eigen(self, diag_blocks, modules):
+        """Start an eigen refresh of a snapshot of the factors on the
+        background thread
+
+        A refresh still in flight is finished first. The results are written
+        to new buffers, so `_get_preconditioned_grad` keeps using the current
+        basis until `_finish_async_eigen` swaps them in. Without a previous
+        basis, or with `max_staleness=0`, the step waits right away.
+        """
+        if self._refresh is not None:
+            self._finish_async_eigen()
+
+        state = types.SimpleNamespace(m_A={}, m_G={}, m_QA={}, m_dA={},
+                                      m_QG={}, m_dG={}, m_rA={}, m_rG={})
+        for module in modules:
+            state.m_A[module] = self.m_A[module].clone()
+            state.m_G[module] = self.m_G[module].clone()
+            state.m_QA[module] = torch.zeros_like(self.m_QA[module])
+            state.m_dA[module] = torch.zeros_like(self.m_dA[module])
+            state.m_QG[module] = torch.zeros_like(self.m_QG[module])
+            state.m_dG[module] = torch.zeros_like(self.m_dG[module])
+            if module in self.m_rA:
+                state.m_rA[module] = torch.zeros_like(self.m_rA[module])
+            if module in self.m_rG:
+                state.m_rG[module] = torch.zeros_like(self.m_rG[module])
+
+        def refresh():
+            self._update_eigen(diag_blocks, state, allgather=False,
+                               modules=modules)
+            parts, self._gather_parts = self._gather_parts, None
+            return state, parts
+
+        self._refresh = (self._refresh_executor.submit(refresh), self.steps)
+        self.refresh_stats['refreshes'] += 1
+        if not self._have_basis or self._staleness_limit() == 0:
+            self._finish_async_eigen()
+
+    def _poll_async_eigen(self):
+        """Swap in the async refresh if it is ready or `max_staleness` old
+
+        Distributed runs only swap at the staleness limit, so the allgather
+        of the results happens at the same step on all ranks.
+        """
+        if self._refresh is None:
+            return
+        future, start = self._refresh
+        if self.steps - start >= self._staleness_limit() or \
+                (self.comm_size == 1 and future.done()):
+            self._finish_async_eigen()
+
+    def _finish_async_eigen(self):
+        """Wait for the async refresh in flight and swap in its eigenbasis"""
+        future, _ = self._refresh
+        self._refresh = None
+        if not future.done():
+            self.refresh_stats['waits'] += 1
+            start = time.time()
+            future.result()
+            self.refresh_stats['wait_time'] += time.time() - start
+        state, parts = future.result()
+
+        if parts is not None:
+            self.comm.allgather_(parts)
+        self.m_QA.update(state.m_QA)
+        self.m_dA.update(state.m_dA)
+        self.m_QG.update(state.m_QG)
+        self.m_dG.update(state.m_dG)
+        self.m_rA.update(state.m_rA)
+        self.m_rG.update(state.m_rG)
+        self._have_basis = True
+
+    def _factor_drift(self, current, last):
+        """Relative Frobenius distance of a factor to its last refresh"""
+        current = self.factor_storage.dense(current)
+        last = self.factor_storage.dense(last)
+        return (torch.norm(current - last) / torch.norm(last).clamp(min=self.eps)).item()
+
+    def _update_freq(self, module):
+        """Iterations between the refreshes of `module`"""
+        return self.module_update_freq.get(self.module_names[module],
+                                           self.kfac_update_freq)
+
+    def _get_refresh_modules(self, forced=(), due=True):
+        """Modules to refresh at this step, recording their refresh
+
+        Without `refresh_drift` all modules are refreshed. Else a module is
+        refreshed if it was never refreshed, if its last refresh is
+        `max_refresh_age` steps old or if A or G drifted by more than
+        `refresh_drift`. The factors are allreduced before, so every rank
+        selects the same modules.
+
+        Args:
+          forced (list, optional): modules refreshed regardless, e.g. after
+              a change of their block layout
+          due (bool, optional): if `False`, only `forced` modules are
+              refreshed. Else the modules whose `_update_freq` divides the
+              step are considered (default: True)
+        """
+        modules = []
+        for module in self.modules:
+            if module not in forced and not (due and self.steps % self._update_freq(module) == 0):
+                continue
+            if self.refresh_drift is not None:
+                self._fetch(module, self._next_module.get(module))
+            if module not in forced and self.refresh_drift is not None and module in self.m_A_last:
+                age = self.steps - self.m_refresh_step[module]
+                if self.max_refresh_age is None or age < self.max_refresh_age:
+                    drift = max(self._factor_drift(self.m_A[module], self.m_A_last[module]),
+                                self._factor_drift(self.m_G[module], self.m_G_last[module]))
+                    if drift <= self.refresh_drift:
+                        continue
+            if self.refresh_drift is not None:
+                new = module not in self.m_A_last
+                self.m_A_last[module] = self.m_A[module].clone()
+                self.m_G_last[module] = self.m_G[module].clone()
+                if new:
+                    # offload the copies with the factors of the layer
+                    self._fetch(module)
+            self.m_refresh_step[module] = self.steps
+            self.refresh_counts[module] = self.refresh_counts.get(module, 0) + 1
+            modules.append(module)
+        return modules
+
+    def _get_damping_split(self, A, G):
+        """Factored Tikhonov ratio pi such that A gets pi*sqrt(damping) and
+        G gets sqrt(damping)/pi. Returns 1 if `factored_damping` is off."""
+        if not self.factored_damping:
+            return A.new_ones(())
+        pi = self._mean_diagonal(A) / self._mean_diagonal(G)
+        return torch.sqrt(pi.clamp(min=self.eps))
+
+    @staticmethod
+    def _mean_diagonal(factor):
+        """tr(F) / dim(F), of the stacked blocks (with padding) if 3-D"""
+        return factor.diagonal(dim1=-2, dim2=-1).mean()
+
+    def _update_inverse(self, modules=None):
+        """Refresh the damped inverses of A and G for `modules` (default: all)
+
+        Every damped factor F + dI is inverted as `cholesky_inverse` of its
+        Cholesky factor. With `batched_eigen`, factors of equal shape are
+        stacked and factorized with one batched call. Like the eigen refresh,
+        each inverse is computed by the rank assigned by `rank_iter` and then
+        shared with all ranks. Block diagonal factors are inverted block by
+        block with the same batched calls.
+
+        With `precondition_mode='newton'` the batched Cholesky is replaced by
+        the batched coupled Newton iteration of `kfac.utils.inverse_root`,
+        which computes (F + dI)^(-1/newton_p) and, for newton_p = 1, starts
+        from the current inverses.
+        """
+        with self.profiler.span('inverse'):
+            self._refresh_inverse(modules)
+
+    def _refresh_inverse(self, modules):
+        """Body of `_update_inverse`, timed as the `'inverse'` phase"""
+        self.rank_iter.reset()
+        if self.comm_size > 1:
+            self._gather_parts = []
+
+        def solve(jobs):
+            factors = torch.stack([factor for factor, _, _ in jobs])
+            d = torch.stack([d for _, d, _ in jobs]).to(factors.dtype)
+            if self.precondition_mode == "newton":
+                previous = torch.stack([inverse.data for _, _, inverse in jobs])
+                warm = self.newton_p == 1 and bool(previous.any())
+                roots, iterations = inverse_root(
+                        factors, d.view(-1, *[1] * (factors.dim() - 3)), self.newton_p,
+                        previous if warm else None, self.newton_iters, self.newton_tol)
+                for i, (_, _, inverse) in enumerate(jobs):
+                    inverse.data.copy_(roots[i])
+                self.newton_stats['solves'] += 1
+                self.newton_stats['iterations'] += iterations
+                self.newton_stats['warm'] += int(warm)
+                return
+            eye = torch.eye(factors.shape[-1], dtype=factors.dtype,
+                            device=factors.device)
+            d = d.view(-1, *[1] * (factors.dim() - 1))
+            L = torch.linalg.cholesky(factors + d * eye)
+            inverses = torch.cholesky_inverse(L)
+            for i, (_, _, inverse) in enumerate(jobs):
+                inverse.data.copy_(inverses[i])
+
+        damping = math.sqrt(self.damping)
+        buckets = {}
+        modules = self.modules if modules is None else modules
+        for module, next_module in zip(modules, modules[1:] + [None]):
+            self._fetch(module, next_module)
+            A = self.factor_storage.dense(self.m_A[module])
+            G = self.factor_storage.dense(self.m_G[module])
+            rank_a, = self.rank_iter.next(1)
+            rank_g, = self.rank_iter.next(1) if self.distribute_layer_factors \
+                                              else (rank_a,)
+            pi = self._get_damping_split(A, G)
+            if self.profiler.enabled:
+                self._profile_decomposition('inverse', module, A, [rank_a])
+                self._profile_decomposition('inverse', module, G, [rank_g])
+            for factor, d, inverse, rank in (
+                    (A, damping * pi, self.m_iA[module], rank_a),
+                    (G, damping / pi, self.m_iG[module], rank_g)):
+                if self._gather_parts is not None:
+                    self._gather_parts.append((rank, [inverse.data]))
+                if rank != self.rank:
+                    continue
+                key = (tuple(factor.shape), factor.dtype, factor.device) \
+                        if self.batched_eigen else id(inverse)
+                buckets.setdefault(key, []).append((factor, d, inverse))
+            if self.offload is not None:
+                # solve before the layer can be evicted
+                for jobs in buckets.values():
+                    solve(jobs)
+                buckets = {}
+        self._parallel_map(solve, list(buckets.values()))
+
+        if self._gather_parts is not None:
+            self._allgather_results()
 
     def _get_diag_blocks(self, module, diag_blocks):
         """Helper method for determining number of diag_blocks to use
 
-        Overrides `diag_blocks` if the `module` does not support
-        `diag_blocks>1`. I.e. for a Linear layer, we do not want to
-        use a `diag_blocks>1`.
+        An int `diag_blocks` only applies to Conv2d layers, i.e. for a
+        Linear layer, we do not want to use a `diag_blocks>1` unless it is
+        set per layer type with a dict.
 
         Args:
           module: module
-          diag_blocks (int): default number of diag blocks to use
+          diag_blocks (int or dict): default number of diag blocks to use,
+              or dict of counts keyed by layer name or class name
         """
-        return diag_blocks if module.__class__.__name__ == 'Conv2d' else 1
+        classname = module.__class__.__name__
+        if isinstance(diag_blocks, dict):
+            name = self.module_names.get(module)
+            if name in diag_blocks:
+                return diag_blocks[name]
+            return diag_blocks.get(classname, 1)
+        return diag_blocks if classname == 'Conv2d' else 1
 
     def _get_grad(self, module):
         """Get formated gradient of module
@@ -322,10 +1687,17 @@ class KFAC(optim.Optimizer):
         Returns:
           preconditioned gradient with same shape as `grad`
         """
-        v1 = self.m_QG[module].t() @ grad @ self.m_QA[module]
-        v2 = v1 / (self.m_dG[module].unsqueeze(1) * self.m_dA[module].unsqueeze(0) + 
-                   self.damping)
-        v = self.m_QG[module] @ v2 @ self.m_QA[module].t()
+        if self.m_blocks[module] > 1:
+            v = self._get_block_preconditioned_grad(module, grad)
+        elif self.precondition_mode != "eigen":
+            v = self.m_iG[module] @ grad @ self.m_iA[module]
+        elif module in self.m_rA or module in self.m_rG:
+            v = self._get_low_rank_preconditioned_grad(module, grad)
+        else:
+            v1 = self.m_QG[module].t() @ grad @ self.m_QA[module]
+            v2 = v1 / (self.m_dG[module].unsqueeze(1) * self.m_dA[module].unsqueeze(0) + 
+                       self.damping)
+            v = self.m_QG[module] @ v2 @ self.m_QA[module].t()
 
         if module.bias is not None:
             v = [v[:, :-1], v[:, -1:]]
@@ -335,10 +1707,70 @@ class KFAC(optim.Optimizer):
             v = [v.view(module.weight.grad.data.size())]
         return v
 
+    def _get_block_preconditioned_grad(self, module, grad):
+        """Precondition `grad` with block diagonal factors A and G
+
+        The gradient is gathered into the padded (kG, bG, kA, bA) layout of
+        the blocks of G and A, so every pair of blocks (i, j) is
+        preconditioned by the same batched products, e.g.
+        QG[i] ((QG[i]^T grad[i, j] QA[j]) / (dG[i] dA[j]^T + damping)) QA[j]^T,
+        and then scattered back. The padding rows/columns are dropped.
+        """
+        if self.precondition_mode != "eigen":
+            left, right = self.m_iG[module], self.m_iA[module]
+        else:
+            left, right = self.m_QG[module], self.m_QA[module]
+        kG, bG = left.shape[:2]
+        kA, bA = right.shape[:2]
+        m, n = grad.shape
+        rows = block_index(m, kG, grad.device)
+        cols = block_index(n, kA, grad.device)
+        padded = torch.nn.functional.pad(grad, (0, 1, 0, 1))
+        blocks = padded[rows][:, cols].view(kG, bG, kA, bA)
+
+        if self.precondition_mode != "eigen":
+            # the inverses (roots) are symmetric
+            v = torch.einsum('ipq,iqjr,jrs->ipjs', left, blocks, right)
+        else:
+            v1 = torch.einsum('iqp,iqjr,jrs->ipjs', left, blocks, right)
+            v2 = v1 / (self.m_dG[module].view(kG, bG, 1, 1) *
+                       self.m_dA[module].view(1, 1, kA, bA) + self.damping)
+            v = torch.einsum('ipq,iqjr,jsr->ipjs', left, v2, right)
+
+        out = grad.new_zeros(m + 1, n + 1)
+        out[rows.unsqueeze(1), cols.unsqueeze(0)] = v.reshape(kG * bG, kA * bA)
+        return out[:m, :n]
+
+    def _get_low_rank_preconditioned_grad(self, module, grad):
+        """Precondition `grad` when A and/or G only keep leading eigenpairs
+
+        A low-rank factor is F = Q diag(d) Q^T + r (I - Q Q^T). The gradient
+        is split into its parts inside/outside the ranges of QG and QA and
+        each part is divided by its eigenvalue of G (x) A plus the damping,
+        e.g. the part outside both ranges by rG * rA + damping.
+        """
+        QA, dA, rA = self.m_QA[module], self.m_dA[module], self.m_rA.get(module)
+        QG, dG, rG = self.m_QG[module], self.m_dG[module], self.m_rG.get(module)
+        GV = QG.t() @ grad
+        W = GV @ QA
+        v = QG @ (W / (dG.unsqueeze(1) * dA.unsqueeze(0) + self.damping)) @ QA.t()
+        if rA is not None:
+            # inside the range of QG, outside the range of QA
+            v += QG @ ((GV - W @ QA.t()) / (dG.unsqueeze(1) * rA + self.damping))
+        if rG is not None:
+            # outside the range of QG, inside the range of QA
+            VA = grad @ QA
+            v += ((VA - QG @ W) / (rG * dA.unsqueeze(0) + self.damping)) @ QA.t()
+        if rA is not None and rG is not None:
+            rest = grad - QG @ GV - VA @ QA.t() + QG @ W @ QA.t()
+            v += rest / (rG * rA + self.damping)
+        return v
+
     # |krockneck(A,B)| = |A||B|
     def _clip_grad_KNormal_(self, updates,eps = 1.e-3,clip=0.02):
         self.nu=clip    
         for module in self.modules:
+            self._fetch(module, self._next_module.get(module))
             grad = updates[module][0]
             nR,nC = grad.shape
             # g_norm = unitwise_norm(grad,axis=axis)
@@ -350,35 +1782,39 @@ class KFAC(optim.Optimizer):
             grad = clip_grad_rc(grad,qG,row_major=True,eps = eps,clip=clip)        
             grad = clip_grad_rc(grad,qA,row_major=False,eps = eps,clip=clip)  
             module.weight.grad.data.copy_(grad)
+        for module in self.diag_modules:
+            self._copy_update(module, updates[module])
+
+    def _copy_update(self, module, v):
+        """Copy the preconditioned gradients `v` into the gradients of `module`"""
+        module.weight.grad.data.copy_(v[0])
+        if getattr(module, 'bias', None) is not None:
+            module.bias.grad.data.copy_(v[1])
 
     def _update_scale_grad_0(self, updates):
         """Update the gradients in place and scale
 
         Updates the gradients in-place for all modules using the preconditioned
-        gradients and scales the gradients.
+        gradients and scales the gradients. The scale `self.nu` is read back
+        once per step and all modules are updated with `torch._foreach_*` ops.
 
         Args:
           updates (dict): dict of {module: precon_grad}
         """
-        vg_sum = 0
-        for module in self.modules:
+        grads, precon_grads = [], []
+        for module in self.modules + self.diag_modules:
             v = updates[module]
-            vg_sum += (v[0] * module.weight.grad.data * self.lr ** 2).sum().item()
-            if module.bias is not None:
-                vg_sum += (v[1] * module.bias.grad.data * self.lr ** 2).sum().item()
-        nu = min(1.0, math.sqrt(self.kl_clip / abs(vg_sum)))
+            grads.append(module.weight.grad.data)
+            precon_grads.append(v[0])
+            if getattr(module, 'bias', None) is not None:
+                grads.append(module.bias.grad.data)
+                precon_grads.append(v[1])
+        nu = kl_clip_scale(precon_grads, grads, self.lr, self.kl_clip).item()
         self.nu = nu
-        for module in self.modules:
-            v = updates[module]
-            module.weight.grad.data.copy_(v[0])
-            module.weight.grad.data.mul_(nu)
-            if module.bias is not None:
-                module.bias.grad.data.copy_(v[1])
-                module.bias.grad.data.mul_(nu)
-   
+        torch._foreach_copy_(grads, precon_grads)
+        torch._foreach_mul_(grads, nu)
+
     def _update_scale_grad(self, updates,eps = 1.e-3,clip=0.02):    
-        self.kA_norm = 0
-        self.kG_norm = 0
         self.W_norm = 0
         self.G_norm = 0
         if self.gradient_clip == "KNormal":
@@ -386,43 +1822,18 @@ class KFAC(optim.Optimizer):
         elif self.gradient_clip != "agc":
             return self._update_scale_grad_0(updates)
 
+        #   adaptive_grad_clip of the weights, as nR x nC matrices
         self.nu=clip    
-        for module in self.modules:
-            #   adaptive_grad_clip
-            self.kA_norm += torch.norm(self.m_QA[module])
-            self.kG_norm += torch.norm(self.m_QG[module])
-            grad = updates[module][0]
-            nR,nC = grad.shape
-            axis = 1 if nR>nC else 0
-            g_norm = unitwise_norm(grad,axis=axis)
-            W = module.weight.data
-            #W_norm = clip*torch.max( (W*W)**0.5, torch.zeros_like(W)+eps )      #clip*torch.max( (W*W)**0.5, eps )            #prevents zero-initialized parameters from always having their gradients clipped to zero.
-            W_norm = unitwise_norm(W,axis=axis)
-            self.W_norm += torch.norm(W_norm)
-            self.G_norm += torch.norm(g_norm)
-
-
-            grad = clip_grad_rc(grad,W,row_major=axis==1,eps = eps,clip=clip)   
-            module.weight.grad.data.copy_(grad)
-            if False and module.bias is not None:
-                v = updates[module][1]
-                axis = 0
-                b_grad = clip_grad_rc(v,module.bias.data,row_major=axis==1,eps = eps,clip=clip)  
-                module.bias.grad.data.copy_(b_grad)
-                 
-            # W_norm[W_norm<eps] = eps
-            # # clipped_grad = grad * (W_norm / g_norm)       
-            # s = torch.squeeze(clip*W_norm / (g_norm+1.0e-6))     
-            # s = torch.clamp(s, max=1)
-            # if s.numel()==nC:       #nC                
-            #     grad = grad*s                
-            # else:                   #nR           
-            #     grad = torch.einsum('rc,r->rc', grad, s)
-            
-            # if module.bias is not None:
-            #     v = updates[module][1]
-            #     module.bias.grad.data.copy_(v)
-
+        layers = self.modules + self.diag_modules
+        grads = [module.weight.grad.data for module in layers]
+        torch._foreach_copy_(grads, [updates[module][0] for module in layers])
+        grads = [grad.view(grad.shape[0], -1) for grad in grads]
+        weights = [module.weight.data.view(grad.shape) for module, grad in zip(layers, grads)]
+        # the norms of the unitwise norms are the Frobenius norms
+        self.W_norm = torch.stack(torch._foreach_norm(weights)).sum()
+        self.G_norm = torch.stack(torch._foreach_norm(grads)).sum()
+        # biases keep their gradient
+        adaptive_clip_grads_(grads, weights, clip=clip, eps=eps)
 
     def step(self, closure=None, epoch=None,accuracy=0):
         """Perform one K-FAC step
@@ -438,6 +1849,7 @@ class KFAC(optim.Optimizer):
               the `diag_warmup` period. `epoch` is not necessary if not using
               `diag_warmup`
         """
+        t0 = time.time()
 
         # Update params, used for compatibilty with `KFACParamScheduler`
         group = self.param_groups[0]
@@ -457,11 +1869,25 @@ class KFAC(optim.Optimizer):
         else:
             diag_blocks = self.diag_blocks if epoch >= self.diag_warmup else 1
 
-        if self.steps % self.fac_update_freq == 0:
-            self._update_A()
-            self._update_G()
-            if self.hvd_size > 1:
-                self._allreduce_factors()
+        converted = self._set_diag_blocks(diag_blocks)
+
+        # the hooks gathered the statistics of this step
+        if self._factor_step():
+            # the allreduce of A overlaps with the computation of G
+            with self.profiler.span('factor_A'):
+                self._update_A()
+            handles = self._allreduce_factors(self.m_A)
+            with self.profiler.span('factor_G'):
+                self._update_G()
+            handles += self._allreduce_factors(self.m_G)
+            if self.diag_modules:
+                with self.profiler.span('factor_diag'):
+                    self._update_diagonal()
+                handles += self._allreduce_diagonal()
+            self.comm.synchronize(handles)
+
+        if self.async_eigen:
+            self._poll_async_eigen()
 
         # if we are switching from no diag approx to approx, we need to clear
         # off-block-diagonal elements
@@ -471,61 +1897,75 @@ class KFAC(optim.Optimizer):
             self._clear_eigen()
             self.have_cleared_Q = True
 
-        if self.steps % self.kfac_update_freq == 0:
-            # reset rank iter so device get the same layers
-            # to compute to take advantage of caching
-            self.rank_iter.reset() 
-
+        modules = self._get_refresh_modules(converted)
+        if modules:
+            if self.precondition_mode != "eigen":
+                self._update_inverse(modules)
+            elif self.async_eigen:
+                self._start_async_eigen(diag_blocks, modules)
+            else:
+                self._update_eigen(diag_blocks, modules=modules)
+        self._refresh_diagonal()
+
+        self._prepare_precondition()
+        # norms of the eigenbases for agc, read while each layer is fetched
+        basis_norms = []
+        with self.profiler.span('precondition'):
             for module in self.modules:
-                # Get ranks to compute this layer on
-                n = self._get_diag_blocks(module, diag_blocks)
-                ranks_a = self.rank_iter.next(n)
-                ranks_g = self.rank_iter.next(n) if self.distribute_layer_factors \
-                                                 else ranks_a
-
-                self._update_eigen_A(module, ranks_a)
-                self._update_eigen_G(module, ranks_g)
-
-            if self.hvd_size > 1:
-                self._allreduce_eigendecomp()
-
-        for module in self.modules:
-            grad = self._get_grad(module)
-            precon_grad = self._get_preconditioned_grad(module, grad)
-            updates[module] = precon_grad
-
-        self._update_scale_grad(updates)
+                self._fetch(module, self._next_module.get(module))
+                with self.profiler.span('precondition', self.module_names[module]):
+                    grad = self._get_grad(module)
+                    precon_grad = self._get_preconditioned_grad(module, grad)
+                updates[module] = precon_grad
+                if self.gradient_clip == "agc" and self.precondition_mode == "eigen":
+                    basis_norms.append(torch.stack([self.m_QA[module].norm(),
+                                                    self.m_QG[module].norm()]))
+                if self.profiler.enabled:
+                    m, n = grad.shape
+                    self.profiler.add('precondition', self.module_names[module],
+                                      nbytes=2 * m * n * grad.element_size(),
+                                      flops=precondition_flops(m, n, self.precondition_mode))
+            for module in self.diag_modules:
+                with self.profiler.span('precondition', self.module_names[module]):
+                    updates[module] = self._get_diagonal_preconditioned_grad(module)
+
+        self.kA_norm, self.kG_norm = torch.stack(basis_norms).sum(0) if basis_norms else (0, 0)
+        with self.profiler.span('scale_grad'):
+            self._update_scale_grad(updates)
+        if self.profiler.enabled:
+            for module in self.modules + self.diag_modules:
+                grad = updates[module][0]
+                self.profiler.add('scale_grad', self.module_names[module],
+                                  nbytes=grad.numel() * grad.element_size(),
+                                  flops=4 * grad.numel())
 
         self.steps += 1
+        self._arm_hooks()
+        # wall time spent in `step()`, reported by `dump()`
+        self.T_all += time.time() - t0
 
-    def _allreduce_factors(self):
-        """Allreduce the factors for all layers"""
-        handles = []
+    def _allreduce_factors(self, factors):
+        """Start the bucketed async allreduce (average) of the factors
 
-        for m in self.modules:
-            handles.append(hvd.allreduce_async_(self.m_A[m].data, op=hvd.Average))
-            handles.append(hvd.allreduce_async_(self.m_G[m].data, op=hvd.Average))
+        Args:
+          factors (dict): `m_A` or `m_G`
 
-        for handle in handles:
-            hvd.synchronize(handle)
+        Returns:
+          handles to pass to `self.comm.synchronize()`
+        """
+        if self.comm_size == 1:
+            return []
+        return self.comm.allreduce_async_([factors[m].data for m in self.modules])
 
-    def _allreduce_eigendecomp(self):
-        """Allreduce the eigendecompositions for all layers
+    def _allgather_results(self):
+        """Allgather the eigendecompositions/inverses computed on each rank
 
-        Note: we use `op=hvd.Sum` to simulate an allgather`. Each rank will
-        either compute the eigendecomposition for a factor or just return
-        zeros so we sum instead of averaging.
+        Every rank only computed the blocks it was assigned in `rank_iter`.
+        The owners recorded in `_gather_parts` are identical on all ranks, so
+        each rank can unpack the results of the others.
         """
-        handles = []
-
-        for m in self.modules:
-            handles.append(hvd.allreduce_async_(self.m_QA[m].data, op=hvd.Sum))
-            handles.append(hvd.allreduce_async_(self.m_QG[m].data, op=hvd.Sum))
-            handles.append(hvd.allreduce_async_(self.m_dA[m].data, op=hvd.Sum))
-            handles.append(hvd.allreduce_async_(self.m_dG[m].data, op=hvd.Sum))
-    
-        for handle in handles:
-            hvd.synchronize(handle)
+        parts, self._gather_parts = self._gather_parts, None
+        self.comm.allgather_(parts)
 
 
 class KFACParamScheduler():
@@ -594,6 +2034,16 @@ class KFACParamScheduler():
 
         return factor_func
 
+    def state_dict(self):
+        """Epoch and base values of the scheduled parameters"""
+        return dict(epoch=self.epoch, damping_base=self.damping_base,
+                    fac_update_freq_base=self.fac_update_freq_base,
+                    kfac_update_freq_base=self.kfac_update_freq_base)
+
+    def load_state_dict(self, state_dict):
+        """Load a `state_dict()`. The schedules themselves are arguments"""
+        self.__dict__.update(state_dict)
+
     def step(self, epoch=None):
         """Update KFAC parameters"""
         if epoch is not None:
@@ -608,4 +2058,6 @@ class KFACParamScheduler():
         factor = self.update_freq_factor_func(self.epoch)
         params['fac_update_freq'] = int(self.fac_update_freq_base * factor)
         params['kfac_update_freq'] = int(self.kfac_update_freq_base * factor)
+        # the next step may now be a factor update step, or no longer be one
+        self.kfac._arm_hooks()
         # print(f"----damp={params['damping']}")
@@ -0,0 +1,213 @@
+import os
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+# dicts of `KFAC` holding the per-layer tensors that can be offloaded
+OFFLOAD_DICTS = ('m_A', 'm_G', 'm_QA', 'm_QG', 'm_dA', 'm_dG', 'm_iA', 'm_iG',
+                 'm_A_last', 'm_G_last')
+_ALIGN = 64
+
+
+class FactorOffload:
+    """Host storage tier of the K-FAC factors and eigendecompositions
+
+    Every offloaded layer has a home buffer in host memory: pinned CPU
+    memory (`kind='cpu'`) or a `numpy.memmap` file in `directory`
+    (`kind='memmap'`). The dicts of `KFAC` (`m_A`, `m_QA`, ...) hold the
+    resident copy of a layer on the compute device, or the home buffer itself
+    once the layer is evicted. Evicted tensors are host tensors, so every
+    reader of a layer must `fetch()` it first.
+
+    `fetch(module)` makes a layer resident before its factor update, refresh
+    or preconditioning. Resident layers are kept in LRU order and the least
+    recently used ones are written back to their home and evicted while the
+    resident bytes exceed `resident_mb`. The layer being fetched always
+    stays resident. `prefetch(module)` loads the next layer on a background
+    thread, overlapping the host reads with the computation of the current
+    layer, if it fits in `resident_mb` next to the current one.
+
+    Args:
+      owner (KFAC): preconditioner whose dicts are offloaded
+      kind (str, optional): `'cpu'` or `'memmap'` (default: 'memmap')
+      directory (str, optional): directory of the memmap files. If `None`,
+          a temporary directory is created and removed with the tier
+          (default: None)
+      resident_mb (float, optional): budget of the resident layers in MB
+          (default: 0, only the layer in use is resident)
+      modules (list, optional): modules to offload (default: all)
+    """
+
+    def __init__(self, owner, kind='memmap', directory=None, resident_mb=0.,
+                 modules=None):
+        if kind not in ('cpu', 'memmap'):
+            raise ValueError("Invalid offload kind: {}".format(kind))
+        self._owner = weakref.ref(owner)
+        self.kind = kind
+        self.budget = int(resident_mb * 1024 * 1024)
+        self.modules = None if modules is None else set(modules)
+        if kind == 'memmap' and directory is None:
+            directory = tempfile.mkdtemp(prefix='kfac_offload_')
+            self._cleanup = weakref.finalize(self, shutil.rmtree, directory, True)
+        self.directory = directory
+        # module -> {dict name: home tensor}, layout and resident bytes
+        self._home = {}
+        self._layout = {}
+        self._nbytes = {}
+        self._files = {}
+        self._resident = OrderedDict()
+        # module -> (future of the loaded tensors, bytes) of a prefetch
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._count = 0
+        self.peak_bytes = 0
+        self.stats = dict(hits=0, loads=0, prefetched=0, evictions=0)
+
+    def _tensors(self, module):
+        owner = self._owner()
+        return {name: getattr(owner, name)[module] for name in OFFLOAD_DICTS
+                if module in getattr(owner, name)}
+
+    @staticmethod
+    def _layout_of(tensors):
+        return {name: (tuple(t.shape), t.dtype) for name, t in tensors.items()}
+
+    def resident_bytes(self):
+        """Bytes of the resident layers and of the prefetches in flight"""
+        return sum(self._nbytes[m] for m in self._resident) + \
+               sum(nbytes for _, nbytes in self._pending.values())
+
+    def is_resident(self, module):
+        return module in self._resident
+
+    def _allocate(self, module, tensors):
+        """Home buffers with the layout of `tensors`"""
+        offsets, total = {}, 0
+        for name, t in tensors.items():
+            offsets[name] = total
+            total += -(-t.numel() * t.element_size() // _ALIGN) * _ALIGN
+        if self.kind == 'memmap':
+            path = os.path.join(self.directory, "{}.bin".format(self._count))
+            self._count += 1
+            buffer = torch.from_numpy(np.memmap(path, dtype=np.uint8, mode='w+',
+                                                shape=(max(total, 1),)))
+            self._files[module] = path
+        else:
+            buffer = torch.empty(max(total, 1), dtype=torch.uint8,
+                                 pin_memory=torch.cuda.is_available())
+        home = {}
+        for name, t in tensors.items():
+            nbytes = t.numel() * t.element_size()
+            start = offsets[name]
+            home[name] = buffer[start:start + nbytes].view(t.dtype).view(t.shape)
+        return home
+
+    def _register(self, module, tensors):
+        """(Re)create the home of a layer whose tensors are in the dicts"""
+        self._drop(module)
+        self._home[module] = self._allocate(module, tensors)
+        self._layout[module] = self._layout_of(tensors)
+        self._nbytes[module] = sum(t.numel() * t.element_size() for t in tensors.values())
+        self._device = next(iter(tensors.values())).device
+
+    def _drop(self, module):
+        self._resident.pop(module, None)
+        pending = self._pending.pop(module, None)
+        if pending is not None:
+            pending[0].result()
+        self._home.pop(module, None)
+        path = self._files.pop(module, None)
+        if path is not None:
+            os.remove(path)
+
+    def discard(self, module):
+        """Forget the home of `module` after its tensors were replaced, the
+        next `fetch()` registers them again"""
+        self._drop(module)
+        self._layout.pop(module, None)
+
+    def _load(self, module):
+        """Copies of the home of `module` on the compute device"""
+        return {name: home.to(self._device, copy=True)
+                for name, home in self._home[module].items()}
+
+    def _writeback(self, module):
+        owner = self._owner()
+        for name, home in self._home[module].items():
+            home.copy_(getattr(owner, name)[module])
+            getattr(owner, name)[module] = home
+
+    def _evict(self, keep, needed=0):
+        """Evict LRU layers other than `keep` until `needed` more bytes fit"""
+        for module in list(self._resident):
+            if self.resident_bytes() + needed <= self.budget:
+                return True
+            if module is keep:
+                continue
+            self._writeback(module)
+            del self._resident[module]
+            self.stats['evictions'] += 1
+        return self.resident_bytes() + needed <= self.budget
+
+    def fetch(self, module, next_module=None):
+        """Make `module` resident, then prefetch `next_module`"""
+        if self.modules is not None and module not in self.modules:
+            return
+        tensors = self._tensors(module)
+        if not tensors:
+            return
+        if module not in self._home or self._layout[module] != self._layout_of(tensors):
+            # new layer, or its tensors were reallocated (e.g. block layout)
+            if module in self._home and module not in self._resident:
+                # the remaining tensors of an evicted layer are on its home
+                owner = self._owner()
+                for name, t in tensors.items():
+                    tensors[name] = t.to(self._device, copy=True)
+                    getattr(owner, name)[module] = tensors[name]
+            self._register(module, tensors)
+            self._resident[module] = None
+        elif module in self._resident:
+            self._resident.move_to_end(module)
+            self.stats['hits'] += 1
+        else:
+            pending = self._pending.pop(module, None)
+            if pending is not None:
+                loaded = pending[0].result()
+                self.stats['prefetched'] += 1
+            else:
+                loaded = self._load(module)
+                self.stats['loads'] += 1
+            owner = self._owner()
+            for name, t in loaded.items():
+                getattr(owner, name)[module] = t
+            self._resident[module] = None
+        self._evict(keep=module)
+        self.peak_bytes = max(self.peak_bytes, self.resident_bytes())
+        if next_module is not None:
+            self.prefetch(next_module, keep=module)
+
+    def prefetch(self, module, keep=None):
+        """Start loading `module` in the background if it fits the budget"""
+        if module not in self._home or module in self._resident or \
+                module in self._pending:
+            return
+        if not self._evict(keep, needed=self._nbytes[module]):
+            return
+        self._pending[module] = (self._executor.submit(self._load, module),
+                                 self._nbytes[module])
+        self.peak_bytes = max(self.peak_bytes, self.resident_bytes())
+
+    def flush(self):
+        """Write the resident layers back to their home"""
+        for module in list(self._resident):
+            self._writeback(module)
+        self._resident.clear()
+        for future, _ in self._pending.values():
+            future.result()
+        self._pending.clear()
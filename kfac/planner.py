@@ -0,0 +1,316 @@
+import torch
+import torch.nn as nn
+
+from kfac.kfac_preconditioner import KFAC
+from kfac.profiler import (covariance_flops, eigh_flops, precondition_flops)
+from kfac.utils import block_slices
+
+
+def _layer_dims(module, input, output):
+    """(rows, dim(A), dim(G), patch elements) of a Linear, Conv2d, Embedding
+    or LayerNorm call. A of Embedding and LayerNorm is diagonal, LayerNorm
+    has no G."""
+    bias = 1 if getattr(module, 'bias', None) is not None else 0
+    if isinstance(module, nn.Conv2d):
+        rows = output.shape[0] * output.shape[2] * output.shape[3]
+        n_a = module.in_channels // module.groups * \
+              module.kernel_size[0] * module.kernel_size[1] + bias
+        return rows, n_a, module.out_channels, rows * n_a
+    if isinstance(module, nn.Embedding):
+        return input.numel(), module.num_embeddings, module.embedding_dim, 0
+    if isinstance(module, nn.LayerNorm):
+        n = module.weight.numel()
+        return input.numel() // n, n * (1 + bias), 0, 0
+    rows = input.numel() // input.shape[-1]
+    return rows, module.in_features + bias, module.out_features, 0
+
+
+def _recurrent_dims(weights, input):
+    """(rows, dim(A), dim(G), patch elements) of the `RecurrentWeights`
+    `weights` of an LSTM/GRU called on `input`"""
+    bias = 1 if weights.bias is not None else 0
+    rows = input.numel() // input.shape[-1]
+    return rows, weights.weight.shape[1] + bias, weights.weight.shape[0], 0
+
+
+class LayerPlan:
+    """Sizes and costs of the K-FAC of one layer, and its planned settings
+
+    Attributes:
+      name, classname: layer name (as in `model.named_modules()`) and type
+      rows: rows of the covariances (samples times conv output positions)
+      a_dim, g_dim: sizes of the factors A and G
+      patch_bytes: size of the unfolded conv patch matrix used for A
+      blocks: planned number of diagonal blocks
+      update_freq: planned iterations between eigen refreshes
+      excluded: `True` if the layer is planned not to be preconditioned
+      diagonal: `True` for the Embedding and LayerNorm layers, whose A is
+          a diagonal kept as a vector. They are not split into blocks.
+    """
+
+    def __init__(self, name, classname, rows, a_dim, g_dim, patch_bytes,
+                 update_freq, elem, diagonal=False):
+        self.name = name
+        self.classname = classname
+        self.rows = rows
+        self.a_dim = a_dim
+        self.g_dim = g_dim
+        self.patch_bytes = patch_bytes
+        self.blocks = 1
+        self.update_freq = update_freq
+        self.excluded = False
+        self.elem = elem
+        self.diagonal = diagonal
+
+    def _block_sizes(self, n):
+        return [end - start for start, end in block_slices(n, self.blocks)] if n else []
+
+    def _stacked(self, n):
+        """(k, b) of the stored blocks of a factor of size n"""
+        sizes = self._block_sizes(n)
+        return len(sizes), max(sizes, default=0)
+
+    def _dense(self):
+        """Sizes of the dense factors"""
+        return (self.g_dim,) if self.diagonal else (self.a_dim, self.g_dim)
+
+    def factor_bytes(self):
+        """Bytes of the running averages of A and G"""
+        diagonal = self.a_dim if self.diagonal else 0
+        return (diagonal + sum(k * b * b for k, b in map(self._stacked, self._dense()))) * self.elem
+
+    def eigen_bytes(self):
+        """Bytes of the eigenvectors and eigenvalues of the dense factors"""
+        return sum(k * b * (b + 1) for k, b in map(self._stacked, self._dense())) * self.elem
+
+    def memory(self):
+        """Persistent bytes of the layer"""
+        return 0 if self.excluded else self.factor_bytes() + self.eigen_bytes()
+
+    def eigen_flops(self):
+        """FLOPs of one refresh of the eigendecompositions"""
+        return sum(eigh_flops(b) for n in self._dense() for b in self._block_sizes(n))
+
+    def factor_flops(self):
+        """FLOPs of one update of the factors"""
+        diagonal = 2 * self.rows * self.a_dim if self.diagonal else 0
+        return diagonal + sum(covariance_flops(self.rows, b) for n in self._dense()
+                              for b in self._block_sizes(n))
+
+    def precondition_flops(self):
+        """FLOPs of preconditioning the gradient, block pair by block pair"""
+        if self.diagonal:
+            # the (a_dim, g_dim) gradient in the eigenbasis of G, divided entrywise
+            return 4 * self.a_dim * self.g_dim ** 2 + 2 * self.a_dim * max(self.g_dim, 1)
+        (k_g, b_g), (k_a, b_a) = self._stacked(self.g_dim), self._stacked(self.a_dim)
+        return k_g * k_a * precondition_flops(b_g, b_a)
+
+    def step_flops(self, fac_update_freq):
+        """Mean FLOPs per step"""
+        if self.excluded:
+            return 0
+        return self.factor_flops() / fac_update_freq + \
+               self.eigen_flops() / self.update_freq + self.precondition_flops()
+
+    def as_dict(self):
+        return dict(name=self.name, type=self.classname, rows=self.rows,
+                    a_dim=self.a_dim, g_dim=self.g_dim,
+                    factor_bytes=self.factor_bytes(), eigen_bytes=self.eigen_bytes(),
+                    eigen_flops=self.eigen_flops(), factor_flops=self.factor_flops(),
+                    patch_bytes=self.patch_bytes, blocks=self.blocks,
+                    update_freq=self.update_freq, excluded=self.excluded,
+                    diagonal=self.diagonal)
+
+
+class KFACPlan:
+    """Per-layer report and settings proposed by `plan_kfac`
+
+    Usage:
+      plan = plan_kfac(model, (3, 32, 32), memory_budget_mb=64, time_budget_ms=20)
+      plan = plan_kfac(rnn, inputs=(tokens, rnn.init_hidden(batch_size)))
+      print(plan)
+      preconditioner = KFAC(model, **plan.kfac_kwargs())
+    """
+
+    def __init__(self, layers, fac_update_freq, kfac_update_freq, gflops,
+                 patch_budget_mb=None):
+        self.layers = layers
+        self.fac_update_freq = fac_update_freq
+        self.kfac_update_freq = kfac_update_freq
+        self.gflops = gflops
+        self.patch_budget_mb = patch_budget_mb
+
+    def memory(self):
+        """Persistent bytes of the factors and eigendecompositions"""
+        return sum(layer.memory() for layer in self.layers)
+
+    def step_time(self):
+        """Estimated mean K-FAC seconds per step"""
+        flops = sum(layer.step_flops(self.fac_update_freq) for layer in self.layers)
+        return flops / (self.gflops * 1e9)
+
+    def report(self):
+        """List of per-layer dicts, see `LayerPlan.as_dict`"""
+        return [layer.as_dict() for layer in self.layers]
+
+    def kfac_kwargs(self):
+        """Keyword arguments of `KFAC` that apply the plan"""
+        kwargs = dict(fac_update_freq=self.fac_update_freq,
+                      kfac_update_freq=self.kfac_update_freq,
+                      diag_blocks={l.name: l.blocks for l in self.layers
+                                   if l.blocks > 1 and not l.excluded} or 1,
+                      exclude_modules=[l.name for l in self.layers if l.excluded],
+                      module_update_freq={l.name: l.update_freq for l in self.layers
+                                          if l.update_freq != self.kfac_update_freq
+                                          and not l.excluded})
+        if self.patch_budget_mb is not None:
+            kwargs['patch_budget_mb'] = self.patch_budget_mb
+        return kwargs
+
+    def __repr__(self):
+        lines = ["{:<40}{:>12}{:>10}{:>10}{:>10}{:>8}{:>8}{:>6}".format(
+                 'layer', 'A x G', 'MB', 'GFLOP', 'patch MB', 'blocks', 'freq', 'skip')]
+        for l in self.layers:
+            lines.append("{:<40}{:>12}{:>10.2f}{:>10.3f}{:>10.2f}{:>8}{:>8}{:>6}".format(
+                l.name[-40:], "{}x{}".format(l.a_dim, l.g_dim),
+                (l.factor_bytes() + l.eigen_bytes()) / 2 ** 20, l.eigen_flops() / 1e9,
+                l.patch_bytes / 2 ** 20, l.blocks, l.update_freq,
+                'yes' if l.excluded else ''))
+        lines.append("total {:.1f} MB, ~{:.1f} ms/step at {} GFLOP/s, "
+                     "fac_update_freq={}".format(self.memory() / 2 ** 20,
+                     self.step_time() * 1e3, self.gflops, self.fac_update_freq))
+        return "\n".join(lines)
+
+
+def plan_kfac(model, input_shape=None, batch_size=32, memory_budget_mb=None,
+              time_budget_ms=None, fac_update_freq=10, kfac_update_freq=100,
+              max_update_freq=1000, max_blocks=16, gflops=10.,
+              dtype=torch.float32, exclude_modules=None, inputs=None):
+    """Plan the K-FAC of `model` within a memory and time budget
+
+    Runs one forward pass on a random batch, or on `inputs`, to find the
+    sizes of the factors of the layers `KFAC` registers (see
+    `KFAC.find_layers`). Then, while the factors and
+    eigendecompositions exceed `memory_budget_mb`, the largest layer gets
+    twice as many diagonal blocks, or is excluded once it has `max_blocks`.
+    While the estimated K-FAC time per step exceeds `time_budget_ms`, the
+    most expensive layer is looked at: if its factor updates cost the most,
+    the factors of all layers are updated less often (at the next divisor
+    of `kfac_update_freq`); if its refreshes cost the most, it is refreshed
+    half as often (up to `max_update_freq`); else it is split into more
+    blocks, or excluded once none of these is possible.
+    If a conv patch matrix does not fit in the memory left, a
+    `patch_budget_mb` is proposed.
+
+    Args:
+      model (nn.Module): model to precondition
+      input_shape (tuple, optional): shape of one input sample, e.g.
+          (3, 32, 32). The random batch is built on the device of the model
+      batch_size (int, optional): batch size of the training (default: 32)
+      memory_budget_mb (float, optional): budget of the persistent K-FAC
+          memory in MB. `None` means no limit (default: None)
+      time_budget_ms (float, optional): budget of the mean K-FAC time per
+          step in ms, estimated at `gflops`. `None` means no limit
+          (default: None)
+      fac_update_freq (int, optional): see `KFAC` (default: 10)
+      kfac_update_freq (int, optional): see `KFAC`, the shortest interval
+          between refreshes (default: 100)
+      max_update_freq (int, optional): longest interval between the
+          refreshes of a layer (default: 1000)
+      max_blocks (int, optional): most diagonal blocks per layer (default: 16)
+      gflops (float, optional): assumed throughput of the K-FAC kernels in
+          GFLOP/s (default: 10)
+      dtype (torch.dtype, optional): dtype of the factors (default: float32)
+      exclude_modules (list, optional): see `KFAC`, these layers are not
+          planned (default: None)
+      inputs (tensor or tuple, optional): arguments of `model` for one
+          training batch, instead of a random batch of `input_shape`, e.g.
+          the tokens and the hidden state of a language model (default: None)
+
+    Returns:
+      `KFACPlan`
+    """
+    if (input_shape is None) == (inputs is None):
+        raise ValueError("plan_kfac needs either input_shape or inputs")
+    elem = torch.empty((), dtype=dtype).element_size()
+    modules, diag_modules, recurrent_modules, names, _ = \
+        KFAC.find_layers(model, set(exclude_modules or []))
+    layers = []
+
+    def add(name, module, dims, diagonal=False):
+        rows, a_dim, g_dim, patch = dims
+        layers.append(LayerPlan(name, module.__class__.__name__, rows, a_dim, g_dim,
+                                patch * elem, kfac_update_freq, elem, diagonal))
+
+    def record(module, input, output):
+        if module in recurrent_modules:
+            for weights in recurrent_modules[module].values():
+                add(names[weights], module, _recurrent_dims(weights, input[0]))
+        else:
+            add(names[module], module, _layer_dims(module, input[0], output),
+                module in diag_modules)
+
+    # the LSTM/GRU layers are hooked instead of their `RecurrentWeights`
+    hooked = list(recurrent_modules) + [m for m in modules + diag_modules
+                                        if isinstance(m, nn.Module)]
+    handles = [module.register_forward_hook(record) for module in hooked]
+    if inputs is None:
+        device = next(model.parameters()).device
+        inputs = torch.randn(batch_size, *input_shape, device=device)
+    if not isinstance(inputs, tuple):
+        inputs = (inputs,)
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(*inputs)
+    finally:
+        model.train(training)
+        for handle in handles:
+            handle.remove()
+    # a layer called several times is planned once
+    layers = list({layer.name: layer for layer in layers}.values())
+
+    def can_split(layer):
+        return not layer.diagonal and \
+               layer.blocks * 2 <= min(max_blocks, layer.a_dim, layer.g_dim)
+
+    if memory_budget_mb is not None:
+        budget = memory_budget_mb * 2 ** 20
+        while sum(l.memory() for l in layers) > budget:
+            layer = max(layers, key=lambda l: l.memory())
+            if can_split(layer):
+                layer.blocks *= 2
+            else:
+                layer.excluded = True
+
+    if time_budget_ms is not None:
+        budget = time_budget_ms * 1e-3 * gflops * 1e9
+        while sum(l.step_flops(fac_update_freq) for l in layers) > budget:
+            active = [l for l in layers if not l.excluded]
+            if not active:
+                break
+            layer = max(active, key=lambda l: l.step_flops(fac_update_freq))
+            factor = layer.factor_flops() / fac_update_freq
+            refresh = layer.eigen_flops() / layer.update_freq
+            divisors = [f for f in range(fac_update_freq + 1, kfac_update_freq + 1)
+                        if kfac_update_freq % f == 0]
+            if factor >= max(refresh, layer.precondition_flops()) and divisors:
+                fac_update_freq = divisors[0]
+            elif refresh >= layer.precondition_flops() and \
+                    layer.update_freq * 2 <= max_update_freq:
+                layer.update_freq *= 2
+            elif can_split(layer):
+                layer.blocks *= 2
+            elif layer.update_freq * 2 <= max_update_freq:
+                layer.update_freq *= 2
+            else:
+                layer.excluded = True
+
+    patch_budget_mb = None
+    if memory_budget_mb is not None:
+        left = memory_budget_mb * 2 ** 20 - sum(l.memory() for l in layers)
+        patch = max([l.patch_bytes for l in layers if not l.excluded], default=0)
+        if patch > left:
+            patch_budget_mb = max(left, 2 ** 20) / 2 ** 20
+    return KFACPlan(layers, fac_update_freq, kfac_update_freq, gflops, patch_budget_mb)
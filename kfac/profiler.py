@@ -0,0 +1,184 @@
+import time
+import threading
+from contextlib import nullcontext
+
+import torch
+
+
+# Rough FLOP counts of the K-FAC kernels
+def covariance_flops(rows, n):
+    """a^T a of a rows x n matrix"""
+    return 2 * rows * n * n
+
+
+def eigh_flops(n):
+    """Symmetric eigendecomposition with eigenvectors (tridiagonal QR)"""
+    return 9 * n ** 3
+
+
+def randomized_eigh_flops(n, size, n_iter=2):
+    """`randomized_eigh` with a subspace of `size` vectors"""
+    products = (n_iter + 2) * 2 * n * n * size
+    return products + (n_iter + 1) * 4 * n * size * size + 9 * size ** 3
+
+
+def inverse_flops(n):
+    """Cholesky factorization and `cholesky_inverse` of an n x n matrix"""
+    return n ** 3
+
+
+def newton_flops(n, p=1, iters=40):
+    """Coupled Newton inverse p-th root of an n x n matrix, at most `iters`
+    iterations of X T and T^p M"""
+    return iters * 2 * (p + 1) * n ** 3
+
+
+def precondition_flops(m, n, mode="eigen"):
+    """Preconditioning of an m x n gradient with m x m and n x n factors"""
+    matmuls = 2 * m * n * (m + n)
+    return 2 * matmuls + 2 * m * n if mode == "eigen" else matmuls
+
+
+class _Span:
+    """Times the enclosed block and adds it to the profiler"""
+
+    def __init__(self, profiler, phase, name):
+        self.profiler = profiler
+        self.phase = phase
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._sync()
+        self.profiler.add(self.phase, self.name,
+                          seconds=time.perf_counter() - self.start)
+        return False
+
+
+class KFACProfiler:
+    """Wall time, memory and FLOP estimates of the K-FAC phases
+
+    Every record is keyed by phase and module name. The phases of `KFAC`
+    are `'factor_A'`, `'factor_G'`, `'eigen'`, `'inverse'`, `'precondition'`
+    and `'scale_grad'`. Only the time is measured. The bytes (`est_bytes`)
+    are analytic estimates of the memory the phase allocates for a module
+    (inputs reshaped for the covariance, factors, decompositions and
+    intermediate products), not allocator measurements. The FLOPs are
+    estimates of the kernels it runs.
+
+    Usage:
+      preconditioner = KFAC(model, profile=True)
+      ...
+      preconditioner.profiler.summary()['eigen']['time']
+      preconditioner.profiler.by_module('precondition')
+      preconditioner.dump_epoch(epoch, log_writer)   # write and reset
+
+    When disabled, `span()` returns a shared no-op context and nothing is
+    recorded, so the instrumentation costs a function call per phase.
+
+    Args:
+      enabled (bool, optional): record the phases (default: False)
+      synchronize (bool, optional): synchronize CUDA before and after timing
+          a span so asynchronous kernels are attributed to the right phase
+          (default: True)
+    """
+
+    def __init__(self, enabled=False, synchronize=True):
+        self.enabled = enabled
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self._null = nullcontext()
+        self._lock = threading.Lock()
+        # (phase, module name or None) -> [calls, seconds, estimated bytes, flops]
+        self._records = {}
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def span(self, phase, name=None):
+        """Context timing `phase`, for module `name` or the whole phase"""
+        if not self.enabled:
+            return self._null
+        return _Span(self, phase, name)
+
+    def add(self, phase, name=None, seconds=0., nbytes=0, flops=0):
+        """Add a measurement to `phase` of module `name` (`None` for the
+        whole phase)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            record = self._records.setdefault((phase, name), [0, 0., 0, 0])
+            if seconds:
+                record[0] += 1
+                record[1] += seconds
+            record[2] += nbytes
+            record[3] += flops
+
+    def reset(self):
+        with self._lock:
+            self._records = {}
+
+    @staticmethod
+    def _as_dict(record):
+        calls, seconds, nbytes, flops = record
+        return dict(calls=calls, time=seconds, est_bytes=nbytes, flops=flops)
+
+    def phases(self):
+        return sorted({phase for phase, _ in self._records})
+
+    def by_module(self, phase):
+        """{module name: dict(calls, time, est_bytes, flops)} of `phase`"""
+        return {name: self._as_dict(record)
+                for (p, name), record in self._records.items()
+                if p == phase and name is not None}
+
+    def summary(self):
+        """{phase: dict(calls, time, est_bytes, flops)}
+
+        The time of a phase is its own span if it was timed as a whole, else
+        the sum of its modules. Bytes and FLOPs are summed over the modules.
+        """
+        summary = {}
+        for phase in self.phases():
+            total = [0, 0., 0, 0]
+            for (p, name), record in self._records.items():
+                if p != phase:
+                    continue
+                total[2] += record[2]
+                total[3] += record[3]
+            whole = self._records.get((phase, None))
+            if whole is not None and whole[0] > 0:
+                total[0], total[1] = whole[0], whole[1]
+            else:
+                modules = self.by_module(phase).values()
+                total[0] = max([m['calls'] for m in modules], default=0)
+                total[1] = sum(m['time'] for m in modules)
+            summary[phase] = self._as_dict(total)
+        return summary
+
+    def write(self, log_writer, step, per_module=False):
+        """Export the totals (and optionally each module) with
+        `log_writer.add_scalar` under `KFAC/profile/`"""
+        for phase, stats in self.summary().items():
+            for key in ('time', 'est_bytes', 'flops'):
+                log_writer.add_scalar('KFAC/profile/{}/{}'.format(phase, key),
+                                      stats[key], step)
+            if not per_module:
+                continue
+            for name, stats in self.by_module(phase).items():
+                for key in ('time', 'est_bytes', 'flops'):
+                    log_writer.add_scalar('KFAC/profile/{}/{}/{}'.format(phase, key, name),
+                                          stats[key], step)
+
+    def __repr__(self):
+        lines = ["{:<14}{:>8}{:>12}{:>14}{:>14}".format(
+                 'phase', 'calls', 'time (ms)', 'est. MB', 'est. GFLOP')]
+        for phase, stats in self.summary().items():
+            lines.append("{:<14}{:>8}{:>12.1f}{:>14.1f}{:>14.3f}".format(
+                phase, stats['calls'], stats['time'] * 1e3,
+                stats['est_bytes'] / 2 ** 20, stats['flops'] / 1e9))
+        return "\n".join(lines)
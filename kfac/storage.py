@@ -0,0 +1,110 @@
+import torch
+
+from kfac.utils import update_running_avg
+
+
+class FactorStorage:
+    """Storage layout of the Kronecker factors A and G
+
+    A factor is always stored as a single tensor so that it can be
+    allreduced and checkpointed like a dense one. With `packed=True` it is
+    the flat upper triangle (row-major) of the symmetric factor, i.e.
+    n(n+1)/2 values instead of n*n. With `dtype`, e.g. `torch.bfloat16`, the
+    running averages are kept in reduced precision. `dense()` always
+    returns the full matrix in `compute_dtype` for the eigendecomposition,
+    inverse and preconditioning.
+
+    Block diagonal factors are stored as their (k, b, b) stack of diagonal
+    blocks (see `kfac.utils.extract_blocks`). They are never packed, only
+    cast to `dtype`, and `dense()` returns the stack in `compute_dtype`.
+
+    Args:
+      packed (bool, optional): store the upper triangle only (default: False)
+      dtype (torch.dtype, optional): storage dtype of the running averages.
+          If `None`, the dtype of the computed factors is kept (default: None)
+      compute_dtype (torch.dtype, optional): dtype of the dense factors used
+          for computation (default: torch.float32)
+    """
+
+    def __init__(self, packed=False, dtype=None, compute_dtype=torch.float32):
+        self.packed = packed
+        self.dtype = dtype
+        self.compute_dtype = compute_dtype
+        self._masks = {}
+
+    @property
+    def is_dense(self):
+        """`True` if factors are stored as plain full-precision matrices"""
+        return not self.packed and self.dtype is None
+
+    def _mask(self, n, device):
+        """Cached boolean mask of the upper triangle of an n x n matrix"""
+        key = (n, device)
+        if key not in self._masks:
+            self._masks[key] = torch.ones(n, n, dtype=torch.bool,
+                                          device=device).triu_()
+        return self._masks[key]
+
+    def dim(self, stored):
+        """Size n of the n x n factor held by `stored` (k * b for blocks,
+        including the padding)"""
+        if stored.dim() == 3:
+            return stored.shape[0] * stored.shape[1]
+        if stored.dim() == 2:
+            return stored.shape[0]
+        return int(((8 * stored.numel() + 1) ** 0.5 - 1) / 2)
+
+    def pack(self, dense):
+        """Convert a dense symmetric factor to the storage layout"""
+        stored = dense[self._mask(dense.shape[0], dense.device)] \
+                if self.packed and dense.dim() == 2 else dense
+        if self.dtype is not None:
+            stored = stored.to(self.dtype)
+        return stored
+
+    def dense(self, stored):
+        """Full n x n factor in `compute_dtype` (no copy for dense storage)"""
+        if self.is_dense:
+            return stored
+        if not self.packed or stored.dim() == 3:
+            return stored.to(self.compute_dtype)
+        n = self.dim(stored)
+        mask = self._mask(n, stored.device)
+        upper = stored.new_zeros(n, n, dtype=self.compute_dtype)
+        upper.masked_scatter_(mask, stored.to(self.compute_dtype))
+        return upper + upper.triu(1).t()
+
+    def eye(self, factor):
+        """Identity with the size, device and layout of `factor`"""
+        if factor.dim() == 3:
+            eye = torch.eye(factor.shape[1], dtype=factor.dtype, device=factor.device)
+            return self.pack(eye.repeat(factor.shape[0], 1, 1))
+        return self.pack(torch.diag(factor.new(factor.shape[0]).fill_(1)))
+
+    def update_running_avg(self, new, current, alpha):
+        """Running average of the dense factor `new` into `current` in place
+
+        The average is computed in the precision of `new` and cast back to
+        the storage dtype.
+        """
+        if self.is_dense:
+            update_running_avg(new, current, alpha)
+            return
+        if self.packed and new.dim() == 2:
+            new = new[self._mask(new.shape[0], new.device)]
+        avg = current.to(new.dtype)
+        update_running_avg(new, avg, alpha)
+        current.copy_(avg)
+
+    @staticmethod
+    def nbytes(stored):
+        return stored.numel() * stored.element_size()
+
+    def dense_nbytes(self, stored):
+        """Bytes of the same factor stored as a dense `compute_dtype` matrix
+        (or stack of blocks)"""
+        elem = torch.empty((), dtype=self.compute_dtype).element_size()
+        if stored.dim() == 3:
+            return stored.numel() * elem
+        n = self.dim(stored)
+        return n * n * elem
@@ -0,0 +1,73 @@
+"""Tiny models, training loop and log writer shared by the tests"""
+import torch
+import torch.nn as nn
+
+import kfac
+
+
+def conv_model(hidden=(12,), convs=1, classes=5):
+    """`convs` Conv2d layers with 4 channels on (3, 6, 6) images, then Linear
+    layers of widths `hidden` and a Linear classifier of `classes` outputs"""
+    layers = []
+    for i in range(convs):
+        layers += [nn.Conv2d(3 if i == 0 else 4, 4, kernel_size=3, padding=1), nn.ReLU()]
+    layers.append(nn.Flatten())
+    width = 4 * 6 * 6
+    for size in hidden:
+        layers += [nn.Linear(width, size), nn.ReLU()]
+        width = size
+    layers.append(nn.Linear(width, classes))
+    return nn.Sequential(*layers)
+
+
+def mlp(*widths, inplace=False):
+    """Linear layers widths[0] -> widths[1] -> ... -> widths[-1] with ReLUs"""
+    layers = []
+    for n_in, n_out in zip(widths[:-1], widths[1:]):
+        layers += [nn.Linear(n_in, n_out), nn.ReLU(inplace=inplace)]
+    return nn.Sequential(*layers[:-1])
+
+
+def run_kfac(steps=3, make_model=conv_model, input_shape=(8, 3, 6, 6), batches=None,
+             epochs=None, callback=None, cls=kfac.KFAC, device="cpu", **kwargs):
+    """Model and preconditioner after `steps` steps on the loss sum(output^2)
+
+    Seeds torch with 0, builds `make_model()` and `cls` with factor and eigen
+    updates on every step, the KL clip and no distributed layer factors,
+    `kwargs` override these options. The batches are random `input_shape`
+    tensors drawn before each step, or the tensors of `batches`, moved with the
+    model to `device`.
+
+    Args:
+      epochs (list, optional): `epoch` passed to every `step()`
+      callback (callable, optional): called with the model and the
+          preconditioner after every step
+    """
+    torch.manual_seed(0)
+    model = make_model().to(device)
+    options = dict(fac_update_freq=1, kfac_update_freq=1,
+                   distribute_layer_factors=False, gradient_clip="kl")
+    options.update(kwargs)
+    preconditioner = cls(model, **options)
+    for step in range(steps):
+        data = torch.randn(*input_shape) if batches is None else batches[step]
+        data = data.to(device)
+        model.zero_grad()
+        model(data).pow(2).sum().backward()
+        preconditioner.step(epoch=None if epochs is None else epochs[step])
+        if callback is not None:
+            callback(model, preconditioner)
+    return model, preconditioner
+
+
+class LogWriter:
+    """Keeps the last value of every tag written like a SummaryWriter"""
+
+    def __init__(self):
+        self.scalars = {}
+
+    def add_scalar(self, tag, value, step):
+        self.scalars[tag] = value
+
+    def add_histogram(self, tag, values, step):
+        self.scalars[tag] = values
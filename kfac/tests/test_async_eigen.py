@@ -0,0 +1,56 @@
+import unittest
+import torch
+
+import kfac
+from kfac.tests.helpers import conv_model, run_kfac
+
+
+def run(steps, **kwargs):
+    """Factor A rebuilt from its eigenbasis after each of `steps` KFAC steps"""
+    bases = []
+
+    def save(model, preconditioner):
+        bases.append([preconditioner.m_QA[m] @ torch.diag(preconditioner.m_dA[m])
+                      @ preconditioner.m_QA[m].t() for m in preconditioner.modules])
+
+    _, preconditioner = run_kfac(steps, kfac_update_freq=2, callback=save, **kwargs)
+    return preconditioner, bases
+
+
+class TestAsyncEigen(unittest.TestCase):
+
+    def assertBasesEqual(self, a, b):
+        for qa, qb in zip(a, b):
+            self.assertTrue(torch.allclose(qa, qb, atol=1e-5))
+
+    def test_first_refresh_waits(self):
+        _, sync = run(1)
+        preconditioner, bases = run(1, async_eigen=True)
+        self.assertBasesEqual(sync[0], bases[0])
+        self.assertEqual(preconditioner.refresh_stats['refreshes'], 1)
+
+    def test_stale_basis_until_swap(self):
+        _, sync = run(4)
+        preconditioner, bases = run(4, async_eigen=True, max_staleness=1)
+        # step 2 starts a refresh but still preconditions with the step 0 basis
+        self.assertBasesEqual(bases[2], sync[0])
+        # the basis of the step 2 factors is used from step 3 on
+        self.assertBasesEqual(bases[3], sync[2])
+        self.assertEqual(preconditioner.refresh_stats['refreshes'], 2)
+
+    def test_zero_staleness_matches_sync(self):
+        _, sync = run(5)
+        preconditioner, bases = run(5, async_eigen=True, max_staleness=0)
+        for a, b in zip(sync, bases):
+            self.assertBasesEqual(a, b)
+        stats = preconditioner.refresh_stats
+        self.assertEqual(stats['refreshes'], 3)
+        self.assertLessEqual(stats['waits'], stats['refreshes'])
+
+    def test_requires_eigen(self):
+        with self.assertRaises(ValueError):
+            kfac.KFAC(conv_model(), async_eigen=True, precondition_mode="inverse")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import torch
+import torch.nn as nn
+
+import kfac
+from kfac.utils import assemble_blocks, extract_blocks
+from kfac.tests.helpers import conv_model, run_kfac
+
+
+def run(steps=3, **kwargs):
+    return run_kfac(steps, damping=0.01, **kwargs)[1]
+
+
+def dense(preconditioner, factor, n):
+    factor = preconditioner.factor_storage.dense(factor)
+    return assemble_blocks(factor, n) if factor.dim() == 3 else factor
+
+
+def reference(preconditioner, module, grad):
+    """Preconditioning with the block diagonal factors as dense matrices"""
+    m, n = grad.shape
+    A = dense(preconditioner, preconditioner.m_A[module], n)
+    G = dense(preconditioner, preconditioner.m_G[module], m)
+    damping = preconditioner.damping
+    if preconditioner.precondition_mode == "inverse":
+        d = damping ** 0.5
+        return torch.linalg.inv(G + d * torch.eye(m)) @ grad @ \
+               torch.linalg.inv(A + d * torch.eye(n))
+    dA, QA = torch.linalg.eigh(A)
+    dG, QG = torch.linalg.eigh(G)
+    v = (QG.t() @ grad @ QA) / (dG.unsqueeze(1) * dA.unsqueeze(0) + damping)
+    return QG @ v @ QA.t()
+
+
+def random_grad(module, seed=1):
+    n = module.weight[0].numel() + 1
+    return torch.randn(module.weight.shape[0], n,
+                       generator=torch.Generator().manual_seed(seed))
+
+
+class TestBlockDiag(unittest.TestCase):
+
+    def test_single_block_is_dense(self):
+        preconditioner = run()
+        for module in preconditioner.modules:
+            self.assertEqual(preconditioner.m_A[module].dim(), 2)
+            grad = random_grad(module)
+            QA, dA = preconditioner.m_QA[module], preconditioner.m_dA[module]
+            QG, dG = preconditioner.m_QG[module], preconditioner.m_dG[module]
+            v = (QG.t() @ grad @ QA) / (dG.unsqueeze(1) * dA.unsqueeze(0) + 0.01)
+            expected = QG @ v @ QA.t()
+            result = preconditioner._get_preconditioned_grad(module, grad)
+            result = torch.cat([result[0].view(grad.shape[0], -1),
+                                result[1].view(-1, 1)], 1)
+            self.assertTrue(torch.equal(result, expected))
+
+    def test_factors_are_diagonal_blocks(self):
+        full = run()
+        blocks = run(diag_blocks={'Conv2d': 3, 'Linear': 2})
+        for module_full, module in zip(full.modules, blocks.modules):
+            k = 3 if isinstance(module, nn.Conv2d) else 2
+            self.assertEqual(blocks.m_blocks[module], k)
+            for factor_full, factor in ((full.m_A[module_full], blocks.m_A[module]),
+                                        (full.m_G[module_full], blocks.m_G[module])):
+                self.assertEqual(factor.dim(), 3)
+                # the padding of uneven blocks starts as identity
+                n = factor_full.shape[0]
+                expected = assemble_blocks(extract_blocks(factor_full, k), n)
+                self.assertTrue(torch.allclose(assemble_blocks(factor, n), expected,
+                                               atol=1e-6))
+        stored = sum(s for _, _, s in blocks.factor_memory_report())
+        stored_full = sum(s for _, _, s in full.factor_memory_report())
+        self.assertLess(stored, stored_full)
+
+    def test_preconditioning(self):
+        for kwargs in (dict(), dict(precondition_mode="inverse"),
+                       dict(packed_factors=True, batched_eigen=False)):
+            with self.subTest(**kwargs):
+                preconditioner = run(diag_blocks={'Conv2d': 3, 'Linear': 2}, **kwargs)
+                for module in preconditioner.modules:
+                    grad = random_grad(module)
+                    expected = reference(preconditioner, module, grad)
+                    result = preconditioner._get_block_preconditioned_grad(module, grad)
+                    self.assertTrue(torch.allclose(result, expected, rtol=1e-3, atol=1e-4))
+
+    def test_int_only_applies_to_conv(self):
+        preconditioner = run(diag_blocks=2)
+        self.assertEqual([preconditioner.m_blocks[m] for m in preconditioner.modules],
+                         [2, 1, 1])
+        self.assertEqual(preconditioner.m_dA[preconditioner.modules[0]].shape, (2, 14))
+
+    def test_diag_warmup(self):
+        for streaming in (False, True):
+            with self.subTest(streaming_factors=streaming):
+                preconditioner = run(steps=3, epochs=[0, 0, 1], diag_blocks=4,
+                                     diag_warmup=1, streaming_factors=streaming)
+                conv = preconditioner.modules[0]
+                self.assertEqual(preconditioner.m_blocks[conv], 4)
+                self.assertEqual(preconditioner.m_A[conv].dim(), 3)
+                self.assertEqual(preconditioner.m_QA[conv].shape, (4, 7, 7))
+                grad = random_grad(conv)
+                expected = reference(preconditioner, conv, grad)
+                result = preconditioner._get_block_preconditioned_grad(conv, grad)
+                self.assertTrue(torch.allclose(result, expected, rtol=1e-3, atol=1e-4))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            run(steps=0, diag_blocks={'Conv2d': 0})
+        with self.assertRaises(ValueError):
+            kfac.KFAC(conv_model(), diag_blocks=2, gradient_clip="KNormal")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+import unittest
+import torch
+import torch.nn as nn
+
+import kfac
+from kfac.utils import conjugate_gradient
+from kfac.tests.helpers import mlp
+
+
+def tiny_model():
+    return mlp(6, 8, 8, 7, 3)
+
+
+def spd(n, cond, generator):
+    Q, _ = torch.linalg.qr(torch.randn(n, n, generator=generator, dtype=torch.float64))
+    return (Q * torch.logspace(0, -torch.log10(torch.tensor(cond)).item(), n,
+                               dtype=torch.float64)) @ Q.t()
+
+
+class TestConjugateGradient(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = torch.Generator().manual_seed(0)
+
+    def systems(self, conds, n=20):
+        F = torch.stack([spd(n, cond, self.generator) for cond in conds])
+        b = torch.randn(len(conds), n, generator=self.generator, dtype=torch.float64)
+        return F, b, lambda v: (F @ v.unsqueeze(-1)).squeeze(-1)
+
+    def test_batched_masked_convergence(self):
+        F, b, fvp = self.systems([2., 1e3, 10.])
+        x, iterations, failed = conjugate_gradient(fvp, b, max_iters=100, tol=1e-12)
+        self.assertFalse(failed.any())
+        self.assertTrue(torch.allclose(x, torch.linalg.solve(F, b), rtol=1e-4, atol=1e-6))
+        # the well conditioned systems stopped early
+        self.assertLess(iterations[0], iterations[1])
+        self.assertLess(iterations[2], iterations[1])
+
+    def test_check_freq(self):
+        F, b, fvp = self.systems([2., 1e3])
+        _, every, _ = conjugate_gradient(fvp, b, max_iters=100, tol=1e-8)
+        _, sparse, _ = conjugate_gradient(fvp, b, max_iters=100, tol=1e-8, check_freq=4)
+        for n, n_sparse in zip(every.tolist(), sparse.tolist()):
+            self.assertEqual(n_sparse, n + (-n) % 4)
+
+    def test_preconditioners(self):
+        F, b, fvp = self.systems([1e4, 1e4])
+        _, plain, _ = conjugate_gradient(fvp, b, max_iters=200, tol=1e-10)
+        # Jacobi on a badly scaled system
+        D = torch.logspace(0, 3, 20, dtype=torch.float64)
+        F_scaled = D[:, None] * F * D[None, :]
+        scaled = lambda v: (F_scaled @ v.unsqueeze(-1)).squeeze(-1)
+        _, cold, _ = conjugate_gradient(scaled, b, max_iters=500, tol=1e-10)
+        diagonal = F_scaled.diagonal(dim1=-2, dim2=-1)
+        _, jacobi, _ = conjugate_gradient(scaled, b, precond=lambda r: r / diagonal,
+                                          max_iters=500, tol=1e-10)
+        self.assertTrue((jacobi < cold).all())
+        # an exact preconditioner converges at once
+        inverse = torch.linalg.inv(F)
+        x, exact, _ = conjugate_gradient(fvp, b, max_iters=200, tol=1e-10,
+                                         precond=lambda r: (inverse @ r.unsqueeze(-1)).squeeze(-1))
+        self.assertEqual(exact.tolist(), [1, 1])
+        self.assertTrue((plain > 1).all())
+
+    def test_warm_start(self):
+        F, b, fvp = self.systems([1e3, 1e3])
+        x, cold, _ = conjugate_gradient(fvp, b, max_iters=100, tol=1e-10)
+        _, warm, _ = conjugate_gradient(fvp, b + 1e-3 * x, x, max_iters=100, tol=1e-10)
+        self.assertTrue((warm < cold).all())
+        # a start worse than zero is replaced by zero
+        _, worse, _ = conjugate_gradient(fvp, b, 1e6 * x, max_iters=100, tol=1e-10)
+        self.assertEqual(worse.tolist(), cold.tolist())
+
+    def test_failure(self):
+        F, b, _ = self.systems([10., 10.])
+        F[1] = -F[1]
+        fvp = lambda v: (F @ v.unsqueeze(-1)).squeeze(-1)
+        x, _, failed = conjugate_gradient(fvp, b, max_iters=50, tol=1e-20)
+        self.assertEqual(failed.tolist(), [False, True])
+        self.assertTrue(torch.allclose(x[0], torch.linalg.solve(F[0], b[0])))
+
+
+class TestCGKFAC(unittest.TestCase):
+
+    def run_kfac(self, steps=3, **kwargs):
+        torch.manual_seed(0)
+        model = tiny_model()
+        preconditioner = kfac.CG_KFAC(model, fac_update_freq=1, kfac_update_freq=2,
+                                      damping=0.01, **kwargs)
+        for _ in range(steps):
+            model.zero_grad()
+            model(torch.randn(16, 6)).pow(2).sum().backward()
+            preconditioner.step()
+        model.zero_grad()
+        model(torch.randn(16, 6)).pow(2).sum().backward()
+        return preconditioner
+
+    def assertSolves(self, preconditioner, tol):
+        updates = {}
+        preconditioner._solve_modules(preconditioner.modules, updates)
+        for module in preconditioner.modules:
+            A = preconditioner.m_A[module]
+            G = preconditioner.m_G[module]
+            grad = preconditioner._get_grad(module)
+            v = torch.cat([updates[module][0], updates[module][1].view(-1, 1)], 1)
+            residual = grad - (G @ v @ A + 0.01 * v)
+            self.assertLessEqual(residual.pow(2).sum(), tol * grad.pow(2).sum())
+
+    def test_solves(self):
+        for precond in (None, 'jacobi', 'eigen'):
+            with self.subTest(precond=precond):
+                preconditioner = self.run_kfac(cg_precond=precond, cg_max_iters=200,
+                                               cg_tol=1e-8, cg_check_freq=3)
+                self.assertSolves(preconditioner, 1e-8)
+                self.assertEqual(preconditioner.n_3, 0)
+
+    def test_eigen_preconditioner(self):
+        # with the factors of the last refresh the K-FAC inverse is exact
+        plain = self.run_kfac(steps=2, cg_max_iters=200, cg_tol=1e-8)
+        eigen = self.run_kfac(steps=2, cg_precond='eigen', cg_max_iters=200, cg_tol=1e-8)
+        for preconditioner in (plain, eigen):
+            preconditioner.nIter = preconditioner.n_1 = 0
+            preconditioner._solve_modules(preconditioner.modules, {})
+        self.assertLess(eigen.nIter, plain.nIter)
+
+    def test_warm_start(self):
+        preconditioner = self.run_kfac(cg_warm_start=True, cg_max_iters=200, cg_tol=1e-8,
+                                       cg_check_freq=1)
+        self.assertEqual(set(preconditioner.last_x0), set(preconditioner.modules))
+        self.assertSolves(preconditioner, 1e-8)
+        # the last solutions solve the same gradients at once
+        preconditioner.nIter = 0
+        preconditioner._solve_modules(preconditioner.modules, {})
+        self.assertEqual(preconditioner.nIter, 0)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            kfac.CG_KFAC(tiny_model(), cg_precond='ilu')
+        with self.assertRaises(ValueError):
+            kfac.CG_KFAC(tiny_model(), cg_check_freq=0)
+
+
+class TestGlobalCG(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def make(self, model, **kwargs):
+        options = dict(fac_update_freq=1, kfac_update_freq=1, damping=0.01,
+                       cg_max_iters=500, cg_tol=1e-12, cg_check_freq=1, cg_mode='global')
+        options.update(kwargs)
+        return kfac.CG_KFAC(model, **options)
+
+    def exact_solve(self, model, modules, x, damping):
+        """(F + damping I)^-1 grad with the empirical Fisher of the
+        per-example gradients of the mean loss"""
+        def flat_grad():
+            return torch.cat([torch.cat([m.weight.grad.reshape(m.weight.size(0), -1),
+                                         m.bias.grad.view(-1, 1)], 1).view(-1)
+                              for m in modules])
+        jacobian = []
+        for example in x:
+            model.zero_grad()
+            model(example.unsqueeze(0)).pow(2).sum().backward()
+            jacobian.append(flat_grad())
+        jacobian = torch.stack(jacobian).double()
+        model.zero_grad()
+        model(x).pow(2).sum(1).mean().backward()
+        fisher = jacobian.t() @ jacobian / len(x)
+        return torch.linalg.solve(fisher + damping * torch.eye(len(fisher), dtype=torch.float64),
+                                  flat_grad().double()).float()
+
+    def global_update(self, preconditioner, modules):
+        updates = {}
+        preconditioner._solve_global(modules, updates)
+        return torch.cat([torch.cat([updates[m][0].reshape(m.weight.size(0), -1),
+                                     updates[m][1].view(-1, 1)], 1).view(-1) for m in modules])
+
+    def test_exact_fisher(self):
+        conv = nn.Sequential(nn.Conv2d(2, 3, 3, padding=1), nn.ReLU(), nn.Flatten(),
+                             nn.Linear(3 * 4 * 4, 3))
+        for model, x in ((tiny_model(), torch.randn(12, 6)),
+                         (conv, torch.randn(5, 2, 4, 4))):
+            with self.subTest(model=type(model[0]).__name__):
+                preconditioner = self.make(model)
+                expected = self.exact_solve(model, preconditioner.modules, x, 0.01)
+                update = self.global_update(preconditioner, preconditioner.modules)
+                self.assertTrue(torch.allclose(update, expected, rtol=1e-3, atol=1e-4))
+                self.assertEqual(preconditioner.n_3, 0)
+
+    def test_layer_groups(self):
+        model = tiny_model()
+        preconditioner = self.make(model, cg_mode={'Linear': 'global', '6': 'module'},
+                                   cg_precond='jacobi')
+        self.assertEqual(preconditioner.global_modules, [model[0], model[2], model[4]])
+        x = torch.randn(12, 6)
+        globals_ = preconditioner.global_modules
+        expected = self.exact_solve(model, globals_, x, 0.01)
+        preconditioner.step()
+        updated = torch.cat([torch.cat([m.weight.grad.reshape(m.weight.size(0), -1),
+                                        m.bias.grad.view(-1, 1)], 1).view(-1)
+                             for m in globals_])
+        self.assertTrue(torch.allclose(updated / preconditioner.nu, expected,
+                                       rtol=1e-3, atol=1e-4))
+
+    def test_budget_and_buffer(self):
+        model = tiny_model()
+        preconditioner = self.make(model, cg_tol=1e-6, cg_max_iters=100, cg_warm_start=True)
+        buffer = None
+        for _ in range(4):
+            model.zero_grad()
+            model(torch.randn(16, 6)).pow(2).sum(1).mean().backward()
+            preconditioner.step()
+            if buffer is None:
+                buffer = preconditioner.cg_buffer.data_ptr()
+        self.assertEqual(preconditioner.cg_buffer.data_ptr(), buffer)
+        self.assertLess(preconditioner.cg_rate, 0)
+        self.assertLess(preconditioner.cg_budget, 100)
+        # the wall-clock cap stops at the first check
+        preconditioner.cg_time_limit = 1e-9
+        preconditioner.cg_check_freq = 2
+        preconditioner.use_last_x0 = False
+        preconditioner.nIter = 0
+        model(torch.randn(16, 6)).pow(2).sum(1).mean().backward()
+        preconditioner.step()
+        self.assertEqual(preconditioner.nIter, 2)
+
+    def test_fresh_statistics(self):
+        model = tiny_model()
+        preconditioner = self.make(model, fac_update_freq=2, kfac_update_freq=2)
+        solved = []
+        solve_global = preconditioner._solve_global
+
+        def record(modules, updates):
+            # the saved inputs are those of the examples of this step
+            solved.append((preconditioner.steps,
+                           torch.equal(preconditioner.m_a[modules[0]], x)))
+            solve_global(modules, updates)
+        preconditioner._solve_global = record
+        for _ in range(5):
+            x = torch.randn(12, 6)
+            model.zero_grad()
+            model(x).pow(2).sum(1).mean().backward()
+            preconditioner.step()
+        self.assertEqual(solved, [(0, True), (2, True), (4, True)])
+        # steps 1 and 3 solved the 4 layers in module mode
+        self.assertEqual(preconditioner.n_1, 3 + 2 * 4)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            kfac.CG_KFAC(tiny_model(), cg_mode={'Linear': 'layer'})
+        with self.assertRaises(ValueError):
+            kfac.CG_KFAC(tiny_model(), cg_time_limit=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
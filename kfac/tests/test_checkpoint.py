@@ -0,0 +1,123 @@
+import io
+import unittest
+import torch
+
+import kfac
+from kfac.tests.helpers import conv_model
+
+
+def tiny_model(hidden=8):
+    return conv_model((hidden,))
+
+
+def roundtrip(state):
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    buffer.seek(0)
+    return torch.load(buffer)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.data = [torch.randn(8, 3, 6, 6) for _ in range(6)]
+
+    def make(self, model=None, cls=kfac.KFAC, **kwargs):
+        model = model if model is not None else tiny_model()
+        options = dict(fac_update_freq=1, kfac_update_freq=3, gradient_clip="kl",
+                       kl_clip=1e6)
+        options.update(kwargs)
+        return model, cls(model, **options)
+
+    def train(self, model, preconditioner, data):
+        grads = []
+        for x in data:
+            model.zero_grad()
+            model(x).pow(2).sum(1).mean().backward()
+            preconditioner.step()
+            grads.append([p.grad.clone() for p in model.parameters()])
+        return grads
+
+    def assertResumes(self, cls=kfac.KFAC, **kwargs):
+        torch.manual_seed(0)
+        model, preconditioner = self.make(cls=cls, **kwargs)
+        initial = {k: v.clone() for k, v in model.state_dict().items()}
+        self.train(model, preconditioner, self.data[:4])
+        state = roundtrip(preconditioner.state_dict())
+        reference = self.train(model, preconditioner, self.data[4:])
+
+        # resumed preconditioner on a fresh copy of the model
+        resumed_model = tiny_model()
+        resumed_model.load_state_dict(initial)
+        _, resumed = self.make(resumed_model, cls=cls, **kwargs)
+        resumed.load_state_dict(state)
+        self.assertEqual(resumed.steps, 4)
+        grads = self.train(resumed_model, resumed, self.data[4:])
+        for step_ref, step in zip(reference, grads):
+            for g_ref, g in zip(step_ref, step):
+                self.assertTrue(torch.allclose(g_ref, g, atol=1e-6))
+        return resumed
+
+    def test_resume(self):
+        for mode in ('eigen', 'inverse'):
+            with self.subTest(mode=mode):
+                self.assertResumes(precondition_mode=mode)
+        self.assertResumes(diag_blocks={'Linear': 2})
+        self.assertResumes(cls=kfac.EKFAC)
+
+    def test_factors_only(self):
+        model, preconditioner = self.make()
+        # the last step refreshed the eigendecompositions of its factors
+        self.train(model, preconditioner, self.data[:4])
+        state = roundtrip(preconditioner.state_dict(factors_only=True))
+        self.assertNotIn('QA', next(iter(state['modules'].values())))
+        _, restored = self.make(tiny_model())
+        restored.load_state_dict(state)
+        for module, original in zip(restored.modules, preconditioner.modules):
+            for name in ('m_A', 'm_G', 'm_dA', 'm_dG'):
+                self.assertTrue(torch.allclose(getattr(restored, name)[module],
+                                               getattr(preconditioner, name)[original],
+                                               atol=1e-5))
+
+    def test_warm_start(self):
+        # the layers of the other width do not fit and keep no factors
+        model, preconditioner = self.make(tiny_model(hidden=16))
+        self.train(model, preconditioner, self.data[:2])
+        state = roundtrip(preconditioner.state_dict())
+        warm_model, warm = self.make(tiny_model(), damping=0.01)
+        warm.load_state_dict(state, warm_start=True)
+        self.assertEqual((warm.steps, warm.damping), (0, 0.01))
+        first = warm.modules[0]
+        self.assertTrue(torch.allclose(warm.m_A[first], preconditioner.m_A[preconditioner.modules[0]]))
+        self.assertEqual(set(warm.m_A), {first})
+        self.train(warm_model, warm, self.data[2:4])
+        self.assertEqual(set(warm.m_A), set(warm.modules))
+
+    def test_strict(self):
+        model, preconditioner = self.make(tiny_model(hidden=16))
+        self.train(model, preconditioner, self.data[:1])
+        state = preconditioner.state_dict()
+        with self.assertRaises(ValueError):
+            self.make(tiny_model())[1].load_state_dict(state)
+        del state['modules']['0']
+        with self.assertRaises(ValueError):
+            self.make(tiny_model(hidden=16))[1].load_state_dict(state)
+
+    def test_scheduler(self):
+        _, preconditioner = self.make()
+        scheduler = kfac.KFACParamScheduler(preconditioner, damping_alpha=0.5,
+                                            damping_schedule=[2])
+        for epoch in range(3):
+            scheduler.step(epoch)
+        _, other = self.make()
+        resumed = kfac.KFACParamScheduler(other, damping_alpha=0.5, damping_schedule=[2])
+        resumed.load_state_dict(roundtrip(scheduler.state_dict()))
+        resumed.step()
+        self.assertEqual(resumed.epoch, 3)
+        self.assertEqual(other.param_groups[0]['damping'],
+                         preconditioner.param_groups[0]['damping'])
+
+
+if __name__ == '__main__':
+    unittest.main()
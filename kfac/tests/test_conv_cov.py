@@ -0,0 +1,75 @@
+import unittest
+import torch
+import torch.nn as nn
+
+import kfac
+from kfac.tests.helpers import conv_model
+from kfac.utils import ComputeA
+
+
+class TestConvCovariance(unittest.TestCase):
+
+    layers = [
+        nn.Conv2d(3, 4, kernel_size=3, padding=1),
+        nn.Conv2d(3, 4, kernel_size=3, padding=1, bias=False),
+        nn.Conv2d(3, 5, kernel_size=3, stride=2, padding=1),
+        nn.Conv2d(3, 2, kernel_size=(3, 1), stride=(1, 2), padding=(1, 0)),
+        nn.Conv2d(3, 2, kernel_size=1),
+    ]
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.x = torch.randn(5, 3, 9, 7)
+
+    def test_exact_mode_matches(self):
+        for layer in self.layers:
+            reference = ComputeA()(self.x.clone(), layer)
+            for budget in (1, 200, 4096, 10**9):
+                cov = ComputeA(patch_budget=budget)(self.x.clone(), layer)
+                self.assertEqual(cov.shape, reference.shape)
+                self.assertTrue(torch.allclose(cov, reference, rtol=1e-5, atol=1e-7),
+                                "{} budget={}".format(layer, budget))
+
+    def test_full_subsample_matches(self):
+        layer = self.layers[0]
+        reference = ComputeA()(self.x.clone(), layer)
+        cov = ComputeA(patch_subsample=1.0)(self.x.clone(), layer)
+        self.assertTrue(torch.allclose(cov, reference, rtol=1e-5, atol=1e-7))
+
+    def test_subsample_is_unbiased(self):
+        layer = self.layers[0]
+        reference = ComputeA()(self.x.clone(), layer)
+        compute = ComputeA(patch_budget=512, patch_subsample=0.25)
+        mean = sum(compute(self.x.clone(), layer) for _ in range(400)) / 400
+        self.assertLess((mean - reference).norm() / reference.norm(), 0.05)
+
+    def test_subsample_generator(self):
+        layer = self.layers[0]
+        compute = ComputeA(patch_subsample=0.25)
+        state = torch.get_rng_state()
+        covs = [compute(self.x.clone(), layer, generator=torch.Generator().manual_seed(seed))
+                for seed in (3, 3, 4)]
+        self.assertTrue(torch.equal(torch.get_rng_state(), state))
+        self.assertTrue(torch.equal(covs[0], covs[1]))
+        self.assertFalse(torch.equal(covs[0], covs[2]))
+
+    def test_kfac_keeps_global_rng(self):
+        for streaming in (False, True):
+            with self.subTest(streaming=streaming):
+                model = conv_model()
+                preconditioner = kfac.KFAC(model, fac_update_freq=1, kfac_update_freq=1,
+                                           patch_subsample=0.5, streaming_factors=streaming)
+                state = torch.get_rng_state()
+                model(self.x[:, :, :6, :6]).pow(2).sum().backward()
+                preconditioner.step()
+                self.assertTrue(torch.equal(torch.get_rng_state(), state))
+
+    def test_input_is_untouched(self):
+        layer = self.layers[2]
+        x = self.x.clone()
+        ComputeA(patch_budget=256)(x, layer)
+        self.assertTrue(torch.equal(x, self.x))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import kfac
+from kfac.tests.helpers import conv_model
+
+WORLD_SIZE = 3
+STEPS = 3
+CONFIGS = [
+    dict(distribute_layer_factors=False),
+    dict(distribute_layer_factors=True),
+    dict(distribute_layer_factors=True, batched_eigen=False, diag_blocks=2),
+    dict(distribute_layer_factors=True, precondition_mode="inverse"),
+    dict(distribute_layer_factors=False, packed_factors=True),
+    dict(distribute_layer_factors=True, async_eigen=True, max_staleness=1),
+    dict(distribute_layer_factors=True, refresh_drift=0.05),
+    dict(distribute_layer_factors=True, low_rank=4, low_rank_min_dim=20),
+]
+
+
+def train(config, rank=0, size=1, comm=None):
+    """Run a few KFAC steps on shard `rank` of a fixed batch"""
+    torch.manual_seed(0)
+    model = conv_model((12, 12))
+    preconditioner = kfac.KFAC(model, fac_update_freq=1, kfac_update_freq=1,
+                               gradient_clip="kl", comm=comm, **config)
+    for step in range(STEPS):
+        generator = torch.Generator().manual_seed(step)
+        data = torch.randn(4 * WORLD_SIZE, 3, 6, 6, generator=generator)
+        data = data.chunk(size)[rank]
+        model.zero_grad()
+        model(data).pow(2).mean().backward()
+        for p in model.parameters():
+            if size > 1:
+                dist.all_reduce(p.grad)
+                p.grad.div_(size)
+        preconditioner.step()
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(p.grad, alpha=-0.1)
+
+    result = {'params': [p.detach().clone() for p in model.parameters()]}
+    for name in ('m_A', 'm_G', 'm_QA', 'm_dA', 'm_iA', 'm_iG'):
+        factors = getattr(preconditioner, name)
+        result[name] = [factors[m].clone() for m in preconditioner.modules
+                        if m in factors]
+    return result
+
+
+def _worker(rank, size, init_file, out_dir):
+    dist.init_process_group('gloo', init_method='file://' + init_file,
+                            rank=rank, world_size=size)
+    results = [train(config, rank, size) for config in CONFIGS]
+    torch.save(results, os.path.join(out_dir, 'rank{}.pt'.format(rank)))
+    dist.destroy_process_group()
+
+
+class TestTorchDistributed(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        init_file = os.path.join(cls.tmp.name, 'init')
+        mp.spawn(_worker, args=(WORLD_SIZE, init_file, cls.tmp.name),
+                 nprocs=WORLD_SIZE, join=True)
+        cls.results = [torch.load(os.path.join(cls.tmp.name, 'rank{}.pt'.format(r)))
+                       for r in range(WORLD_SIZE)]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_matches_single_process(self):
+        for i, config in enumerate(CONFIGS):
+            serial = train(config, comm=kfac.Comm())
+            for rank in range(WORLD_SIZE):
+                distributed = self.results[rank][i]
+                for name in ('m_A', 'm_G', 'params'):
+                    for a, b in zip(serial[name], distributed[name]):
+                        self.assertTrue(torch.allclose(a, b, rtol=1e-4, atol=1e-6),
+                                        "{} differs for {}".format(name, config))
+
+    def test_ranks_share_results(self):
+        for i, config in enumerate(CONFIGS):
+            for name in ('m_QA', 'm_dA', 'm_iA', 'm_iG', 'params'):
+                for rank in range(1, WORLD_SIZE):
+                    for a, b in zip(self.results[0][i][name], self.results[rank][i][name]):
+                        self.assertTrue(torch.equal(a, b),
+                                        "{} differs for {}".format(name, config))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import torch
+
+import kfac
+from kfac.tests.helpers import conv_model
+
+
+def prepare(batched_eigen):
+    torch.manual_seed(0)
+    model = conv_model((10, 10), convs=2)
+    preconditioner = kfac.KFAC(model, distribute_layer_factors=False,
+                               batched_eigen=batched_eigen)
+    data = torch.randn(8, 3, 6, 6)
+    model(data).pow(2).sum().backward()
+    preconditioner._update_A()
+    preconditioner._update_G()
+    preconditioner._update_eigen(1)
+    return preconditioner
+
+
+class TestBatchedEigen(unittest.TestCase):
+
+    def test_matches_per_module(self):
+        serial = prepare(batched_eigen=False)
+        batched = prepare(batched_eigen=True)
+        self.assertIsNone(batched._eigen_buckets)
+        for m_s, m_b in zip(serial.modules, batched.modules):
+            for Q, d in (('m_QA', 'm_dA'), ('m_QG', 'm_dG')):
+                Qs, ds = getattr(serial, Q)[m_s], getattr(serial, d)[m_s]
+                Qb, db = getattr(batched, Q)[m_b], getattr(batched, d)[m_b]
+                self.assertTrue(torch.allclose(ds, db, atol=1e-5))
+                self.assertTrue(torch.allclose(Qs @ torch.diag(ds) @ Qs.t(),
+                                               Qb @ torch.diag(db) @ Qb.t(),
+                                               atol=1e-5))
+
+    def test_reconstructs_factor(self):
+        preconditioner = prepare(batched_eigen=True)
+        for module in preconditioner.modules:
+            A = preconditioner.m_A[module]
+            Q, d = preconditioner.m_QA[module], preconditioner.m_dA[module]
+            self.assertTrue(torch.allclose(Q @ torch.diag(d) @ Q.t(), A,
+                                           atol=1e-4))
+
+    def test_step(self):
+        torch.manual_seed(0)
+        model = conv_model((10, 10), convs=2)
+        preconditioner = kfac.KFAC(model, distribute_layer_factors=False,
+                                   kfac_update_freq=1, fac_update_freq=1,
+                                   gradient_clip="kl")
+        for _ in range(2):
+            model.zero_grad()
+            model(torch.randn(8, 3, 6, 6)).pow(2).sum().backward()
+            preconditioner.step()
+        for p in model.parameters():
+            self.assertTrue(torch.isfinite(p.grad).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+import torch
+import torch.nn as nn
+
+import kfac
+from kfac.comm import Comm
+from kfac.tests.helpers import conv_model
+
+
+def per_example_grads(model, data):
+    """Formatted (weight | bias) gradients of each layer for each example
+
+    The loss is the batch mean, so the per-example gradients are those of
+    the example loss, i.e. batch size times its share of the batch gradient.
+    """
+    layers = [m for m in model if isinstance(m, (nn.Linear, nn.Conv2d))]
+    grads = {m: [] for m in layers}
+    for x in data:
+        model.zero_grad()
+        model(x[None]).pow(2).sum().backward()
+        for m in layers:
+            grads[m].append(torch.cat([m.weight.grad.view(m.weight.size(0), -1),
+                                       m.bias.grad.view(-1, 1)], 1))
+    return {m: torch.stack(g) for m, g in grads.items()}
+
+
+class RecordingComm(Comm):
+    """Single process comm recording the tensors of every allreduce"""
+
+    def __init__(self):
+        self.allreduces = []
+
+    def allreduce_async_(self, tensors, average=True):
+        self.allreduces.append([t.shape for t in tensors])
+        return []
+
+
+class TestEKFAC(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = conv_model((8,))
+        self.data = torch.randn(8, 3, 6, 6)
+
+    def step(self, preconditioner, data):
+        self.model.zero_grad()
+        self.model(data).pow(2).sum(1).mean().backward()
+        preconditioner.step()
+
+    def test_scale_matches_per_example_gradients(self):
+        preconditioner = kfac.EKFAC(self.model, fac_update_freq=1, kfac_update_freq=1,
+                                    gradient_clip="kl")
+        self.step(preconditioner, self.data)
+        examples = per_example_grads(self.model, self.data)
+        for module in preconditioner.modules:
+            QG, QA = preconditioner.m_QG[module], preconditioner.m_QA[module]
+            expected = (QG.t() @ examples[module] @ QA).pow(2).mean(0)
+            self.assertTrue(torch.allclose(preconditioner.m_S[module], expected,
+                                           rtol=1e-4, atol=1e-7))
+
+    def test_preconditioned_gradient(self):
+        preconditioner = kfac.EKFAC(self.model, fac_update_freq=1, kfac_update_freq=1,
+                                    gradient_clip="kl", kl_clip=1e6)
+        self.model.zero_grad()
+        self.model(self.data).pow(2).sum(1).mean().backward()
+        module = preconditioner.modules[0]
+        grad = preconditioner._get_grad(module).clone()
+        preconditioner.step()
+        examples = per_example_grads(self.model, self.data)
+        QG, QA = preconditioner.m_QG[module], preconditioner.m_QA[module]
+        S = (QG.t() @ examples[module] @ QA).pow(2).mean(0)
+        expected = QG @ ((QG.t() @ grad @ QA) / (S + preconditioner.damping)) @ QA.t()
+        self.model.zero_grad()
+        self.model(self.data).pow(2).sum(1).mean().backward()
+        v = preconditioner._get_preconditioned_grad(module, grad)
+        self.assertTrue(torch.allclose(torch.cat([v[0].view(4, -1), v[1].view(-1, 1)], 1),
+                                       expected, rtol=1e-3, atol=1e-5))
+
+    def test_running_average_between_refreshes(self):
+        preconditioner = kfac.EKFAC(self.model, fac_update_freq=1, kfac_update_freq=3,
+                                    factor_decay=0.9, gradient_clip="kl")
+        second = torch.randn(8, 3, 6, 6)
+        self.step(preconditioner, self.data)
+        module = preconditioner.modules[-1]
+        first_scale = preconditioner.m_S[module].clone()
+        # the refresh resets the scale, a step without refresh averages it
+        self.step(preconditioner, second)
+        examples = per_example_grads(self.model, second)
+        QG, QA = preconditioner.m_QG[module], preconditioner.m_QA[module]
+        new = (QG.t() @ examples[module] @ QA).pow(2).mean(0)
+        self.assertTrue(torch.allclose(preconditioner.m_S[module],
+                                       0.9 * first_scale + 0.1 * new, rtol=1e-4, atol=1e-7))
+
+    def test_training_drop_in(self):
+        preconditioner = kfac.EKFAC(self.model, lr=0.1, fac_update_freq=2,
+                                    kfac_update_freq=4, gradient_clip="kl")
+        optimizer = torch.optim.SGD(self.model.parameters(), lr=0.1)
+        target = torch.randn(8, 5)
+        losses = []
+        for _ in range(20):
+            self.model.zero_grad()
+            loss = (self.model(self.data) - target).pow(2).mean()
+            loss.backward()
+            preconditioner.step()
+            optimizer.step()
+            losses.append(loss.item())
+        self.assertLess(losses[-1], losses[0])
+
+    def test_scales_allreduced_together(self):
+        preconditioner = kfac.EKFAC(self.model, fac_update_freq=1, kfac_update_freq=1,
+                                    gradient_clip="kl")
+        preconditioner.comm = RecordingComm()
+        preconditioner.comm_size = 2
+        self.step(preconditioner, self.data)
+        scales = [preconditioner.m_S[m].shape for m in preconditioner.modules]
+        self.assertEqual(preconditioner.comm.allreduces.count(scales), 1)
+
+    def test_positional_arguments(self):
+        preconditioner = kfac.EKFAC(self.model, 0.2, 0.9)
+        self.assertEqual(preconditioner.param_groups[0]['lr'], 0.2)
+        self.assertEqual(preconditioner.factor_decay, 0.9)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            kfac.EKFAC(self.model, precondition_mode="inverse")
+        with self.assertRaises(ValueError):
+            kfac.EKFAC(self.model, 0.1, 0.95, 0.001, 0.001, 10, 100, True, 2)
+        with self.assertRaises(ValueError):
+            kfac.EKFAC(self.model, diag_blocks=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
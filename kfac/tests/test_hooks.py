@@ -0,0 +1,100 @@
+import unittest
+import torch
+import torch.nn as nn
+
+import kfac
+from kfac.tests.helpers import mlp
+
+
+def tiny_model(inplace=False):
+    return mlp(6, 8, 3, inplace=inplace)
+
+
+def grads_of_outputs(model, data):
+    """Inputs and gradients w.r.t. the outputs of the Linear layers"""
+    inputs, outputs = {}, {}
+
+    def save(module, input, output):
+        inputs[module] = input[0]
+        output.retain_grad()
+        outputs[module] = output
+
+    handles = [m.register_forward_hook(save) for m in model if isinstance(m, nn.Linear)]
+    model(data).pow(2).sum().backward()
+    for handle in handles:
+        handle.remove()
+    return inputs, {m: o.grad for m, o in outputs.items()}
+
+
+class TestHooks(unittest.TestCase):
+
+    def test_hooks_only_on_factor_steps(self):
+        model = tiny_model()
+        preconditioner = kfac.KFAC(model, fac_update_freq=3, kfac_update_freq=3,
+                                   gradient_clip="kl")
+        attached = []
+        for _ in range(7):
+            attached.append(all(len(m._forward_hooks) == 1 for m in preconditioner.modules))
+            model.zero_grad()
+            model(torch.randn(4, 6)).sum().backward()
+            preconditioner.step()
+        self.assertEqual(attached, [True, False, False, True, False, False, True])
+        for module in preconditioner.modules:
+            self.assertEqual(len(module._backward_hooks), 0)
+            self.assertEqual(len(module._forward_pre_hooks), 0)
+
+    def test_scheduled_frequency(self):
+        model = tiny_model()
+        preconditioner = kfac.KFAC(model, fac_update_freq=2, kfac_update_freq=4,
+                                   gradient_clip="kl")
+        scheduler = kfac.KFACParamScheduler(preconditioner, update_freq_alpha=1.5,
+                                            update_freq_schedule=[1])
+        updated = []
+        update_A = preconditioner._update_A
+        preconditioner._update_A = lambda: (updated.append(preconditioner.steps), update_A())
+        for step in range(9):
+            if step == 3:
+                # 2 -> 3: step 3 becomes a factor step
+                scheduler.step(1)
+            model.zero_grad()
+            model(torch.randn(4, 6)).sum().backward()
+            preconditioner.step()
+        self.assertEqual(updated, [0, 2, 3, 6])
+
+        # set directly in the param group, the hooks follow from the next step
+        # and the statistics gathered for step 9 are dropped
+        preconditioner.param_groups[0]['fac_update_freq'] = 2
+        model(torch.randn(4, 6)).sum().backward()
+        preconditioner.step()
+        self.assertEqual(updated, [0, 2, 3, 6])
+        self.assertEqual(preconditioner.m_a, {})
+        model(torch.randn(4, 6)).sum().backward()
+        preconditioner.step()
+        self.assertEqual(updated, [0, 2, 3, 6, 10])
+
+    def test_saved_statistics(self):
+        for inplace in (False, True):
+            with self.subTest(inplace=inplace):
+                torch.manual_seed(0)
+                model = tiny_model(inplace)
+                data = torch.randn(4, 6)
+                reference = tiny_model()
+                reference.load_state_dict(model.state_dict())
+                inputs, grads = grads_of_outputs(reference, data)
+
+                preconditioner = kfac.KFAC(model, gradient_clip="kl")
+                model(data).pow(2).sum().backward()
+                for module, module_ref in zip(preconditioner.modules, inputs):
+                    self.assertTrue(torch.equal(preconditioner.m_a[module], inputs[module_ref]))
+                    self.assertTrue(torch.allclose(preconditioner.m_g[module], grads[module_ref]))
+
+    def test_no_grad_forward(self):
+        model = tiny_model()
+        preconditioner = kfac.KFAC(model, gradient_clip="kl")
+        with torch.no_grad():
+            model(torch.randn(4, 6))
+        self.assertEqual(preconditioner.m_a, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import math
+import unittest
+import torch
+
+import kfac
+from kfac.tests.helpers import conv_model
+
+
+def prepare(**kwargs):
+    torch.manual_seed(0)
+    model = conv_model((10,))
+    preconditioner = kfac.KFAC(model, distribute_layer_factors=False,
+                               damping=0.01, precondition_mode="inverse",
+                               **kwargs)
+    model(torch.randn(8, 3, 6, 6)).pow(2).sum().backward()
+    preconditioner.damping = 0.01
+    preconditioner._update_A()
+    preconditioner._update_G()
+    preconditioner._update_inverse()
+    return preconditioner
+
+
+class TestInversePreconditioner(unittest.TestCase):
+
+    def check_inverse(self, preconditioner, pi_of):
+        damping = math.sqrt(preconditioner.damping)
+        for module in preconditioner.modules:
+            A, G = preconditioner.m_A[module], preconditioner.m_G[module]
+            pi = pi_of(A, G)
+            iA = torch.inverse(A + damping * pi * torch.eye(A.shape[0]))
+            iG = torch.inverse(G + damping / pi * torch.eye(G.shape[0]))
+            grad = preconditioner._get_grad(module)
+            v = preconditioner._get_preconditioned_grad(module, grad)
+            v = torch.cat([v[0].view(grad.shape[0], -1), v[1].view(-1, 1)], 1)
+            self.assertTrue(torch.allclose(v, iG @ grad @ iA, rtol=1e-3,
+                                           atol=1e-5))
+            self.assertNotIn(module, preconditioner.m_QA)
+
+    def test_matches_explicit_inverse(self):
+        self.check_inverse(prepare(), lambda A, G: 1.0)
+
+    def test_unbatched(self):
+        self.check_inverse(prepare(batched_eigen=False), lambda A, G: 1.0)
+
+    def test_factored_damping(self):
+        def pi_of(A, G):
+            return math.sqrt((torch.trace(A).item() / A.shape[0]) /
+                             (torch.trace(G).item() / G.shape[0]))
+        self.check_inverse(prepare(factored_damping=True), pi_of)
+
+    def test_step(self):
+        torch.manual_seed(0)
+        model = conv_model((10,))
+        preconditioner = kfac.KFAC(model, distribute_layer_factors=False,
+                                   kfac_update_freq=1, fac_update_freq=1,
+                                   precondition_mode="inverse",
+                                   gradient_clip="kl")
+        for _ in range(2):
+            model.zero_grad()
+            model(torch.randn(8, 3, 6, 6)).pow(2).sum().backward()
+            preconditioner.step()
+        for p in model.parameters():
+            self.assertTrue(torch.isfinite(p.grad).all())
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            kfac.KFAC(conv_model((10,)), distribute_layer_factors=False,
+                      precondition_mode="cholesky")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import io
+import unittest
+import torch
+import torch.nn as nn
+
+import kfac
+from kfac.utils import RecurrentWeights, recurrent_forward
+
+
+class Language(nn.Module):
+    """Embedding -> LSTM/GRU -> LayerNorm -> Linear decoder"""
+    def __init__(self, rnn=nn.LSTM, tokens=7, size=4, layers=2, tied=False):
+        super(Language, self).__init__()
+        self.encoder = nn.Embedding(tokens, size)
+        self.rnn = rnn(size, size, layers, batch_first=True)
+        self.norm = nn.LayerNorm(size)
+        self.decoder = nn.Linear(size, tokens)
+        if tied:
+            self.decoder.weight = self.encoder.weight
+
+    def forward(self, x, hidden=None):
+        output, _ = self.rnn(self.encoder(x), hidden)
+        return self.decoder(self.norm(output))
+
+
+def loss_of(model, x, *args):
+    """Mean squared output over all tokens"""
+    return model(x, *args).pow(2).sum(-1).mean()
+
+
+def formatted_grad(module):
+    """(weight | bias) gradient as preconditioned by K-FAC"""
+    grad = module.weight.grad.view(module.weight.size(0), -1)
+    if module.bias is not None:
+        grad = torch.cat([grad, module.bias.grad.view(-1, 1)], 1)
+    return grad
+
+
+class TestLayers(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def make(self, model, **kwargs):
+        options = dict(fac_update_freq=1, kfac_update_freq=1, gradient_clip="kl",
+                       kl_clip=1e6)
+        options.update(kwargs)
+        return kfac.KFAC(model, **options)
+
+    def factors(self, preconditioner, module):
+        """Factors of the statistics saved by the hooks for the last pass"""
+        a = preconditioner.computeA(preconditioner.m_a[module], module)
+        g = preconditioner.computeG(preconditioner.m_g[module], module, True)
+        return a, g
+
+    def test_registration(self):
+        model = Language()
+        preconditioner = self.make(model)
+        self.assertEqual([preconditioner.module_names[m] for m in preconditioner.modules],
+                         ['rnn.weight_ih_l0', 'rnn.weight_hh_l0', 'rnn.weight_ih_l1',
+                          'rnn.weight_hh_l1', 'decoder'])
+        self.assertEqual(preconditioner.diag_modules, [model.encoder, model.norm])
+        # the tied embedding is left to the decoder
+        preconditioner = self.make(Language(tied=True))
+        self.assertEqual(len(preconditioner.diag_modules), 1)
+        preconditioner = self.make(Language(), exclude_modules=['rnn.weight_hh_l1', 'norm'])
+        self.assertEqual(len(preconditioner.modules), 4)
+        self.assertEqual(len(preconditioner.diag_modules), 1)
+
+    def test_unrolled_forward(self):
+        for rnn in (nn.LSTM, nn.GRU):
+            with self.subTest(rnn=rnn.__name__):
+                module = rnn(3, 5, num_layers=2, batch_first=True)
+                x = torch.randn(2, 6, 3)
+                h = torch.randn(2, 2, 5)
+                hx = (h, torch.randn_like(h)) if rnn is nn.LSTM else h
+                expected = module(x, hx)
+                output = recurrent_forward(module, x, hx)
+                self.assertTrue(torch.allclose(output[0], expected[0], atol=1e-6))
+                for state, state_ref in zip(output[1], expected[1]):
+                    self.assertTrue(torch.allclose(state, state_ref, atol=1e-6))
+
+    def test_recurrent_statistics(self):
+        # summed over the timesteps and sequences, the saved inputs and gate
+        # gradients give the weight gradients
+        for rnn in (nn.LSTM, nn.GRU):
+            with self.subTest(rnn=rnn.__name__):
+                model = Language(rnn)
+                preconditioner = self.make(model)
+                loss_of(model, torch.randint(7, (3, 5))).backward()
+                for module in preconditioner.modules[:-1]:
+                    a = preconditioner.m_a[module]
+                    g = preconditioner.m_g[module]
+                    self.assertEqual(a.shape[:2], (5, 3))
+                    a = torch.cat([a, a.new_ones(*a.shape[:2], 1)], 2)
+                    grad = torch.einsum('tbo,tbi->oi', g, a)
+                    self.assertTrue(torch.allclose(grad, formatted_grad(module), atol=1e-6))
+                    # factors pooled over all timesteps of all sequences
+                    A, G = self.factors(preconditioner, module)
+                    rows = a.reshape(-1, a.size(-1))
+                    self.assertTrue(torch.allclose(A, rows.t() @ rows / 15, atol=1e-6))
+
+    def test_recurrent_fisher_block(self):
+        # for one example of one timestep A (x) G is the Fisher block
+        for rnn in (nn.LSTM, nn.GRU):
+            with self.subTest(rnn=rnn.__name__):
+                model = Language(rnn)
+                preconditioner = self.make(model)
+                hidden = torch.randn(2, 1, 4)
+                hidden = (hidden, torch.randn_like(hidden)) if rnn is nn.LSTM else hidden
+                loss_of(model, torch.tensor([[3]]), hidden).backward()
+                for module in preconditioner.modules:
+                    A, G = self.factors(preconditioner, module)
+                    grad = formatted_grad(module).reshape(-1)
+                    self.assertTrue(torch.allclose(torch.kron(G, A), torch.outer(grad, grad),
+                                                   atol=1e-6))
+
+    def test_embedding_fisher_block(self):
+        model = Language()
+        preconditioner = self.make(model)
+        loss_of(model, torch.tensor([[2]])).backward()
+        A, G = self.factors(preconditioner, model.encoder)
+        self.assertTrue(torch.equal(A, torch.eye(7)[2]))
+        grad = model.encoder.weight.grad.reshape(-1)
+        self.assertTrue(torch.allclose(torch.kron(torch.diag(A), G), torch.outer(grad, grad),
+                                       atol=1e-7))
+
+        # token frequencies of a batch
+        x = torch.tensor([[1, 1, 4], [0, 1, 6]])
+        model.zero_grad()
+        loss_of(model, x).backward()
+        A, _ = self.factors(preconditioner, model.encoder)
+        self.assertTrue(torch.allclose(A, torch.bincount(x.view(-1), minlength=7) / 6.))
+
+    def test_layer_norm_fisher_diagonal(self):
+        model = Language()
+        preconditioner = self.make(model)
+        x = torch.randint(7, (3, 5))
+        loss_of(model, x).backward()
+        norm = model.norm
+        D = preconditioner.computeG.layer_norm(
+                preconditioner.m_g[norm], norm, True,
+                preconditioner.computeA(preconditioner.m_a[norm], norm))
+        # per token gradients: the loss is the mean of 15 token losses
+        features = model.rnn(model.encoder(x))[0].detach().reshape(15, 4)
+        per_token = []
+        for row in features:
+            model.zero_grad()
+            model.decoder(norm(row)).pow(2).sum().backward()
+            per_token.append(torch.stack([norm.weight.grad, norm.bias.grad]))
+        self.assertTrue(torch.allclose(D, torch.stack(per_token).pow(2).mean(0), atol=1e-5))
+
+    def test_preconditioned_gradients(self):
+        model = Language()
+        preconditioner = self.make(model, damping=0.01)
+        x = torch.randint(7, (3, 5))
+        loss_of(model, x).backward()
+        grads = {m: m.weight.grad.clone() for m in preconditioner.diag_modules}
+        bias = model.norm.bias.grad.clone()
+        preconditioner.step()
+
+        D = preconditioner.m_D[model.norm]
+        self.assertTrue(torch.allclose(model.norm.weight.grad, grads[model.norm] / (D[0] + 0.01)))
+        self.assertTrue(torch.allclose(model.norm.bias.grad, bias / (D[1] + 0.01)))
+
+        # diag(A) (x) G + damping solved explicitly
+        encoder = model.encoder
+        fisher = torch.kron(torch.diag(preconditioner.m_D[encoder]), preconditioner.m_G[encoder])
+        expected = torch.linalg.solve(fisher + 0.01 * torch.eye(28), grads[encoder].view(-1))
+        self.assertTrue(torch.allclose(encoder.weight.grad.view(-1), expected, atol=1e-5))
+
+    def test_modes_and_training(self):
+        target = torch.randint(7, (4, 5))
+        for mode in ('eigen', 'inverse', 'newton'):
+            for rnn in (nn.LSTM, nn.GRU):
+                with self.subTest(mode=mode, rnn=rnn.__name__):
+                    torch.manual_seed(0)
+                    model = Language(rnn)
+                    preconditioner = self.make(model, lr=0.1, fac_update_freq=2,
+                                               kfac_update_freq=4, precondition_mode=mode,
+                                               streaming_factors=mode == 'inverse')
+                    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+                    losses = []
+                    for _ in range(12):
+                        model.zero_grad()
+                        loss = nn.functional.cross_entropy(model(target).view(-1, 7),
+                                                           target.view(-1))
+                        loss.backward()
+                        preconditioner.step()
+                        optimizer.step()
+                        losses.append(loss.item())
+                    self.assertLess(losses[-1], losses[0])
+                    # the unrolled forward is only used on factor update steps
+                    self.assertEqual(len(model.rnn._forward_hooks), 1)
+
+    def test_checkpoint(self):
+        model = Language()
+        preconditioner = self.make(model)
+        loss_of(model, torch.randint(7, (3, 5))).backward()
+        preconditioner.step()
+        buffer = io.BytesIO()
+        torch.save(preconditioner.state_dict(), buffer)
+        buffer.seek(0)
+        restored = self.make(Language())
+        restored.load_state_dict(torch.load(buffer))
+        for module, original in zip(restored.diag_modules, preconditioner.diag_modules):
+            self.assertTrue(torch.equal(restored.m_D[module], preconditioner.m_D[original]))
+        self.assertTrue(torch.equal(restored.m_QG[restored.diag_modules[0]],
+                                    preconditioner.m_QG[model.encoder]))
+
+
+if __name__ == '__main__':
+    unittest.main()
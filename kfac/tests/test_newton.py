@@ -0,0 +1,104 @@
+import math
+import unittest
+import torch
+
+import kfac
+from kfac.utils import inverse_root
+from kfac.tests.helpers import mlp, run_kfac
+
+
+def ill_conditioned(n, cond, generator):
+    """Symmetric PSD matrix with eigenvalues log-spaced from 1 to 1/cond"""
+    Q, _ = torch.linalg.qr(torch.randn(n, n, generator=generator, dtype=torch.float64))
+    return ((Q * torch.logspace(0, -math.log10(cond), n, dtype=torch.float64)) @ Q.t()).float()
+
+
+def eigh_root(factor, d, p):
+    evalues, evectors = torch.linalg.eigh(factor.double())
+    return (evectors * (evalues + d).pow(-1. / p)) @ evectors.t()
+
+
+def relative_error(x, reference):
+    return ((x.double() - reference).norm() / reference.norm()).item()
+
+
+def tiny_model():
+    return mlp(6, 8, 3)
+
+
+class TestNewton(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = torch.Generator().manual_seed(0)
+
+    def test_converges_to_eigh_roots(self):
+        factors = torch.stack([ill_conditioned(48, cond, self.generator)
+                               for cond in (1e2, 1e5, 1e8)])
+        d = torch.tensor([1e-3, 1e-4, 1e-4])
+        for p in (1, 2, 4):
+            with self.subTest(p=p):
+                roots, iterations = inverse_root(factors, d, p, iters=60, tol=1e-5)
+                self.assertLess(iterations, 60)
+                for root, factor, damping in zip(roots, factors, d.tolist()):
+                    self.assertLess(relative_error(root, eigh_root(factor, damping, p)), 1e-3)
+                    self.assertTrue(torch.equal(root, root.t()))
+
+    def test_block_batch(self):
+        # (B, k, b, b) stacks of blocks with one damping per stack
+        factors = torch.stack([torch.stack([ill_conditioned(8, 1e4, self.generator)
+                                            for _ in range(3)]) for _ in range(2)])
+        d = torch.tensor([[1e-3], [1e-2]])
+        roots, _ = inverse_root(factors, d, 2)
+        for i in range(2):
+            for j in range(3):
+                reference = eigh_root(factors[i, j], d[i, 0].item(), 2)
+                self.assertLess(relative_error(roots[i, j], reference), 1e-3)
+
+    def test_warm_start(self):
+        factor = ill_conditioned(48, 1e6, self.generator)
+        update = ill_conditioned(48, 1e6, self.generator)
+        previous, _ = inverse_root(factor, 1e-4)
+        new = 0.99 * factor + 0.01 * update
+        cold, cold_iterations = inverse_root(new, 1e-4)
+        warm, warm_iterations = inverse_root(new, 1e-4, x0=previous)
+        self.assertLess(warm_iterations, cold_iterations)
+        self.assertLess(relative_error(warm, eigh_root(new, 1e-4, 1)), 1e-3)
+        # invalid starts fall back to the cold start
+        for x0 in (torch.zeros(48, 48), -previous):
+            root, _ = inverse_root(new, 1e-4, x0=x0)
+            self.assertLess(relative_error(root, eigh_root(new, 1e-4, 1)), 1e-3)
+
+    def train(self, steps=4, **kwargs):
+        model, preconditioner = run_kfac(steps, make_model=tiny_model, input_shape=(16, 6),
+                                         kl_clip=1e6, **kwargs)
+        return preconditioner, [p.grad.clone() for p in model.parameters()]
+
+    def test_kfac_p1_matches_inverse(self):
+        _, reference = self.train(precondition_mode="inverse")
+        preconditioner, grads = self.train(precondition_mode="newton", newton_tol=1e-6)
+        for g, g_ref in zip(grads, reference):
+            self.assertTrue(torch.allclose(g, g_ref, rtol=1e-3, atol=1e-5))
+        stats = preconditioner.newton_stats
+        # the first of the 4 refreshes starts cold, the others from the last inverses
+        self.assertEqual(stats['warm'], stats['solves'] * 3 // 4)
+
+    def test_kfac_shampoo_root(self):
+        preconditioner, _ = self.train(precondition_mode="newton", newton_p=4,
+                                       diag_blocks={'Linear': 2})
+        d = math.sqrt(preconditioner.damping)
+        module = preconditioner.modules[0]
+        for factor, root in ((preconditioner.m_A[module], preconditioner.m_iA[module]),
+                             (preconditioner.m_G[module], preconditioner.m_iG[module])):
+            self.assertEqual(root.dim(), 3)
+            for block, block_root in zip(factor, root):
+                self.assertLess(relative_error(block_root, eigh_root(block, d, 4)), 1e-3)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            kfac.KFAC(tiny_model(), precondition_mode="newton", newton_p=0)
+        with self.assertRaises(ValueError):
+            kfac.KFAC(tiny_model(), precondition_mode="newton", newton_tol=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
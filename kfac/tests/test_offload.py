@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import unittest
+import torch
+
+import kfac
+from kfac.offload import OFFLOAD_DICTS
+from kfac.tests.helpers import conv_model, mlp, run_kfac
+
+
+def tiny_model():
+    return conv_model((32, 16))
+
+
+def run(steps=5, **kwargs):
+    """Preconditioner and the preconditioned gradients of every step"""
+    grads = []
+
+    def save(model, preconditioner):
+        grads.append([p.grad.clone() for p in model.parameters()])
+
+    kwargs.setdefault('make_model', tiny_model)
+    _, preconditioner = run_kfac(steps, kfac_update_freq=2, batched_eigen=False,
+                                 callback=save, **kwargs)
+    return preconditioner, grads
+
+
+def layer_bytes(preconditioner, module):
+    return sum(getattr(preconditioner, name)[module].numel() * 4
+               for name in OFFLOAD_DICTS if module in getattr(preconditioner, name))
+
+
+class TestOffload(unittest.TestCase):
+
+    def assertSameRun(self, reference, offloaded):
+        (ref, ref_grads), (off, off_grads) = reference, offloaded
+        for step_ref, step_off in zip(ref_grads, off_grads):
+            for g_ref, g_off in zip(step_ref, step_off):
+                self.assertTrue(torch.allclose(g_ref, g_off.to(g_ref), atol=1e-6))
+        for m_ref, m_off in zip(ref.modules, off.modules):
+            for name in OFFLOAD_DICTS:
+                if m_ref not in getattr(ref, name):
+                    continue
+                t_ref = getattr(ref, name)[m_ref]
+                self.assertTrue(torch.allclose(t_ref, getattr(off, name)[m_off].to(t_ref),
+                                               atol=1e-6))
+
+    def test_matches_resident(self):
+        for mode in ('eigen', 'inverse'):
+            with self.subTest(mode=mode):
+                reference = run(precondition_mode=mode)
+                for tier in ('memmap', 'cpu'):
+                    offloaded = run(precondition_mode=mode, offload=tier)
+                    self.assertSameRun(reference, offloaded)
+
+    def test_devices(self):
+        # the agc norms, the KNormal clip and the drift check read the
+        # factors of evicted layers
+        # (KNormal clips Linear layers only)
+        linear = dict(make_model=lambda: mlp(20, 32, 16, 5), input_shape=(8, 20))
+        for device in ('cpu', 'cuda'):
+            for clip, model in (('agc', {}), ('KNormal', linear)):
+                with self.subTest(device=device, clip=clip):
+                    if device == 'cuda' and not torch.cuda.is_available():
+                        self.skipTest("CUDA is not available")
+                    options = dict(device=device, gradient_clip=clip, refresh_drift=1e-3,
+                                   **model)
+                    reference = run(**options)
+                    offloaded = run(offload='cpu', **options)
+                    self.assertSameRun(reference, offloaded)
+                    tier = offloaded[0].offload
+                    self.assertGreater(tier.stats['evictions'], 0)
+                    for module in offloaded[0].modules:
+                        if tier.is_resident(module):
+                            self.assertEqual(offloaded[0].m_A_last[module].device.type, device)
+                        else:
+                            home = tier._home[module]['m_A_last']
+                            self.assertEqual(offloaded[0].m_A_last[module].data_ptr(),
+                                             home.data_ptr())
+                    if clip == 'agc':
+                        self.assertEqual(offloaded[0].kA_norm.device.type, device)
+                        self.assertTrue(torch.allclose(reference[0].kA_norm,
+                                                       offloaded[0].kA_norm))
+
+    def test_strict_memory_cap(self):
+        preconditioner, _ = run(steps=1)
+        sizes = sorted(layer_bytes(preconditioner, m) for m in preconditioner.modules)
+        # room for the two largest layers but not for a third one
+        cap = sizes[-1] + sizes[-2]
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        reference = run()
+        preconditioner, grads = run(offload='memmap', offload_dir=directory,
+                                    offload_resident_mb=cap / 2 ** 20)
+        self.assertSameRun(reference, (preconditioner, grads))
+        tier = preconditioner.offload
+        self.assertLessEqual(tier.peak_bytes, cap)
+        self.assertGreater(tier.stats['evictions'], 0)
+        self.assertGreater(tier.stats['prefetched'], 0)
+        self.assertEqual(len(os.listdir(directory)), len(preconditioner.modules))
+        resident = [m for m in preconditioner.modules if tier.is_resident(m)]
+        self.assertLessEqual(sum(layer_bytes(preconditioner, m) for m in resident), cap)
+        # evicted layers point to their memmap home
+        for module in preconditioner.modules:
+            if not tier.is_resident(module):
+                home = tier._home[module]['m_A']
+                self.assertEqual(preconditioner.m_A[module].data_ptr(), home.data_ptr())
+
+    def test_lru_keeps_hot_layers(self):
+        # a budget for all layers: nothing is loaded back after the first step
+        preconditioner, _ = run(offload='memmap', offload_resident_mb=16)
+        tier = preconditioner.offload
+        self.assertEqual((tier.stats['loads'], tier.stats['evictions']), (0, 0))
+        self.assertTrue(all(tier.is_resident(m) for m in preconditioner.modules))
+
+    def test_selected_modules(self):
+        preconditioner, _ = run(offload='memmap', offload_modules=['3'])
+        tier = preconditioner.offload
+        self.assertEqual(list(tier._home), [preconditioner.modules[1]])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            kfac.KFAC(tiny_model(), offload='disk')
+        with self.assertRaises(ValueError):
+            kfac.KFAC(tiny_model(), offload='memmap', async_eigen=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
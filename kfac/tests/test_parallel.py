@@ -0,0 +1,52 @@
+import unittest
+import torch
+
+import kfac
+from kfac.tests.helpers import conv_model, run_kfac
+
+
+def tiny_model():
+    return conv_model((12, 12), convs=2)
+
+
+def run(steps=3, **kwargs):
+    return run_kfac(steps, make_model=tiny_model, **kwargs)
+
+
+class TestParallelRefresh(unittest.TestCase):
+
+    def check_identical(self, **kwargs):
+        model_s, serial = run(**kwargs)
+        model_p, parallel = run(num_workers=3, threads_per_worker=1, **kwargs)
+        self.assertIsNotNone(parallel.executor)
+        for name in ('m_A', 'm_G', 'm_QA', 'm_QG', 'm_dA', 'm_dG', 'm_iA', 'm_iG'):
+            factors_s, factors_p = getattr(serial, name), getattr(parallel, name)
+            for m_s, m_p in zip(serial.modules, parallel.modules):
+                if m_s in factors_s:
+                    self.assertTrue(torch.equal(factors_s[m_s], factors_p[m_p]))
+        for p_s, p_p in zip(model_s.parameters(), model_p.parameters()):
+            self.assertTrue(torch.equal(p_s.grad, p_p.grad))
+
+    def test_eigen(self):
+        self.check_identical()
+
+    def test_eigen_unbatched(self):
+        self.check_identical(batched_eigen=False)
+
+    def test_inverse(self):
+        self.check_identical(precondition_mode="inverse")
+
+    def test_map_visits_every_item(self):
+        _, preconditioner = run(steps=1, num_workers=2)
+        seen = []
+        preconditioner._parallel_map(seen.append, list(range(7)))
+        self.assertEqual(sorted(seen), list(range(7)))
+
+    def test_invalid_workers(self):
+        with self.assertRaises(ValueError):
+            kfac.KFAC(tiny_model(), distribute_layer_factors=False,
+                      num_workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
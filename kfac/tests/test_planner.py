@@ -0,0 +1,125 @@
+import unittest
+import torch
+
+import kfac
+from kfac.planner import plan_kfac
+from kfac.profiler import eigh_flops
+from kfac.tests.helpers import conv_model
+from examples.wikitext_models import RNNModel
+
+
+def tiny_model():
+    return conv_model((64,))
+
+
+class TestPlanner(unittest.TestCase):
+
+    def test_report(self):
+        plan = plan_kfac(tiny_model(), (3, 6, 6), batch_size=8)
+        report = {layer['name']: layer for layer in plan.report()}
+        self.assertEqual(list(report), ['0', '3', '5'])
+        conv, linear = report['0'], report['3']
+        self.assertEqual((conv['rows'], conv['a_dim'], conv['g_dim']), (8 * 36, 28, 4))
+        self.assertEqual(conv['patch_bytes'], 8 * 36 * 28 * 4)
+        self.assertEqual((linear['a_dim'], linear['g_dim']), (145, 64))
+        self.assertEqual(linear['factor_bytes'], (145 ** 2 + 64 ** 2) * 4)
+        self.assertEqual(linear['eigen_flops'], eigh_flops(145) + eigh_flops(64))
+        self.assertEqual(plan.kfac_kwargs()['diag_blocks'], 1)
+        self.assertEqual(plan.kfac_kwargs()['exclude_modules'], [])
+
+    def test_memory_budget(self):
+        plan = plan_kfac(tiny_model(), (3, 6, 6), memory_budget_mb=0.1)
+        self.assertLessEqual(plan.memory(), 0.1 * 2 ** 20)
+        layers = {layer.name: layer for layer in plan.layers}
+        # the largest layer is split first
+        self.assertGreater(layers['3'].blocks, 1)
+
+        plan = plan_kfac(tiny_model(), (3, 6, 6), memory_budget_mb=0.01, max_blocks=2)
+        self.assertLessEqual(plan.memory(), 0.01 * 2 ** 20)
+        self.assertIn('3', plan.kfac_kwargs()['exclude_modules'])
+
+    def test_time_budget(self):
+        unlimited = plan_kfac(tiny_model(), (3, 6, 6))
+        budget = unlimited.step_time() * 1e3 / 3
+        plan = plan_kfac(tiny_model(), (3, 6, 6), time_budget_ms=budget)
+        self.assertLessEqual(plan.step_time() * 1e3, budget)
+        # only the most expensive layer is changed
+        self.assertGreater(plan.kfac_kwargs()['diag_blocks']['3'], 1)
+        self.assertEqual([(l.blocks, l.update_freq) for l in plan.layers[::2]],
+                         [(1, 100), (1, 100)])
+        self.assertEqual(plan.kfac_kwargs()['exclude_modules'], [])
+
+        # with large batches the factor updates dominate
+        unlimited = plan_kfac(tiny_model(), (3, 6, 6), batch_size=4096)
+        budget = unlimited.step_time() * 1e3 / 3
+        plan = plan_kfac(tiny_model(), (3, 6, 6), batch_size=4096, time_budget_ms=budget)
+        self.assertLessEqual(plan.step_time() * 1e3, budget)
+        self.assertEqual(plan.kfac_kwargs()['fac_update_freq'], 50)
+
+    def test_kfac_consumes_plan(self):
+        torch.manual_seed(0)
+        model = tiny_model()
+        plan = plan_kfac(model, (3, 6, 6), memory_budget_mb=0.05, max_blocks=4,
+                         fac_update_freq=1, kfac_update_freq=1)
+        plan.layers[-1].update_freq = 2
+        preconditioner = kfac.KFAC(model, gradient_clip="kl", **plan.kfac_kwargs())
+        for _ in range(4):
+            model.zero_grad()
+            model(torch.randn(8, 3, 6, 6)).pow(2).sum().backward()
+            preconditioner.step()
+        names = {name: m for m, name in preconditioner.module_names.items()}
+        for layer in plan.layers:
+            self.assertEqual(layer.name in names, not layer.excluded)
+            if not layer.excluded:
+                module = names[layer.name]
+                self.assertEqual(preconditioner.m_blocks[module], layer.blocks)
+        self.assertEqual(preconditioner.refresh_counts[names['5']], 2)
+
+    def test_rnn_model(self):
+        # the layers of KFAC: recurrent weights, embedding and decoder
+        torch.manual_seed(0)
+        model = RNNModel('LSTM', ntoken=50, ninp=16, nhid=24, nlayers=2, dropout=0.)
+        tokens = torch.randint(50, (4, 7))
+        plan = plan_kfac(model, inputs=(tokens, model.init_hidden(4)),
+                         exclude_modules=['rnn.weight_hh_l1'])
+        report = {layer['name']: layer for layer in plan.report()}
+        self.assertEqual(set(report), {'encoder', 'rnn.weight_ih_l0', 'rnn.weight_hh_l0',
+                                       'rnn.weight_ih_l1', 'decoder'})
+        ih, hh = report['rnn.weight_ih_l0'], report['rnn.weight_hh_l0']
+        self.assertEqual((ih['rows'], ih['a_dim'], ih['g_dim']), (28, 17, 96))
+        self.assertEqual((hh['a_dim'], hh['g_dim']), (25, 96))
+        encoder = report['encoder']
+        self.assertTrue(encoder['diagonal'])
+        self.assertEqual((encoder['rows'], encoder['a_dim'], encoder['g_dim']), (28, 50, 16))
+        self.assertEqual(encoder['factor_bytes'], (50 + 16 ** 2) * 4)
+
+        # the diagonal layer is not split, KFAC takes the plan
+        plan = plan_kfac(model, inputs=(tokens, model.init_hidden(4)), memory_budget_mb=0.02,
+                         max_blocks=4, fac_update_freq=1, kfac_update_freq=1)
+        self.assertEqual([l.blocks for l in plan.layers if l.diagonal], [1])
+        preconditioner = kfac.KFAC(model, gradient_clip="kl", **plan.kfac_kwargs())
+        names = {name: m for m, name in preconditioner.module_names.items()}
+        self.assertEqual(set(names), {l.name for l in plan.layers if not l.excluded})
+        for layer in plan.layers:
+            if not layer.excluded and not layer.diagonal:
+                self.assertEqual(preconditioner.m_blocks[names[layer.name]], layer.blocks)
+
+        # tied weights: the embedding is not preconditioned
+        model = RNNModel('GRU', ntoken=50, ninp=16, nhid=16, nlayers=1, dropout=0.,
+                         tie_weights=True)
+        plan = plan_kfac(model, inputs=(tokens, model.init_hidden(4)))
+        self.assertEqual([l.name for l in plan.layers],
+                         ['rnn.weight_ih_l0', 'rnn.weight_hh_l0', 'decoder'])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            plan_kfac(tiny_model())
+
+    @unittest.skipUnless(torch.cuda.is_available(), "CUDA is not available")
+    def test_device(self):
+        plan = plan_kfac(tiny_model().cuda(), (3, 6, 6), batch_size=8)
+        self.assertEqual([l.name for l in plan.layers], ['0', '3', '5'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import torch
+
+import kfac
+from kfac.profiler import covariance_flops, eigh_flops
+from kfac.tests.helpers import LogWriter, run_kfac
+
+
+def run(steps, **kwargs):
+    return run_kfac(steps, kfac_update_freq=2, **kwargs)[1]
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_disabled_records_nothing(self):
+        preconditioner = run(2)
+        self.assertEqual(preconditioner.profiler.summary(), {})
+        self.assertGreater(preconditioner.T_all, 0)
+
+    def test_phases_and_modules(self):
+        preconditioner = run(3, profile=True)
+        summary = preconditioner.profiler.summary()
+        for phase in ('factor_A', 'factor_G', 'eigen', 'precondition', 'scale_grad'):
+            self.assertGreater(summary[phase]['time'], 0, phase)
+        self.assertEqual(summary['factor_A']['calls'], 3)
+        self.assertEqual(summary['eigen']['calls'], 2)
+        self.assertEqual(summary['precondition']['calls'], 3)
+
+        names = set(preconditioner.module_names.values())
+        self.assertEqual(set(preconditioner.profiler.by_module('precondition')), names)
+
+    def test_flop_estimates(self):
+        preconditioner = run(1, profile=True)
+        linear = preconditioner.modules[-1]
+        name = preconditioner.module_names[linear]
+        # Linear(12, 5) with bias on a batch of 8
+        factor_A = preconditioner.profiler.by_module('factor_A')[name]
+        self.assertEqual(factor_A['flops'], covariance_flops(8, 13))
+        eigen = preconditioner.profiler.by_module('eigen')[name]
+        self.assertEqual(eigen['flops'], eigh_flops(13) + eigh_flops(5))
+        # 8 x 13 inputs and the 13 x 13 covariance
+        self.assertEqual(factor_A['est_bytes'], (8 * 13 + 13 * 13) * 4)
+
+        conv = preconditioner.modules[0]
+        factor_A = preconditioner.profiler.by_module('factor_A')[preconditioner.module_names[conv]]
+        self.assertEqual(factor_A['flops'], covariance_flops(8 * 36, 28))
+
+    def test_inverse_phase(self):
+        preconditioner = run(1, profile=True, precondition_mode="inverse")
+        summary = preconditioner.profiler.summary()
+        self.assertIn('inverse', summary)
+        self.assertNotIn('eigen', summary)
+
+    def test_write(self):
+        preconditioner = run(1, profile=True)
+        writer = LogWriter()
+        preconditioner.profiler.write(writer, 1, per_module=True)
+        self.assertIn('KFAC/profile/eigen/time', writer.scalars)
+        name = preconditioner.module_names[preconditioner.modules[0]]
+        self.assertIn('KFAC/profile/factor_A/flops/' + name, writer.scalars)
+        # the memory is an estimate, not a measurement
+        self.assertIn('KFAC/profile/factor_A/est_bytes/' + name, writer.scalars)
+        self.assertNotIn('KFAC/profile/factor_A/bytes', writer.scalars)
+        self.assertIn('est. MB', repr(preconditioner.profiler))
+        preconditioner.profiler.reset()
+        self.assertEqual(preconditioner.profiler.summary(), {})
+
+    def test_flush_per_epoch(self):
+        preconditioner = run(2, profile=True)
+        writer = LogWriter()
+        preconditioner.dump(1, writer)
+        self.assertNotIn('KFAC/profile/eigen/time', writer.scalars)
+        preconditioner.dump_epoch(1, writer)
+        self.assertIn('KFAC/profile/eigen/time', writer.scalars)
+        self.assertEqual(preconditioner.profiler.summary(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
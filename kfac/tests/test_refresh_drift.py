@@ -0,0 +1,63 @@
+import unittest
+import torch
+
+import kfac
+from kfac.tests.helpers import LogWriter, run_kfac
+
+
+def run(steps, fixed_data=False, **kwargs):
+    """KFAC preconditioner after `steps` steps on random or repeated batches"""
+    batches = None
+    if fixed_data:
+        batches = [torch.randn(8, 3, 6, 6, generator=torch.Generator().manual_seed(1))] * steps
+    return run_kfac(steps, batches=batches, **kwargs)[1]
+
+
+class TestRefreshDrift(unittest.TestCase):
+
+    def test_zero_threshold_refreshes_all(self):
+        full = run(6, kfac_update_freq=2)
+        drift = run(6, kfac_update_freq=2, refresh_drift=0.0)
+        for m_f, m_d in zip(full.modules, drift.modules):
+            self.assertTrue(torch.allclose(full.m_QA[m_f], drift.m_QA[m_d]))
+            self.assertTrue(torch.allclose(full.m_dG[m_f], drift.m_dG[m_d]))
+            self.assertEqual(full.refresh_counts[m_f], 3)
+            self.assertEqual(drift.refresh_counts[m_d], 3)
+
+    def test_max_refresh_age(self):
+        preconditioner = run(9, kfac_update_freq=2, refresh_drift=float('inf'),
+                             max_refresh_age=4)
+        # refreshed at steps 0, 4 and 8
+        for module in preconditioner.modules:
+            self.assertEqual(preconditioner.refresh_counts[module], 3)
+            self.assertEqual(preconditioner.m_refresh_step[module], 8)
+
+    def test_basis_of_last_refresh(self):
+        preconditioner = run(5, fixed_data=True, kfac_update_freq=1, refresh_drift=0.5)
+        counts = [preconditioner.refresh_counts[m] for m in preconditioner.modules]
+        self.assertLess(sum(counts), 5 * len(counts))
+        for module in preconditioner.modules:
+            QA, dA = preconditioner.m_QA[module], preconditioner.m_dA[module]
+            last = preconditioner.m_A_last[module]
+            self.assertTrue(torch.allclose(QA @ torch.diag(dA) @ QA.t(), last, atol=1e-5))
+            drift = max(preconditioner._factor_drift(preconditioner.m_A[module], last),
+                        preconditioner._factor_drift(preconditioner.m_G[module],
+                                                     preconditioner.m_G_last[module]))
+            if preconditioner.m_refresh_step[module] < 4:
+                self.assertLessEqual(drift, 0.5)
+            else:
+                self.assertEqual(drift, 0)
+
+    def test_dump_refresh_counts(self):
+        preconditioner = run(4, kfac_update_freq=2)
+        writer = LogWriter()
+        preconditioner.dump(1, writer)
+        self.assertNotIn('KFAC/refreshes', writer.scalars)
+        preconditioner.dump_epoch(1, writer)
+        n = len(preconditioner.modules)
+        self.assertEqual(writer.scalars['KFAC/refreshes'], 2 * n)
+        self.assertEqual(writer.scalars['KFAC/refreshes_per_layer'].tolist(), [2] * n)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import math
+import unittest
+import torch
+
+import kfac
+from kfac.utils import adaptive_clip_grads_, kl_clip_scale
+from kfac.tests.helpers import conv_model
+from models.VoT.some_utils import clip_grad_rc
+
+
+def step(gradient_clip):
+    """Model with fresh gradients and their preconditioned updates after
+    one KFAC step"""
+    torch.manual_seed(0)
+    model = conv_model((12, 12), classes=1)
+    preconditioner = kfac.KFAC(model, fac_update_freq=1, kfac_update_freq=1,
+                               gradient_clip=gradient_clip)
+    for _ in range(2):
+        model.zero_grad()
+        model(torch.randn(8, 3, 6, 6)).pow(2).sum().backward()
+        if preconditioner.steps == 0:
+            preconditioner.step()
+    updates = {m: preconditioner._get_preconditioned_grad(m, preconditioner._get_grad(m))
+               for m in preconditioner.modules}
+    return model, preconditioner, updates
+
+
+def reference_clip(grad, weight, clip=0.02, eps=1.e-3):
+    if min(grad.shape) > 1:
+        return clip_grad_rc(grad, weight, row_major=grad.shape[0] > grad.shape[1])
+    # `clip_grad_rc` fails on a single row, whose unitwise norm is the norm
+    scale = clip * weight.norm().clamp(min=eps) / (grad.norm() + 1.0e-6)
+    return grad * scale.clamp(max=1)
+
+
+class TestScaleGrad(unittest.TestCase):
+
+    def test_adaptive_clip_matches_clip_grad_rc(self):
+        torch.manual_seed(0)
+        shapes = [(6, 4), (6, 4), (4, 6), (5, 5), (1, 7), (7, 1)]
+        grads = [torch.randn(*shape) for shape in shapes]
+        weights = [torch.randn(*shape) * 0.01 for shape in shapes]
+        weights[2][0].zero_()
+        expected = [reference_clip(g, w) for g, w in zip(grads, weights)]
+        adaptive_clip_grads_(grads, weights)
+        for g, e in zip(grads, expected):
+            self.assertTrue(torch.allclose(g, e, atol=1e-6))
+
+    def test_kl_clip_scale(self):
+        torch.manual_seed(0)
+        updates = [torch.randn(3, 4), torch.randn(3)]
+        grads = [torch.randn(3, 4), torch.randn(3)]
+        vg_sum = sum((v * g * 0.1 ** 2).sum().item() for v, g in zip(updates, grads))
+        nu = kl_clip_scale(updates, grads, 0.1, 0.001)
+        self.assertEqual(nu.dim(), 0)
+        self.assertAlmostEqual(nu.item(), min(1.0, math.sqrt(0.001 / abs(vg_sum))), places=5)
+
+    def test_kl_step(self):
+        model, preconditioner, updates = step("kl")
+        preconditioner._update_scale_grad(updates)
+        nu = preconditioner.nu
+        self.assertIsInstance(nu, float)
+        for module in preconditioner.modules:
+            self.assertTrue(torch.allclose(module.weight.grad, updates[module][0] * nu))
+            self.assertTrue(torch.allclose(module.bias.grad, updates[module][1] * nu))
+
+    def test_agc_step(self):
+        model, preconditioner, updates = step("agc")
+        bias_grads = [m.bias.grad.clone() for m in preconditioner.modules]
+        preconditioner._update_scale_grad(updates)
+        for module, bias_grad in zip(preconditioner.modules, bias_grads):
+            grad = updates[module][0].view(module.weight.shape[0], -1)
+            weight = module.weight.data.view(grad.shape)
+            expected = reference_clip(grad, weight)
+            self.assertTrue(torch.allclose(module.weight.grad.view(grad.shape),
+                                           expected, atol=1e-6))
+            self.assertTrue(torch.equal(module.bias.grad, bias_grad))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import torch
+
+import kfac
+from kfac.storage import FactorStorage
+from kfac.tests.helpers import run_kfac
+
+
+class TestFactorStorage(unittest.TestCase):
+
+    def test_pack_round_trip(self):
+        storage = FactorStorage(packed=True)
+        x = torch.randn(7, 7)
+        x = x + x.t()
+        stored = storage.pack(x)
+        self.assertEqual(stored.shape, (28,))
+        self.assertEqual(storage.dim(stored), 7)
+        self.assertTrue(torch.equal(storage.dense(stored), x))
+
+    def test_running_avg(self):
+        x = torch.randn(5, 5)
+        x = x @ x.t()
+        dense, packed = torch.eye(5), FactorStorage(packed=True).pack(torch.eye(5))
+        kfac.utils.update_running_avg(x, dense, 0.9)
+        storage = FactorStorage(packed=True)
+        storage.update_running_avg(x, packed, 0.9)
+        self.assertTrue(torch.allclose(storage.dense(packed), dense, atol=1e-6))
+
+    def test_packed_matches_dense(self):
+        model_d, dense = run_kfac()
+        model_p, packed = run_kfac(packed_factors=True)
+        for m_d, m_p in zip(dense.modules, packed.modules):
+            self.assertEqual(packed.m_A[m_p].dim(), 1)
+            self.assertTrue(torch.allclose(
+                packed.factor_storage.dense(packed.m_A[m_p]), dense.m_A[m_d], atol=1e-6))
+        for p_d, p_p in zip(model_d.parameters(), model_p.parameters()):
+            self.assertTrue(torch.allclose(p_d.grad, p_p.grad, rtol=1e-4, atol=1e-6))
+
+    def test_bfloat16(self):
+        model_d, dense = run_kfac()
+        model_h, half = run_kfac(packed_factors=True, factor_dtype=torch.bfloat16)
+        for m_d, m_h in zip(dense.modules, half.modules):
+            self.assertEqual(half.m_G[m_h].dtype, torch.bfloat16)
+            self.assertEqual(half.m_QG[m_h].dtype, torch.float32)
+            A = half.factor_storage.dense(half.m_A[m_h])
+            self.assertEqual(A.dtype, torch.float32)
+            self.assertLess((A - dense.m_A[m_d]).norm() / dense.m_A[m_d].norm(), 1e-2)
+
+    def test_memory_report(self):
+        _, dense = run_kfac(steps=1)
+        _, half = run_kfac(steps=1, packed_factors=True, factor_dtype=torch.float16)
+        report = dict((name, (d, s)) for name, d, s in half.factor_memory_report())
+        for name, dense_bytes, stored_bytes in dense.factor_memory_report():
+            self.assertEqual(dense_bytes, stored_bytes)
+            self.assertEqual(report[name][0], dense_bytes)
+            self.assertLess(report[name][1], dense_bytes / 3.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import torch
+
+import kfac
+from kfac.tests.helpers import conv_model
+
+
+def factors(micro_batches, **kwargs):
+    """Factors after one KFAC step over `micro_batches` chunks of a batch"""
+    torch.manual_seed(0)
+    model = conv_model()
+    preconditioner = kfac.KFAC(model, distribute_layer_factors=False,
+                               batch_averaged=False, factor_decay=0.5,
+                               gradient_clip="kl", **kwargs)
+    data = torch.randn(8, 3, 6, 6)
+    model.zero_grad()
+    for chunk in data.chunk(micro_batches):
+        model(chunk).pow(2).sum().backward()
+    if preconditioner.streaming_factors:
+        for module in preconditioner.modules:
+            a = preconditioner.m_a[module]
+            assert a.dim() == 2 and a.shape[0] == a.shape[1]
+    preconditioner.step()
+    return preconditioner
+
+
+class TestStreamingFactors(unittest.TestCase):
+
+    def test_single_pass_matches(self):
+        saved = factors(1)
+        streamed = factors(1, streaming_factors=True)
+        for m_s, m_t in zip(saved.modules, streamed.modules):
+            self.assertTrue(torch.allclose(saved.m_A[m_s], streamed.m_A[m_t], atol=1e-6))
+            self.assertTrue(torch.allclose(saved.m_G[m_s], streamed.m_G[m_t], atol=1e-6))
+
+    def test_micro_batches_accumulate(self):
+        full = factors(1)
+        streamed = factors(4, streaming_factors=True)
+        for m_f, m_s in zip(full.modules, streamed.modules):
+            self.assertTrue(torch.allclose(full.m_A[m_f], streamed.m_A[m_s], atol=1e-6))
+            self.assertTrue(torch.allclose(full.m_G[m_f], streamed.m_G[m_s], atol=1e-5))
+        self.assertEqual(len(streamed.m_a), 0)
+        self.assertEqual(len(streamed.m_g_count), 0)
+
+    def test_micro_batches_overwrite_without_streaming(self):
+        full = factors(1)
+        saved = factors(4)
+        module_f, module_s = full.modules[-1], saved.modules[-1]
+        self.assertFalse(torch.allclose(full.m_A[module_f], saved.m_A[module_s], atol=1e-6))
+
+
+if __name__ == '__main__':
+    unittest.main()
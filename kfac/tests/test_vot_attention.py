@@ -0,0 +1,308 @@
+import math
+import unittest
+import torch
+
+from models.VoT import VoT, VoT_config
+from models.VoT.gaussian import GaussianSelfAttention, register_attention_cache_hook
+from models.VoT.gabor_filter import GaborSelfAttention
+from models.VoT.voxel_transformer import BertConfig, Learned2DRelativeSelfAttention
+from models.VoT import position_encode
+from models.VoT.position_encode import relative_position_grid, relative_index_grid, \
+                                       clear_relative_grids
+
+
+class QuietLogger:
+    epoch = 0
+    batch_idx = 0
+
+    def isPlot(self):
+        return False
+
+
+def vot_config(**kwargs):
+    config = dict(VoT_config)
+    config.update(INPUT_W=8, INPUT_H=8, positional_encoding="", logger=QuietLogger(),
+                  num_hidden_layers=2, num_attention_heads=4)
+    config.update(kwargs)
+    return config
+
+
+def legacy_grid(theta=None, size=50):
+    """The grid the layers used to build and register as the buffer R"""
+    range_ = torch.arange(size)
+    grid = torch.cat([t.unsqueeze(-1) for t in torch.meshgrid([range_, range_], indexing="ij")],
+                     dim=-1)
+    if theta is not None:
+        rotate = torch.tensor([[math.cos(theta), math.sin(theta)],
+                               [-math.sin(theta), math.cos(theta)]])
+        grid = torch.einsum('ijc,cr->ijr', [grid.float(), rotate])
+    relative = grid.unsqueeze(0).unsqueeze(0) - grid.unsqueeze(-2).unsqueeze(-2)
+    return torch.cat([relative, relative ** 2,
+                      (relative[..., 0] * relative[..., 1]).unsqueeze(-1)], dim=-1).float()
+
+
+def attention_layers(model, cls):
+    return [m for m in model.modules() if isinstance(m, cls)]
+
+
+class TestRelativeGrids(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        clear_relative_grids()
+
+    def test_grid(self):
+        R = relative_position_grid(6, 5)
+        self.assertEqual(R.shape, (6, 5, 6, 5, 5))
+        self.assertTrue(torch.equal(R, legacy_grid()[:6, :5, :6, :5]))
+        rotated = relative_position_grid(6, 5, theta=math.pi / 4)
+        self.assertTrue(torch.allclose(rotated, legacy_grid(math.pi / 4)[:6, :5, :6, :5],
+                                       atol=1e-4))
+        # one tensor per key
+        self.assertIs(relative_position_grid(6, 5, torch.float32, "cpu"), R)
+        self.assertIsNot(relative_position_grid(5, 6), R)
+        self.assertEqual(relative_position_grid(6, 5, torch.float64).dtype, torch.float64)
+        indices = relative_index_grid(4, 16)
+        self.assertTrue(torch.equal(indices, (torch.arange(4).view(1, -1) -
+                                              torch.arange(4).view(-1, 1)) + 15))
+
+    def test_shared_and_not_saved(self):
+        for attention, cls in (("gaussian", GaussianSelfAttention),
+                               ("gabor", GaborSelfAttention)):
+            with self.subTest(attention=attention):
+                clear_relative_grids()
+                model = VoT(vot_config(use_attention=attention), num_classes=10).eval()
+                x = torch.randn(2, 3, 32, 32)
+                expected = model(x)
+                # both layers used the one 8x8 grid
+                self.assertEqual([tuple(R.shape) for R in position_encode._RELATIVE_GRIDS.values()],
+                                 [(8, 8, 8, 8, 5)])
+                names = [k.split('.')[-1] for k in model.state_dict()]
+                self.assertFalse({"R", "R_xitas_"} & set(names))
+                layers = attention_layers(model, cls)
+                self.assertEqual(len(layers), 2)
+
+                # checkpoints of the former layout still load strictly
+                state = model.state_dict()
+                for name, module in model.named_modules():
+                    if isinstance(module, cls):
+                        state[name + ".R"] = legacy_grid()
+                        if cls is GaborSelfAttention:
+                            state[name + ".R_xitas_"] = legacy_grid()[:8, :8, :8, :8].expand(
+                                    4, 8, 8, 8, 8, 5)
+                torch.manual_seed(1)
+                restored = VoT(vot_config(use_attention=attention), num_classes=10).eval()
+                restored.load_state_dict(state)
+                self.assertTrue(torch.equal(restored(x), expected))
+
+    def test_learned_2d(self):
+        config = BertConfig.from_dict(vot_config(max_position_embeddings=8))
+        layer = Learned2DRelativeSelfAttention(config)
+        self.assertNotIn("relative_indices", layer.state_dict())
+        output = layer(torch.randn(2, 6, 6, 48), None)
+        self.assertEqual(output.shape, (2, 6, 6, 48))
+        state = layer.state_dict()
+        state["relative_indices"] = relative_index_grid(8, 8)
+        Learned2DRelativeSelfAttention(config).load_state_dict(state)
+
+
+class TestAttentionCache(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_cache(self):
+        model = VoT(vot_config(use_attention="gaussian"), num_classes=10)
+        layer = attention_layers(model, GaussianSelfAttention)[0]
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        x = torch.randn(2, 3, 32, 32)
+
+        model.eval()
+        with torch.no_grad():
+            probs = layer.get_attention_probs(8, 8)
+            self.assertIs(layer.get_attention_probs(8, 8), probs)
+            self.assertIsNot(layer.get_attention_probs(4, 8), probs)
+        self.assertTrue(torch.equal(probs, layer.compute_attention_probs(8, 8)))
+
+        # training recomputes with a graph and the step invalidates the cache
+        model.train()
+        for _ in range(2):
+            model.zero_grad()
+            model(x).sum().backward()
+        self.assertEqual(layer.attention_cache, {})
+        optimizer.step()
+        model.eval()
+        with torch.no_grad():
+            updated = layer.get_attention_probs(8, 8)
+            self.assertFalse(torch.equal(updated, probs))
+            self.assertTrue(torch.equal(updated, layer.compute_attention_probs(8, 8)))
+            layer.cache_attention = False
+            self.assertIsNot(layer.get_attention_probs(8, 8), updated)
+            layer.cache_attention = True
+            # in place changes, e.g. loading a checkpoint, invalidate it too
+            self.assertNotIn("attention_cache", "".join(model.state_dict()))
+            state = {k: v.clone() for k, v in model.state_dict().items()}
+            model.load_state_dict(state)
+            self.assertIsNot(layer.get_attention_probs(8, 8), updated)
+
+    @torch.no_grad()
+    def test_in_place_copy(self):
+        model = VoT(vot_config(use_attention="gaussian"), num_classes=10).eval()
+        layer = attention_layers(model, GaussianSelfAttention)[0]
+        probs = layer.get_attention_probs(8, 8)
+        # bumps the version counter of the weight
+        layer.sigmaLayer.weight.copy_(torch.randn_like(layer.sigmaLayer.weight))
+        updated = layer.get_attention_probs(8, 8)
+        self.assertFalse(torch.equal(updated, probs))
+        self.assertTrue(torch.equal(updated, layer.compute_attention_probs(8, 8)))
+        # .data has its own counter, the cache is cleared explicitly
+        layer.sigmaLayer.weight.data.copy_(torch.randn_like(layer.sigmaLayer.weight))
+        self.assertIs(layer.get_attention_probs(8, 8), updated)
+        layer.clear_attention_cache()
+        self.assertTrue(torch.equal(layer.get_attention_probs(8, 8),
+                                    layer.compute_attention_probs(8, 8)))
+
+    def test_explicit_invalidation(self):
+        model = VoT(vot_config(use_attention="gaussian"), num_classes=10).eval()
+        layers = attention_layers(model, GaussianSelfAttention)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        handle = register_attention_cache_hook(optimizer, model)
+
+        def fill():
+            with torch.no_grad():
+                for layer in layers:
+                    layer.get_attention_probs(8, 8)
+            self.assertTrue(all(layer.attention_cache for layer in layers))
+        fill()
+        model.train()
+        self.assertFalse(any(layer.attention_cache for layer in layers))
+        model.eval()
+        fill()
+        model.load_state_dict(model.state_dict())
+        self.assertFalse(any(layer.attention_cache for layer in layers))
+        fill()
+        optimizer.step()
+        self.assertFalse(any(layer.attention_cache for layer in layers))
+        handle.remove()
+
+
+class TestSeparableAttention(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def assertEquivalent(self, layer, x):
+        layer.use_separable = False
+        dense = layer(x, None)
+        dense_probs = layer.compute_attention_probs(*x.shape[1:3])
+        layer.use_separable = True
+        layer.output_attentions = True
+        probs, separable = layer(x, None)
+        layer.output_attentions = False
+        self.assertTrue(torch.allclose(separable, dense, atol=1e-5))
+        self.assertTrue(torch.allclose(probs, dense_probs, atol=1e-6))
+
+    @torch.no_grad()
+    def test_equivalence(self):
+        x = torch.randn(3, 6, 5, 48)
+        # isotropic spreads start with a zero cross term weight
+        model = VoT(vot_config(use_attention="gaussian", attention_isotropic_gaussian=True),
+                    num_classes=10).eval()
+        layer = attention_layers(model, GaussianSelfAttention)[0]
+        self.assertTrue(layer.isSigma)
+        self.assertEqual(layer.sigmaLayer.in_features, 5)
+        self.assertIsNotNone(layer.get_separable_probs(6, 5))
+        self.assertEquivalent(layer, x)
+
+        # a general covariance is separable while its cross term is zero
+        model = VoT(vot_config(use_attention="gaussian"), num_classes=10).eval()
+        layer = attention_layers(model, GaussianSelfAttention)[0]
+        self.assertIsNone(layer.get_separable_probs(6, 5))
+        layer.sigmaLayer.weight[:, 4] = 0
+        self.assertIsNotNone(layer.get_separable_probs(6, 5))
+        self.assertEquivalent(layer, x)
+        layer.sigmaLayer.weight[0, 4] = 1e-3
+        self.assertIsNone(layer.get_separable_probs(6, 5))
+
+        # target vectors of the spreads and centers
+        layer.isSigma = False
+        layer.attention_isotropic_gaussian = True
+        layer.attention_spreads = torch.nn.Parameter(torch.rand(4) + 0.5)
+        self.assertIsNotNone(layer.get_separable_probs(6, 5))
+        self.assertEquivalent(layer, x)
+
+    def test_check_cached(self):
+        model = VoT(vot_config(use_attention="gaussian"), num_classes=10).eval()
+        layer = attention_layers(model, GaussianSelfAttention)[0]
+        calls = []
+        compute = layer.compute_separable_probs
+        layer.compute_separable_probs = lambda *size: calls.append(size) or compute(*size)
+        with torch.no_grad():
+            for _ in range(2):
+                self.assertIsNone(layer.get_separable_probs(6, 5))
+            self.assertEqual(len(calls), 1)
+            layer.sigmaLayer.weight[:, 4] = 0
+            self.assertIsNotNone(layer.get_separable_probs(6, 5))
+            self.assertEqual(len(calls), 2)
+
+    def training_grads(self, model, x):
+        """sigmaLayer weight gradients of the dense and separable paths and the computed separable sizes"""
+        layer = attention_layers(model, GaussianSelfAttention)[0]
+        calls = []
+        compute = layer.compute_separable_probs
+
+        def record(*size):
+            probs = compute(*size)
+            calls.append((size, probs))
+            return probs
+        layer.compute_separable_probs = record
+        grads = []
+        for use_separable in (False, True):
+            layer.use_separable = use_separable
+            model.zero_grad()
+            torch.manual_seed(1)
+            model(x).pow(2).sum().backward()
+            grads.append(layer.sigmaLayer.weight.grad.clone())
+        return grads, [size for size, probs in calls if probs is not None]
+
+    def test_training(self):
+        x = torch.randn(2, 3, 32, 32)
+        # the zero cross term of isotropic spreads is still trained by the dense path
+        model = VoT(vot_config(use_attention="gaussian", attention_isotropic_gaussian=True,
+                               attention_probs_dropout_prob=0.), num_classes=10)
+        self.assertEqual(self.training_grads(model, x)[1], [])
+
+        # without the cross term weight the gradients of both paths match
+        model = VoT(vot_config(use_attention="gaussian", attention_isotropic_gaussian=True,
+                               attention_separable_sigma=True, attention_probs_dropout_prob=0.),
+                    num_classes=10)
+        layer = attention_layers(model, GaussianSelfAttention)[0]
+        self.assertEqual(layer.sigmaLayer.in_features, 4)
+        (dense, separable), sizes = self.training_grads(model, x)
+        self.assertEqual(sizes, [(8, 8)])
+        self.assertTrue(torch.allclose(dense, separable, rtol=1e-4, atol=1e-6))
+
+        # the dense path keeps the attention dropout
+        layer.dropout.p = 0.1
+        calls = []
+        layer.compute_separable_probs = lambda *size: calls.append(size)
+        model(x)
+        self.assertEqual(calls, [])
+
+    def test_isotropic_checkpoint(self):
+        # isotropic heads keep the 5 term layout of the checkpoints
+        model = VoT(vot_config(use_attention="gaussian", attention_isotropic_gaussian=True),
+                    num_classes=10).eval()
+        layer = attention_layers(model, GaussianSelfAttention)[0]
+        state = model.state_dict()
+        name = [k for k in state if k.endswith("sigmaLayer.weight")][0]
+        self.assertEqual(state[name].shape[1], 5)
+        state[name] = state[name].clone()
+        state[name][:, 4] = 0.5
+        model.load_state_dict(state)
+        self.assertTrue(torch.equal(layer.sigmaLayer.weight, state[name]))
+        with torch.no_grad():
+            self.assertIsNone(layer.get_separable_probs(6, 5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import itertools
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -57,6 +58,270 @@ def get_block_boundary(index, block_count, shape):
                  for i, x in enumerate(block_shape)]
     return block_start, block_end
 
+def block_slices(n, blocks):
+    """(start, end) of the diagonal blocks of an n x n factor split into
+    `blocks` (at most n) blocks with `get_block_boundary`"""
+    blocks = min(blocks, n)
+    return [(start[0], end[0]) for start, end in
+            (get_block_boundary(i, blocks, (n, n)) for i in range(blocks))]
+
+def extract_blocks(factor, blocks):
+    """Diagonal blocks of the n x n `factor` stacked as a (k, b, b) tensor,
+    zero padded to the largest block size b"""
+    slices = block_slices(factor.shape[0], blocks)
+    size = max(end - start for start, end in slices)
+    stacked = factor.new_zeros(len(slices), size, size)
+    for i, (start, end) in enumerate(slices):
+        stacked[i, :end - start, :end - start] = factor[start:end, start:end]
+    return stacked
+
+def assemble_blocks(stacked, n):
+    """n x n block diagonal matrix of the padded (k, b, b) `stacked` blocks"""
+    factor = stacked.new_zeros(n, n)
+    for i, (start, end) in enumerate(block_slices(n, stacked.shape[0])):
+        factor[start:end, start:end] = stacked[i, :end - start, :end - start]
+    return factor
+
+def block_index(n, blocks, device=None):
+    """Index of every padded block row in the n rows of a factor
+
+    Entry `i * b + j` is the row of row `j` of block `i`, or `n` for padding,
+    so a gradient padded with one zero row/column can be gathered into and
+    scattered back from the (k, b) block layout.
+    """
+    slices = block_slices(n, blocks)
+    size = max(end - start for start, end in slices)
+    index = torch.full((len(slices), size), n, dtype=torch.long, device=device)
+    for i, (start, end) in enumerate(slices):
+        index[i, :end - start] = torch.arange(start, end, device=device)
+    return index.view(-1)
+
+def _cov(x, y, blocks=None):
+    """x^T y, or only its diagonal blocks in the padded (k, b, b) layout"""
+    if blocks is None or blocks == 1:
+        return x.t() @ y
+    slices = block_slices(x.size(1), blocks)
+    size = max(end - start for start, end in slices)
+    cov = x.new_zeros(len(slices), size, size)
+    for i, (start, end) in enumerate(slices):
+        cov[i, :end - start, :end - start] = x[:, start:end].t() @ y[:, start:end]
+    return cov
+
+def randomized_eigh(A, rank, oversample=10, n_iter=2, generator=None):
+    """Leading `rank` eigenpairs of the symmetric PSD matrix `A`
+
+    Randomized range finder with subspace iteration (Halko et al., 2011):
+    the range of `A` is sampled with `rank + oversample` Gaussian vectors,
+    refined with `n_iter` power iterations and `A` is eigendecomposed in
+    that subspace.
+
+    Returns:
+      eigenvalues (rank,) in ascending order and eigenvectors (n, rank)
+    """
+    n = A.shape[0]
+    size = min(n, rank + oversample)
+    omega = torch.randn(n, size, generator=generator, dtype=A.dtype).to(A.device)
+    Q, _ = torch.linalg.qr(A @ omega)
+    for _ in range(n_iter):
+        Q, _ = torch.linalg.qr(A @ Q)
+    B = Q.t() @ A @ Q
+    d, V = torch.linalg.eigh((B + B.t()) / 2)
+    return d[-rank:], Q @ V[:, -rank:]
+
+def _coupled_newton(X, M, p, iters, tol):
+    """Iterate X <- X T, M <- T^p M with T = ((p + 1)I - M) / p until
+    max|M - I| <= tol, leaving converged matrices of the batch unchanged"""
+    eye = torch.eye(M.shape[-1], dtype=M.dtype, device=M.device)
+    for i in range(iters + 1):
+        converged = (M - eye).abs().amax(dim=(-2, -1)) <= tol
+        if i == iters or bool(converged.all()):
+            return X, converged, i
+        active = ~converged[..., None, None]
+        T = ((p + 1) * eye - M) / p
+        X = torch.where(active, X @ T, X)
+        M = torch.where(active, torch.linalg.matrix_power(T, p) @ M, M)
+
+
+def _spectral_bound(M, squarings=3):
+    """Upper bound ||M^(2^s)||_F^(1/2^s) of the spectral radius of `M`,
+    with the powers normalized so they cannot overflow"""
+    norm = torch.linalg.matrix_norm(M)
+    P, log_bound = M / norm[..., None, None], norm.log()
+    for j in range(1, squarings + 1):
+        P = P @ P
+        norm = torch.linalg.matrix_norm(P)
+        P = P / norm[..., None, None]
+        log_bound = log_bound + norm.log() / 2 ** j
+    return log_bound.exp()
+
+
+def inverse_root(factors, damping, p=1, x0=None, iters=40, tol=1e-4):
+    """Damped inverse p-th roots (F + dI)^(-1/p) of a batch of symmetric PSD
+    matrices with the coupled Newton iteration (Higham, 2008), matmuls only
+
+    The cold start is X = z^(1/p) I, M = z(F + dI) with
+    z = (p + 1) / (2 ||F + dI||_F), so the spectrum of M is in (0, (p+1)/2].
+    For p = 1, `x0` (e.g. the previous inverse) is used as a warm start with
+    M = (F + dI) x0 scaled into (0, 1], which is the Newton-Schulz
+    iteration and converges for any symmetric positive definite `x0`. A
+    warm start that does not converge to a finite symmetric root is redone
+    from the cold start. For p > 1 the iteration requires a start that
+    commutes with F, so `x0` is ignored.
+
+    Args:
+      factors: (..., n, n) symmetric PSD matrices
+      damping: damping d, broadcastable to `factors.shape[:-2]`
+      p (int, optional): root (default: 1, the inverse)
+      x0 (optional): (..., n, n) warm start of the p = 1 iteration
+      iters (int, optional): maximum iterations (default: 40)
+      tol (float, optional): convergence tolerance on max|M - I|
+          (default: 1e-4)
+
+    Returns:
+      symmetrized roots (..., n, n) and the number of iterations run
+    """
+    eye = torch.eye(factors.shape[-1], dtype=factors.dtype, device=factors.device)
+    damping = torch.as_tensor(damping, dtype=factors.dtype, device=factors.device)
+    A = factors + damping[..., None, None] * eye
+    if p == 1 and x0 is not None:
+        M = A @ x0
+        s = (1 / _spectral_bound(M)).clamp(max=1)
+        warm = torch.isfinite(s) & (s > 0)
+        if bool(warm.any()):
+            s = torch.where(warm, s, torch.ones_like(s))[..., None, None]
+            X, converged, iterations = _coupled_newton(s * x0, s * M, p, iters, tol)
+            symmetric = (X - X.mT).abs().amax(dim=(-2, -1)) <= \
+                        math.sqrt(tol) * X.abs().amax(dim=(-2, -1))
+            ok = warm & converged & symmetric & torch.isfinite(X).all(-1).all(-1)
+            if bool(ok.all()):
+                return (X + X.mT) / 2, iterations
+            cold, cold_iterations = inverse_root(factors, damping, p, None, iters, tol)
+            X = torch.where(ok[..., None, None], (X + X.mT) / 2, cold)
+            return X, iterations + cold_iterations
+    z = (p + 1) / (2 * torch.linalg.matrix_norm(A))
+    X, _, iterations = _coupled_newton(z.pow(1. / p)[..., None, None] * eye,
+                                       z[..., None, None] * A, p, iters, tol)
+    return (X + X.mT) / 2, iterations
+
+def conjugate_gradient(fvp, b, x0=None, precond=None, max_iters=10, tol=1e-2,
+                       check_freq=1):
+    """Batched preconditioned conjugate gradient for SPD systems F x = b
+
+    The systems stacked along the first dim of `b` are iterated together.
+    A system stops (its step is masked to zero) once its squared residual
+    is at most `tol` times the squared norm of its right-hand side, which
+    is only checked every `check_freq` iterations, so the host syncs once
+    per check instead of once per iteration. A system whose curvature
+    p^T F p is not positive or whose iterate is not finite is stopped and
+    reported as failed.
+
+    `x0` warm-starts the systems whose residual b - F x0 is smaller than b,
+    the others start from zero. As the tolerance is relative to b, a good
+    warm start needs fewer iterations.
+
+    Args:
+      fvp: function returning F v for a stack `v` shaped like `b`
+      b: (B, ...) right-hand sides
+      x0 (optional): (B, ...) warm starts
+      precond (optional): function returning M^-1 r for an SPD
+          preconditioner M ~ F
+      max_iters (int, optional): maximum iterations (default: 10)
+      tol (float, optional): relative squared residual tolerance
+          (default: 1e-2)
+      check_freq (int, optional): iterations between the convergence
+          checks (default: 1)
+
+    Returns:
+      solutions x, the iterations run by each system (B,) and the mask (B,)
+      of the failed systems
+    """
+    dims = tuple(range(1, b.dim()))
+    shape = (-1,) + (1,) * (b.dim() - 1)
+
+    def dot(u, v):
+        return (u * v).sum(dims)
+
+    b_norm = dot(b, b)
+    if x0 is None:
+        x, r = torch.zeros_like(b), b.clone()
+    else:
+        r = b - fvp(x0)
+        warm = (dot(r, r) < b_norm).view(shape)
+        x = torch.where(warm, x0, torch.zeros_like(b))
+        r = torch.where(warm, r, b)
+    z = r if precond is None else precond(r)
+    p = z.clone()
+    rz = dot(r, z)
+    zero = torch.zeros_like(rz)
+    active = dot(r, r) > tol * b_norm
+    failed = torch.zeros_like(active)
+    iterations = torch.zeros(b.shape[0], dtype=torch.long, device=b.device)
+    if not bool(active.any()):
+        return x, iterations, failed
+    for i in range(max_iters):
+        u = fvp(p)
+        s = dot(p, u)
+        failed |= active & ~(s > 0)
+        active &= ~failed
+        alpha = torch.where(active, rz / s, zero)
+        x += alpha.view(shape) * p
+        r -= alpha.view(shape) * u
+        z = r if precond is None else precond(r)
+        rz_next = dot(r, z)
+        beta = torch.where(active & (rz > 0), rz_next / rz, zero)
+        p = z + beta.view(shape) * p
+        rz = rz_next
+        iterations += active
+        failed |= active & ~torch.isfinite(rz)
+        active &= ~failed
+        if (i + 1) % check_freq == 0 or i + 1 == max_iters:
+            active &= dot(r, r) > tol * b_norm
+            if not bool(active.any()):
+                break
+    return x, iterations, failed
+
+def kl_clip_scale(updates, grads, lr, kl_clip):
+    """KL clip scale nu = min(1, sqrt(kl_clip / |lr^2 sum(v * g)|))
+
+    Computed from the lists of preconditioned gradients `updates` and
+    gradients `grads` as a 0-dim tensor, from per-tensor dot products so no
+    flat copy of the gradients is made.
+    """
+    products = torch._foreach_mul(updates, grads)
+    vg_sum = torch.stack([v.sum() for v in products]).sum() * lr ** 2
+    return torch.sqrt(kl_clip / vg_sum.abs()).clamp(max=1.0)
+
+def _group_by_shape(tensors):
+    """Indices of `tensors` grouped by (shape, dtype, device)"""
+    groups = {}
+    for i, t in enumerate(tensors):
+        groups.setdefault((tuple(t.shape), t.dtype, t.device), []).append(i)
+    return groups.values()
+
+def adaptive_clip_grads_(grads, weights, clip=0.02, eps=1.e-3):
+    """Unitwise adaptive gradient clipping of 2-D `grads` in place
+
+    Same as `clip_grad_rc(grad, W, row_major=nR > nC)` of every pair of an
+    nR x nC gradient and its weight: the unit norms are taken over the rows
+    if nR > nC else over the columns (over the whole tensor for a single
+    row or column), and each unit is scaled by
+    min(1, clip * max(|W|, eps) / (|grad| + 1e-6)). Pairs of the same shape
+    are stacked, so each group is clipped with a few batched kernels and no
+    host sync.
+    """
+    for group in _group_by_shape(grads):
+        g = torch.stack([grads[i] for i in group])
+        w = torch.stack([weights[i] for i in group]).to(g.dtype)
+        n_rows, n_cols = g.shape[1:]
+        if n_rows == 1 or n_cols == 1:
+            dim = (1, 2)
+        else:
+            dim = 2 if n_rows > n_cols else 1
+        g_norm = (g * g).sum(dim, keepdim=True).sqrt()
+        w_norm = (w * w).sum(dim, keepdim=True).sqrt().clamp(min=eps)
+        scale = (clip * w_norm / (g_norm + 1.0e-6)).clamp(max=1)
+        torch._foreach_mul_([grads[i] for i in group], list(scale.unbind(0)))
+
 def _extract_patches(x, kernel_size, stride, padding):
     """Extract patches from convolutional layer
 
@@ -81,6 +346,81 @@ def _extract_patches(x, kernel_size, stride, padding):
     return x
 
 
+def _conv2d_cov_tiled(x, layer, max_bytes=None, subsample=None, blocks=None,
+                      generator=None):
+    """Covariance of the conv patches accumulated over tiles
+
+    Computes the same matrix as `ComputeA.conv2d` without materializing
+    the full (batch_size*out_h*out_w, in_c*kh*kw) patch matrix. The patches
+    are gathered from a strided unfold view of `x`, one tile of samples and
+    output positions at a time, and a^T a is accumulated over the tiles.
+
+    Args:
+      x: The input feature maps.  (batch_size, in_c, h, w)
+      layer: the nn.Conv2d layer
+      max_bytes (int, optional): maximum size of a patch tile in bytes. A
+          tile holds at least one output position of one sample. If `None`,
+          a single tile covers all patches
+      subsample (float, optional): fraction of the output positions randomly
+          kept (the same positions for all samples). The sum is rescaled so
+          the estimate stays unbiased (default: None, keep all positions)
+      blocks (int, optional): only accumulate this many diagonal blocks,
+          see `_cov` (default: None, the full matrix)
+      generator (torch.Generator, optional): CPU generator drawing the kept
+          positions (default: None, the global generator)
+
+    Returns:
+      Tensor of shape (in_c*kh*kw [+1], in_c*kh*kw [+1]) or (k, b, b)
+    """
+    batch_size = x.size(0)
+    padding, stride = layer.padding, layer.stride
+    if padding[0] + padding[1] > 0:
+        x = F.pad(x, (padding[1], padding[1], padding[0], padding[0])).data
+    x = x.unfold(2, layer.kernel_size[0], stride[0])
+    x = x.unfold(3, layer.kernel_size[1], stride[1])
+    out_h, out_w = x.size(2), x.size(3)
+    spatial_size = out_h * out_w
+
+    positions = torch.arange(spatial_size, device=x.device)
+    if subsample is not None and subsample < 1:
+        keep = max(1, int(round(subsample * spatial_size)))
+        perm = torch.randperm(spatial_size, generator=generator).to(x.device)
+        positions = positions[perm[:keep]]
+    rows, cols = positions // out_w, positions % out_w
+    n_pos = positions.numel()
+
+    dim = x.size(1) * x.size(4) * x.size(5) + (layer.bias is not None)
+    if max_bytes is None:
+        tile_rows = batch_size * n_pos
+    else:
+        tile_rows = max(1, int(max_bytes) // (dim * x.element_size()))
+    batch_tile = max(1, tile_rows // n_pos)
+    pos_tile = min(n_pos, tile_rows)
+
+    slices = block_slices(dim, blocks) if blocks is not None and blocks > 1 \
+                                       else None
+    if slices is None:
+        cov = x.new_zeros(dim, dim)
+    else:
+        size = max(end - start for start, end in slices)
+        cov = x.new_zeros(len(slices), size, size)
+    for b in range(0, batch_size, batch_tile):
+        for p in range(0, n_pos, pos_tile):
+            # (b, in_c, p, kh, kw) -> (b*p, in_c*kh*kw)
+            a = x[b:b + batch_tile, :, rows[p:p + pos_tile], cols[p:p + pos_tile]]
+            a = a.transpose(1, 2).reshape(-1, dim - (layer.bias is not None))
+            if layer.bias is not None:
+                a = torch.cat([a, a.new(a.size(0), 1).fill_(1)], 1)
+            a = a / spatial_size
+            if slices is None:
+                cov.addmm_(a.t(), a)
+                continue
+            for i, (start, end) in enumerate(slices):
+                cov[i, :end - start, :end - start].addmm_(
+                        a[:, start:end].t(), a[:, start:end])
+    return cov * (spatial_size / n_pos / batch_size)
+
+
 def update_running_avg(new, current, alpha):
     """Compute running average of matrix in-place
 
@@ -91,27 +431,133 @@ def update_running_avg(new, current, alpha):
     current *= (1 - alpha)
 
 
+class RecurrentWeights:
+    """Input-to-hidden (`kind='ih'`) or hidden-to-hidden (`kind='hh'`)
+    weights of one layer of an `nn.LSTM` or `nn.GRU`
+
+    Stands for the affine map of these weights, which K-FAC preconditions
+    like a Linear layer applied at every timestep. Its inputs and output
+    gradients are saved by the hook of `rnn`, see `recurrent_forward`.
+    """
+    def __init__(self, rnn, layer, kind):
+        self.rnn = rnn
+        self.layer = layer
+        self.kind = kind
+
+    @property
+    def weight(self):
+        return getattr(self.rnn, 'weight_{}_l{}'.format(self.kind, self.layer))
+
+    @property
+    def bias(self):
+        if not self.rnn.bias:
+            return None
+        return getattr(self.rnn, 'bias_{}_l{}'.format(self.kind, self.layer))
+
+    def __repr__(self):
+        return 'RecurrentWeights({}, layer={}, kind={})'.format(
+                self.rnn.__class__.__name__, self.layer, self.kind)
+
+
+def recurrent_forward(rnn, input, hx=None, save=None):
+    """Forward of a unidirectional `nn.LSTM` or `nn.GRU` unrolled over time
+
+    Computes the same outputs as `rnn(input, hx)` with the cell equations of
+    the PyTorch docs. For every layer, `save(layer, kind, a, z)` is called
+    with the inputs `a` (T, B, in) of its `'ih'` and `'hh'` affine maps and a
+    tensor `z` (T, B, gates) whose gradient is the gradient w.r.t. their
+    outputs at every timestep. Dropout between the layers is drawn anew.
+    """
+    lstm = isinstance(rnn, nn.LSTM)
+    batched = input.dim() == 3
+    x = input if batched else input.unsqueeze(1)
+    if rnn.batch_first and batched:
+        x = x.transpose(0, 1)
+    if hx is None:
+        zeros = x.new_zeros(rnn.num_layers, x.size(1), rnn.hidden_size)
+        hx = (zeros, zeros) if lstm else zeros
+    elif not batched:
+        hx = tuple(h.unsqueeze(1) for h in hx) if lstm else hx.unsqueeze(1)
+    h0, c0 = hx if lstm else (hx, None)
+
+    h_n, c_n = [], []
+    for layer in range(rnn.num_layers):
+        ih, hh = RecurrentWeights(rnn, layer, 'ih'), RecurrentWeights(rnn, layer, 'hh')
+        u = F.linear(x, ih.weight, ih.bias)
+        # zero added to the 'hh' outputs, its gradient is theirs at every step
+        probe = u.new_zeros(u.shape, requires_grad=True) if save is not None else None
+        h, c = h0[layer], c0[layer] if lstm else None
+        hidden, outputs = [], []
+        for t in range(x.size(0)):
+            hidden.append(h)
+            v = F.linear(h, hh.weight, hh.bias)
+            if probe is not None:
+                v = v + probe[t]
+            if lstm:
+                i, f, g, o = (u[t] + v).chunk(4, 1)
+                c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+                h = torch.sigmoid(o) * torch.tanh(c)
+            else:
+                u_r, u_z, u_n = u[t].chunk(3, 1)
+                v_r, v_z, v_n = v.chunk(3, 1)
+                r = torch.sigmoid(u_r + v_r)
+                z = torch.sigmoid(u_z + v_z)
+                h = (1 - z) * torch.tanh(u_n + r * v_n) + z * h
+            outputs.append(h)
+        if save is not None:
+            save(layer, 'ih', x, u)
+            save(layer, 'hh', torch.stack(hidden), probe)
+        x = torch.stack(outputs)
+        if layer < rnn.num_layers - 1 and rnn.dropout > 0:
+            x = F.dropout(x, rnn.dropout, rnn.training)
+        h_n.append(h)
+        c_n.append(c)
+
+    output = x.transpose(0, 1) if rnn.batch_first and batched else x
+    h_n = torch.stack(h_n)
+    c_n = torch.stack(c_n) if lstm else None
+    if not batched:
+        output, h_n = output.squeeze(1), h_n.squeeze(1)
+        c_n = c_n.squeeze(1) if lstm else None
+    return (output, (h_n, c_n)) if lstm else (output, h_n)
+
+
 class ComputeA:
 
-    @classmethod
-    def compute_cov_a(cls, a, layer):
-        return cls.__call__(a, layer)
+    def __init__(self, patch_budget=None, patch_subsample=None):
+        """
+        :param patch_budget: maximum bytes of conv patches materialized at once
+            (None extracts all patches of the batch at once)
+        :param patch_subsample: fraction of conv output positions used for the
+            statistics (None uses all positions)
+        """
+        self.patch_budget = patch_budget
+        self.patch_subsample = patch_subsample
 
     @classmethod
-    def __call__(cls, a, layer):
-        if isinstance(layer, nn.Linear):
-            cov_a = cls.linear(a, layer)
-        elif isinstance(layer, BertLayerNorm):
-            cov_a = cls.linear(a, layer)
+    def compute_cov_a(cls, a, layer):
+        return cls()(a, layer)
+
+    def __call__(self, a, layer, blocks=None, generator=None):
+        if isinstance(layer, (nn.Linear, RecurrentWeights)):
+            cov_a = self.linear(a, layer, blocks)
+        elif isinstance(layer, nn.Embedding):
+            cov_a = self.embedding(a, layer)
+        elif isinstance(layer, nn.LayerNorm):
+            cov_a = self.layer_norm(a, layer)
         elif isinstance(layer, nn.Conv2d):
-            cov_a = cls.conv2d(a, layer)
+            if self.patch_budget is None and self.patch_subsample is None:
+                cov_a = self.conv2d(a, layer, blocks)
+            else:
+                cov_a = _conv2d_cov_tiled(a, layer, self.patch_budget,
+                                          self.patch_subsample, blocks, generator)
         else:
             raise NotImplementedError("KFAC does not support layer: ".format(layer))
 
         return cov_a
 
     @staticmethod
-    def conv2d(a, layer):
+    def conv2d(a, layer, blocks=None):
         batch_size = a.size(0)
         a = _extract_patches(a, layer.kernel_size, layer.stride, layer.padding)
         spatial_size = a.size(1) * a.size(2)
@@ -120,20 +566,34 @@ class ComputeA:
             a = torch.cat([a, a.new(a.size(0), 1).fill_(1)], 1)
         a = a/spatial_size
         # FIXME(CW): do we need to divide the output feature map's size?
-        return a.t() @ (a / batch_size)
+        return _cov(a, a / batch_size, blocks)
+
+    @staticmethod
+    def embedding(a, layer):
+        # a: token indices, A is diagonal: the frequency of every token
+        counts = torch.bincount(a.reshape(-1), minlength=layer.num_embeddings)
+        return counts.to(layer.weight.dtype) / a.numel()
+
+    @staticmethod
+    def layer_norm(a, layer):
+        # normalized input, one row per normalized slice (not a covariance)
+        dims = tuple(range(-len(layer.normalized_shape), 0))
+        mean = a.mean(dims, keepdim=True)
+        var = a.var(dims, unbiased=False, keepdim=True)
+        return ((a - mean) * torch.rsqrt(var + layer.eps)).reshape(-1, layer.weight.numel())
 
     @staticmethod
-    def linear(a, layer):
+    def linear(a, layer, blocks=None):
         # a: batch_size * in_dim        
         if len(a.shape) > 2:
-            a = a.view(-1, a.shape[-1])
+            a = a.reshape(-1, a.shape[-1])
             #a = torch.mean(a, list(range(len(a.shape)))[1:-1])
         batch_size = a.size(0)
         if layer.bias is not None:
             a = torch.cat([a, a.new(a.size(0), 1).fill_(1)], 1)
         # else:
         #     print(f"a={a.shape}")
-        return a.t() @ (a / batch_size)
+        return _cov(a, a / batch_size, blocks)
 
 
 class ComputeG:
@@ -150,20 +610,20 @@ class ComputeG:
         return cls.__call__(g, layer, batch_averaged)
 
     @classmethod
-    def __call__(cls, g, layer, batch_averaged):
+    def __call__(cls, g, layer, batch_averaged, blocks=None):
         if isinstance(layer, nn.Conv2d):
-            cov_g = cls.conv2d(g, layer, batch_averaged)
+            cov_g = cls.conv2d(g, layer, batch_averaged, blocks)
         # elif isinstance(layer, BertLayerNorm):
         #     cov_g = cls.conv2d(g, layer, batch_averaged)
-        elif isinstance(layer, nn.Linear):
-            cov_g = cls.linear(g, layer, batch_averaged)
+        elif isinstance(layer, (nn.Linear, RecurrentWeights, nn.Embedding)):
+            cov_g = cls.linear(g, layer, batch_averaged, blocks)
         else:
             raise NotImplementedError("KFAC does not support layer: ".format(layer))
 
         return cov_g
 
     @staticmethod
-    def conv2d(g, layer, batch_averaged):
+    def conv2d(g, layer, batch_averaged, blocks=None):
         # g: batch_size * n_filters * out_h * out_w
         # n_filters is actually the output dimension (analogous to Linear layer)
         spatial_size = g.size(2) * g.size(3)
@@ -175,12 +635,26 @@ class ComputeG:
         if batch_averaged:
             g = g * batch_size
         g = g * spatial_size
-        cov_g = g.t() @ (g / g.size(0))
+        cov_g = _cov(g, g / g.size(0), blocks)
 
         return cov_g
 
     @staticmethod
-    def linear(g, layer, batch_averaged):
+    def layer_norm(g, layer, batch_averaged, normalized):
+        """Diagonal of the Fisher of the affine parameters of a LayerNorm
+
+        Mean over the rows of the squared per-row gradients of the weight
+        and bias, as a (2, n) stack (or (1, n) without bias). `normalized`
+        is the normalized input from `ComputeA.layer_norm`.
+        """
+        g = g.reshape(-1, layer.weight.numel())
+        if batch_averaged:
+            g = g * g.size(0)
+        grads = [g * normalized] if layer.bias is None else [g * normalized, g]
+        return torch.stack(grads).pow(2).mean(1)
+
+    @staticmethod
+    def linear(g, layer, batch_averaged, blocks=None):
         # g: batch_size * out_dim
         
         if len(g.shape) > 2:
@@ -188,9 +662,9 @@ class ComputeG:
            #g = torch.mean(g, list(range(len(g.shape)))[1:-1])
         batch_size = g.size(0)
         if batch_averaged:
-            cov_g = g.t() @ (g * batch_size)
+            cov_g = _cov(g, g * batch_size, blocks)
         else:
-            cov_g = g.t() @ (g / batch_size)
+            cov_g = _cov(g, g / batch_size, blocks)
         return cov_g
 
 def seed_everything(seed=0):
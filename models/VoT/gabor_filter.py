@@ -8,6 +8,7 @@ from torch import nn
 from torch.nn import functional as F
 import sys
 from .some_utils import show_tensors
+from .position_encode import relative_position_grid, drop_legacy_grids
 
 class GaborFilters(nn.Module):
     def __init__(self, 
@@ -352,15 +353,6 @@ class GaborSelfAttention(nn.Module):
         # print(f"wave={wave.shape} => {wave.view(-1,K0,K1).shape}")
         self.wave = nn.Parameter(self.wave.float())     #self.wave.cuda().float()
 
-    def grid2RPE_5(self,grid,xita=None):      #grid(X,Y) =>   relative position encoding (dX,dY,dX2,dY2,dXdY)
-        if xita is not None:
-            rotate = torch.tensor( [[math.cos(xita),math.sin(xita)],[-math.sin(xita),math.cos(xita)]] )
-            grid = torch.einsum('ijc,cr->ijr', [grid.float(), rotate])      #cr: rotate vector of each codinate
-        relative_indices = grid.unsqueeze(0).unsqueeze(0) - grid.unsqueeze(-2).unsqueeze(-2)        #so elegant and hard code
-        R = torch.cat([relative_indices, relative_indices ** 2, (relative_indices[..., 0] * relative_indices[..., 1]).unsqueeze(-1)], dim=-1)
-        R = R.float()
-        return R 
-
     def __init__(self, config, hidden_in,output_attentions=False, keep_multihead_output=False,title=""):
         super().__init__()
         self.config = config
@@ -408,23 +400,17 @@ class GaborSelfAttention(nn.Module):
 
         if not config.attention_gaussian_blur_trick:
             # relative encoding grid (delta_x, delta_y, delta_x**2, delta_y**2, delta_x * delta_y)
-            MAX_WIDTH_HEIGHT = 50
-            range_ = torch.arange(MAX_WIDTH_HEIGHT)
-            grid = torch.cat([t.unsqueeze(-1) for t in torch.meshgrid([range_, range_])], dim=-1)
-            if self.isRXitas:   #need some time
-                listR=[]
-                for xita in numpy.linspace(0.0, 2.0*math.pi, num=self.num_attention_heads, endpoint=False):
-                    listR.append(self.grid2RPE_5(grid,0)[:width,:height,:width,:height,:])
-                R_xitas_ = torch.stack(listR)
-                self.register_buffer("R_xitas_", R_xitas_)  
-            else:
-                self.R_xitas_ = None
-            if True:
-                R = self.grid2RPE_5(grid,math.pi/4)            
-                self.register_buffer("R", R)            #parameters which should be saved and restored in the state_dict, but not trained by the optimizer,
+            # shared by all layers, see relative_position_grid. isRXitas: the same unrotated
+            # grid for every head, else the grid rotated by pi/4
+            self.grid_theta = None if self.isRXitas else math.pi/4
             self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
         self._init_gabor_(config,kernel_size=8,n_lambdas = 1,n_phase=1,n_thetas=self.num_attention_heads )
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints saved the grids as the buffers R and R_xitas_
+        drop_legacy_grids(state_dict, prefix, ["R", "R_xitas_"])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def get_heads_target_vectors(self):
         inv_covariance = torch.einsum('hij,hkj->hik', [self.attention_spreads, self.attention_spreads])
         a, b, c = inv_covariance[:, 0, 0], inv_covariance[:, 0, 1], inv_covariance[:, 1, 1]
@@ -444,23 +430,17 @@ class GaborSelfAttention(nn.Module):
         """Compute the positional attention for an image of size width x height
         Returns: tensor of attention probabilities (width, height, num_head, width, height)
         """
+        R = relative_position_grid(width, height, self.attention_centers.dtype, self.attention_centers.device,
+                                   theta=self.grid_theta)
         if self.isSigma:
             d = 5
-            if self.R_xitas_ is not None:  #would CRASH
-                R1 = self.R_xitas_.reshape(-1,d).contiguous()
-            else:
-                R1 = self.R[:width,:height,:width,:height,:].reshape(-1,d).contiguous()
+            R1 = R.reshape(-1,d)
             gaussian_ = self.sigmaLayer(R1)  #R1@(u.permute(1,0))
             gaussian_ = gaussian_.view(width,height,width,height,-1).permute(0,1,4,2,3).contiguous()
         else:
             u = self.get_heads_target_vectors()
         # Compute attention map for each head
-            if True:
-                gaussian_ = torch.einsum('hijkld,hd->ijhkl', [self.R_xitas_, u])
-                # for h in self.config.num_head:
-                #     gaussian_ = torch.einsum('ijkld,d->ijkl', [self.R_xita[h], u[h]])
-            else:
-                gaussian_ = torch.einsum('ijkld,hd->ijhkl', [self.R[:width,:height,:width,:height,:], u])
+            gaussian_ = torch.einsum('ijkld,hd->ijhkl', [R, u])
         # show_tensors(gaussian_[:,:,-1,:,:].contiguous().view(-1,1,width,height), nr_=8, pad_=4)
         # Softmax
         
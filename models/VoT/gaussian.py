@@ -6,6 +6,7 @@ from torch.nn import functional as F
 from .bert_utils import cached_path, WEIGHTS_NAME, CONFIG_NAME
 from vit_pytorch import sparsemax, entmax15
 from .guided_filter import SelfGuidedFilter
+from .position_encode import relative_position_grid, drop_legacy_grids
 import numbers
 
 
@@ -145,9 +146,26 @@ class se_basic(nn.Module):
         out = out.squeeze()
         return out
 
+def clear_attention_caches(model):
+    """
+    Drop the cached positional attention of every GaussianSelfAttention of model
+    """
+    for module in model.modules():
+        if isinstance(module, GaussianSelfAttention):
+            module.clear_attention_cache()
+
+def register_attention_cache_hook(optimizer, model):
+    """
+    Clear the attention caches of model after every optimizer.step()
+    Returns: the handle of the hook
+    """
+    return optimizer.register_step_post_hook(lambda *args: clear_attention_caches(model))
+
+
 class GaussianSelfAttention(nn.Module):
-    def __init__(self, config, hidden_in,output_attentions=False, keep_multihead_output=False):
+    def __init__(self, config, hidden_in,output_attentions=False, keep_multihead_output=False,title=""):
         super().__init__()
+        self.title = title
         self.attention_gaussian_blur_trick = config.attention_gaussian_blur_trick
         self.attention_isotropic_gaussian = config.attention_isotropic_gaussian
         self.gaussian_init_mu_std = config.gaussian_init_mu_std
@@ -186,9 +204,14 @@ class GaussianSelfAttention(nn.Module):
             self.attention_spreads = attention_spreads
             attention_spreads = self.get_heads_target_vectors()
             print(attention_spreads)
-            self.sigmaLayer = nn.Linear(5,self.num_attention_heads)   
+            # with attention_separable_sigma, isotropic heads have no weight for the dx*dy column of the grid, so
+            # their attention stays separable while it is trained, see compute_separable_probs
+            self.separable_sigma = bool(getattr(config, "attention_separable_sigma", False)) and \
+                                   config.attention_isotropic_gaussian
+            nTerm = 4 if self.separable_sigma else 5
+            self.sigmaLayer = nn.Linear(nTerm,self.num_attention_heads)   
             with torch.no_grad():
-                self.sigmaLayer.weight.copy_(attention_spreads)
+                self.sigmaLayer.weight.copy_(attention_spreads[:, :nTerm])
         else:
             self.attention_spreads = nn.Parameter(attention_spreads)
 
@@ -199,15 +222,28 @@ class GaussianSelfAttention(nn.Module):
             self.fc_allhead2hidden = nn.Linear(self.all_head_size,hidden_in )      #config.hidden_size
 
         if not config.attention_gaussian_blur_trick:
-            # relative encoding grid (delta_x, delta_y, delta_x**2, delta_y**2, delta_x * delta_y)
-            MAX_WIDTH_HEIGHT = 50
-            range_ = torch.arange(MAX_WIDTH_HEIGHT)
-            grid = torch.cat([t.unsqueeze(-1) for t in torch.meshgrid([range_, range_])], dim=-1)
-            relative_indices = grid.unsqueeze(0).unsqueeze(0) - grid.unsqueeze(-2).unsqueeze(-2)        #so elegant and hard code
-            R = torch.cat([relative_indices, relative_indices ** 2, (relative_indices[..., 0] * relative_indices[..., 1]).unsqueeze(-1)], dim=-1)
-            R = R.float()
-            self.register_buffer("R", R)
+            # the relative encoding grid (delta_x, delta_y, delta_x**2, delta_y**2, delta_x * delta_y)
+            # is shared by all layers, see relative_position_grid
             self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        # attention probabilities of each (width, height) with the parameter versions they were computed from
+        self.cache_attention = True
+        self.attention_cache = {}
+        # apply an axis-aligned attention as a row and a column contraction, see compute_separable_probs
+        self.use_separable = True
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints saved the grid as the buffer R
+        drop_legacy_grids(state_dict, prefix, ["R"])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self.clear_attention_cache()
+
+    def train(self, mode=True):
+        self.clear_attention_cache()
+        return super().train(mode)
+
+    def clear_attention_cache(self):
+        """Drop the cached positional attention, see cached_attention"""
+        self.attention_cache.clear()
 
     def get_heads_target_vectors(self):
         if self.attention_isotropic_gaussian:
@@ -229,20 +265,98 @@ class GaussianSelfAttention(nn.Module):
         ], dim=-1)
         return t_h
 
+    def positional_parameters(self):
+        """The parameters the positional attention depends on"""
+        if self.isSigma:
+            return [p for p in self.sigmaLayer.parameters()]
+        return [self.attention_centers, self.attention_spreads]
+
+    def attention_version(self):
+        """Changes whenever a positional parameter is replaced or modified in place (e.g. by an optimizer step)
+        Relies on the private Tensor._version counter, which in-place ops bump, also under torch.no_grad(). Edits
+        through the detached p.data have their own counter and are not seen: call clear_attention_cache() after them
+        """
+        return tuple((p.data_ptr(), p._version) for p in self.positional_parameters())
+
+    def cached_attention(self, key, compute):
+        """The attention does not depend on the input: when no gradient is needed (torch.no_grad() or frozen
+        parameters) compute() is called once per key and parameter version and its result reused, see
+        cache_attention. With gradients it is always called, so every backward has its own graph.
+        The cache is cleared explicitly by train(), eval(), load_state_dict() and, with
+        register_attention_cache_hook, every optimizer step; the parameter version guards other changes."""
+        needs_grad = torch.is_grad_enabled() and any(p.requires_grad for p in self.positional_parameters())
+        if not self.cache_attention or needs_grad:
+            self.attention_cache.clear()
+            return compute()
+        version = self.attention_version()
+        cached = self.attention_cache.get(key)
+        if cached is None or cached[0] != version:
+            cached = self.attention_cache[key] = (version, compute())
+        return cached[1]
+
     def get_attention_probs(self, width, height):
+        """Positional attention for an image of size width x height, see cached_attention
+        Returns: tensor of attention probabilities (width, height, num_head, width, height)
+        """
+        return self.cached_attention((width, height), lambda: self.compute_attention_probs(width, height))
+
+    def get_separable_probs(self, width, height):
+        """Factors of the positional attention if it is separable, see cached_attention
+        Returns: (row, col) probabilities (num_head, width, width) and (num_head, height, height), or None
+        """
+        return self.cached_attention(("separable", width, height),
+                                     lambda: self.compute_separable_probs(width, height))
+
+    def compute_separable_probs(self, width, height):
+        """With an axis-aligned Gaussian (no dx*dy term) the score of (dx, dy) is a row score of dx plus a column
+        score of dy, so the softmax over the (width, height) grid is the product of a softmax over the rows and one
+        over the columns: attention_probs[i,j,h,k,l] = row[h,i,k] * col[h,j,l]
+        The isotropic target vectors and the 4 term sigmaLayer of attention_separable_sigma have no dx*dy term by
+        construction. Other heads are separable while their dx*dy weight (or target) is exactly zero, a check cached
+        with the result by get_separable_probs. Their zero cross term still has a gradient, which only the dense path
+        gives, so they are not separable when gradients are needed
+        Returns: (row, col) probabilities (num_head, width, width) and (num_head, height, height), or None
+        """
+        if self.isSigma:
+            u = self.sigmaLayer.weight
+        else:
+            u = self.get_heads_target_vectors()
+        if not (self.separable_sigma if self.isSigma else self.attention_isotropic_gaussian):
+            if torch.is_grad_enabled() and any(p.requires_grad for p in self.positional_parameters()):
+                return None
+            if not bool((u[:, 4] == 0).all()):
+                return None
+        probs = []
+        for size, (linear, square) in ((width, (0, 2)), (height, (1, 3))):
+            delta = torch.arange(size, dtype=u.dtype, device=u.device)
+            delta = delta.unsqueeze(0) - delta.unsqueeze(1)
+            scores = u[:, linear, None, None] * delta + u[:, square, None, None] * delta ** 2
+            probs.append(torch.softmax(scores, dim=-1))
+        return tuple(probs)
+
+    def separable_attention(self, X, row, col):
+        """The dense attention of X (batch, width, height, dim) with the row and col factors as two contractions
+        Output: shape (batch, width, height, dim x num_heads)
+        """
+        b, w, h, _ = X.shape
+        Y = torch.einsum('hik,bkld->bildh', row, X)
+        return torch.einsum('hjl,bildh->bijdh', col, Y).reshape(b, w, h, -1)
+
+    def compute_attention_probs(self, width, height):
         """Compute the positional attention for an image of size width x height
         Returns: tensor of attention probabilities (width, height, num_head, width, height)
         """
+        R = relative_position_grid(width, height, self.attention_centers.dtype, self.attention_centers.device)
         if self.isSigma:
             # u = self.attention_spreads
             d = 5
-            R1 = self.R[:width,:height,:width,:height,:].reshape(-1,d).contiguous()
+            R1 = R.reshape(-1,d)[:, :self.sigmaLayer.in_features]
             attention_scores = self.sigmaLayer(R1)  #R1@(u.permute(1,0))
             attention_scores = attention_scores.view(width,height,width,height,-1).permute(0,1,4,2,3).contiguous()
         else:
             u = self.get_heads_target_vectors()
         # Compute attention map for each head
-            attention_scores = torch.einsum('ijkld,hd->ijhkl', [self.R[:width,:height,:width,:height,:], u])
+            attention_scores = torch.einsum('ijkld,hd->ijhkl', [R, u])
         # Softmax
         # attention_scores = self.attention_dropout(attention_scores)
         attention_probs = torch.nn.Softmax(dim=-1)(attention_scores.view(width, height, self.num_attention_heads, -1))
@@ -252,6 +366,7 @@ class GaussianSelfAttention(nn.Module):
         return attention_probs
 
     def reset_heads(self, heads):
+        self.clear_attention_cache()
         device = self.attention_spreads.data.device
         reset_heads_mask = torch.zeros(self.num_attention_heads, device=device, dtype=torch.bool)
         for head in heads:
@@ -318,7 +433,14 @@ class GaussianSelfAttention(nn.Module):
         if self.guided_filter is not None:
             hidden_states = self.guided_filter(hidden_states.permute(0,3,2,1)).permute(0,2,3,1)
             
-        if not self.attention_gaussian_blur_trick:
+        separable = None
+        if not self.attention_gaussian_blur_trick and self.use_separable and not (self.training and self.dropout.p > 0):
+            separable = self.get_separable_probs(w, h)
+        if separable is not None:
+            all_heads = self.separable_attention(hidden_states, *separable)
+            if self.output_attentions:
+                attention_probs = torch.einsum('hik,hjl->ijhkl', *separable)
+        elif not self.attention_gaussian_blur_trick:
             attention_probs = self.get_attention_probs(w, h)
             attention_probs = self.dropout(attention_probs)
             if False:
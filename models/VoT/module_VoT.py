@@ -127,6 +127,7 @@ VoT_config = OrderedDict(
     query_positional_score=False,            # use q.r attention (see Ramachandran, 2019)
     
     attention_isotropic_gaussian=False,     #little higher than TRUE
+    attention_separable_sigma=False,         # isotropic heads without the dx*dy weight, separable also in training
     prune_degenerated_heads=False,           # remove heads with Sigma^{-1} close to 0 or very singular (kappa > 1000) at epoch 0
     reset_degenerated_heads=False,           # reinitialize randomly the heads mentioned above
     fix_original_heads_position=False,       # original heads (not pruned/reinit) position are fixed to their original value
@@ -186,8 +187,8 @@ class VoT(nn.Module):
         #self.voxel_embedding = nn.Linear(num_channels_in, self.hidden_dims[0])        #just like the Token Embeddings in BERT
         self.voxel_embedding = None
         
-        # output all attentions, won't return them if self.output_attentions is False
-        self.encoder = VoxTransformer(self.config, output_attentions=True,hidden_dim=self.hidden_dims)
+        # the attention layers only build the dense attention maps if they are returned
+        self.encoder = VoxTransformer(self.config, output_attentions=output_attentions,hidden_dim=self.hidden_dims)
         self.classifier = nn.Linear(self.hidden_dims[-1], num_classes)
         # self.classifier = nn.ModuleList([nn.Linear(self.hidden_dims[-1], self.hidden_dims[-1]),nn.Linear(self.hidden_dims[-1], num_classes)])
         # self.pixelizer = nn.Linear(self.hidden_size, 3)
@@ -330,11 +331,13 @@ class VoT(nn.Module):
 
         b, w, h, _ = batch_features.shape
 
-        all_attentions, all_representations = self.encoder(
+        all_representations = self.encoder(
             batch_features,
             attention_mask=self.attention_mask,
             output_all_encoded_layers=False,
         )
+        if self.output_attentions:
+            all_attentions, all_representations = all_representations
 
         representations = all_representations[0]
 
@@ -273,4 +273,59 @@ class DistanceEmbedding(nn.Module):
         distance_embedding = self.get_distance_embedding(q_len, k_len)
         if q is None:
             return distance_embedding
-        return self.matmul_with_relative_keys(q, distance_embedding, self.heads_share_relative_embedding, bias)
\ No newline at end of file
+        return self.matmul_with_relative_keys(q, distance_embedding, self.heads_share_relative_embedding, bias)
+
+# Relative position grids shared by all the attention layers of a process
+_RELATIVE_GRIDS = {}
+
+def _shared_grid(key, build):
+    grid = _RELATIVE_GRIDS.get(key)
+    if grid is None:
+        grid = _RELATIVE_GRIDS[key] = build()
+    return grid
+
+def relative_position_grid(width, height, dtype=torch.float32, device="cpu", theta=None):
+    """
+    Relative position encoding (dx, dy, dx^2, dy^2, dx*dy) of a width x height token grid,
+    built once per (width, height, dtype, device) and shared by every layer asking for it.
+    It is a constant: it must not be modified in place and is not part of any state_dict.
+    :param theta: rotate the positions by theta before taking the differences
+    :return: tensor of size (width, height, width, height, 5), [i,j,k,l] encodes (k-i, l-j)
+    """
+    device = torch.device(device)
+    def build():
+        grid = torch.stack(torch.meshgrid(torch.arange(width, device=device),
+                                          torch.arange(height, device=device),
+                                          indexing="ij"), dim=-1).double()
+        if theta is not None:
+            rotate = torch.tensor([[math.cos(theta), math.sin(theta)],
+                                   [-math.sin(theta), math.cos(theta)]],
+                                  dtype=grid.dtype, device=device)
+            grid = grid @ rotate
+        delta = grid.unsqueeze(0).unsqueeze(0) - grid.unsqueeze(-2).unsqueeze(-2)
+        R = torch.cat([delta, delta ** 2, (delta[..., 0] * delta[..., 1]).unsqueeze(-1)], dim=-1)
+        return R.to(dtype)
+    return _shared_grid(("position", width, height, dtype, device, theta), build)
+
+def relative_index_grid(size, max_position, device="cpu"):
+    """
+    Shared (size, size) grid of the relative indices k - i shifted to [0, 2 * max_position - 1)
+    """
+    device = torch.device(device)
+    def build():
+        deltas = torch.arange(size, device=device).view(1, -1) - torch.arange(size, device=device).view(-1, 1)
+        return deltas + max_position - 1
+    return _shared_grid(("index", size, size, torch.long, device, max_position), build)
+
+def clear_relative_grids():
+    """
+    Release the shared grids, e.g. after evaluating at other resolutions
+    """
+    _RELATIVE_GRIDS.clear()
+
+def drop_legacy_grids(state_dict, prefix, names):
+    """
+    Remove the grids older versions saved as buffers from a state_dict being loaded
+    """
+    for name in names:
+        state_dict.pop(prefix + name, None)
@@ -38,6 +38,7 @@ from torch.nn import functional as F
 from .bert_utils import cached_path, WEIGHTS_NAME, CONFIG_NAME
 from .gaussian import *
 from .gabor_filter import *
+from .position_encode import relative_index_grid, drop_legacy_grids
 # from vit_pytorch import sparsemax, entmax15
 # from .guided_filter import SelfGuidedFilter
 
@@ -364,12 +365,13 @@ class Learned2DRelativeSelfAttention(nn.Module):
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
         self.value = nn.Linear(self.all_head_size, config.hidden_size)
+        # the deltas shifted to [0, 2 * max_position_embeddings - 1] are shared, see relative_index_grid
+        self.max_position_embeddings = max_position_embeddings
 
-        deltas = torch.arange(max_position_embeddings).view(1, -1) - torch.arange(max_position_embeddings).view(-1, 1)
-        # shift the delta to [0, 2 * max_position_embeddings - 1]
-        relative_indices = deltas + max_position_embeddings - 1
-
-        self.register_buffer("relative_indices", relative_indices)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints saved the grid as the buffer relative_indices
+        drop_legacy_grids(state_dict, prefix, ["relative_indices"])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, hidden_states, attention_mask, head_mask=None):
         assert len(hidden_states.shape) == 4
@@ -429,10 +431,11 @@ class Learned2DRelativeSelfAttention(nn.Module):
 
         # Compute attention scores based on position
         # Probably not optimal way to order computation
-        relative_indices = self.relative_indices[:width,:width].reshape(-1)
+        device = self.row_embeddings.weight.device
+        relative_indices = relative_index_grid(width, self.max_position_embeddings, device).reshape(-1)
         row_embeddings = self.row_embeddings(relative_indices)
 
-        relative_indices = self.relative_indices[:height,:height].reshape(-1)
+        relative_indices = relative_index_grid(height, self.max_position_embeddings, device).reshape(-1)
         col_embeddings = self.col_embeddings(relative_indices)
 
         # keep attention scores/prob for plotting
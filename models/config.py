@@ -203,10 +203,54 @@ def get_parser(datas_name, desc, default_task='classification'):
 
     parser.add_argument('--diag-blocks', type=int, default=1,
                         help='Number of blocks to approx layer factor with (default: 1)')
+    parser.add_argument('--diag-blocks-linear', type=int, default=None,
+                        help='Number of blocks to approx Linear layer factors with, --diag-blocks then only sets Conv2d (default: None, 1)')
     parser.add_argument('--diag-warmup', type=int, default=5,
                         help='Epoch to start diag block approximation at (default: 5)')
     parser.add_argument('--distribute-layer-factors', action='store_true', default=False,
                         help='Compute A and G for a single layer on different workers')
+    parser.add_argument('--kfac-variant', type=str, default='kfac',
+                        help='KFAC preconditioner [kfac, ekfac] (default: kfac)')
+    parser.add_argument('--precondition-mode', type=str, default='eigen',
+                        help='KFAC preconditioning with eigendecompositions, damped inverses or Newton inverse roots [eigen, inverse, newton] (default: eigen)')
+    parser.add_argument('--kfac-newton-p', type=int, default=1,
+                        help='root of the damped factors with --precondition-mode=newton, 4 for Shampoo (default: 1)')
+    parser.add_argument('--kfac-workers', type=int, default=1,
+                        help='threads used for the per-layer KFAC factor and eigen refresh (default: 1)')
+    parser.add_argument('--kfac-worker-threads', type=int, default=None,
+                        help='intra-op threads of each KFAC worker (default: split evenly)')
+    parser.add_argument('--kfac-streaming-factors', action='store_true', default=False,
+                        help='accumulate KFAC factors inside the hooks over all micro-batches instead of keeping the activations')
+    parser.add_argument('--kfac-patch-budget-mb', type=float, default=None,
+                        help='memory budget of the conv patch matrix for KFAC factor A (default: unbounded)')
+    parser.add_argument('--kfac-patch-subsample', type=float, default=None,
+                        help='fraction of conv output positions sampled for KFAC factor A (default: all)')
+    parser.add_argument('--kfac-packed-factors', action='store_true', default=False,
+                        help='store KFAC factors as packed upper triangles')
+    parser.add_argument('--kfac-factor-dtype', type=str, default=None,
+                        help='storage dtype of KFAC factors [float16, bfloat16] (default: float32)')
+    parser.add_argument('--kfac-async-eigen', action='store_true', default=False,
+                        help='refresh the KFAC eigendecompositions on a background thread, preconditioning with the previous basis meanwhile')
+    parser.add_argument('--kfac-max-staleness', type=int, default=None,
+                        help='steps an async KFAC refresh may lag before the step waits for it (default: kfac-update-freq)')
+    parser.add_argument('--kfac-refresh-drift', type=float, default=None,
+                        help='only refresh KFAC layers whose factors drifted by more than this relative norm (default: refresh all)')
+    parser.add_argument('--kfac-max-refresh-age', type=int, default=None,
+                        help='steps after which a KFAC layer is refreshed regardless of its drift (default: no limit)')
+    parser.add_argument('--kfac-low-rank', type=int, default=None,
+                        help='eigenpairs kept for large KFAC factors with a randomized eigendecomposition (default: full)')
+    parser.add_argument('--kfac-low-rank-min-dim', type=int, default=1024,
+                        help='smallest KFAC factor size that uses --kfac-low-rank (default: 1024)')
+    parser.add_argument('--kfac-offload', type=str, default=None,
+                        help='storage tier of the KFAC factors and eigenbases [cpu, memmap] (default: on device)')
+    parser.add_argument('--kfac-offload-dir', type=str, default=None,
+                        help='directory of the --kfac-offload=memmap files (default: temporary)')
+    parser.add_argument('--kfac-offload-resident-mb', type=float, default=0.,
+                        help='memory budget of the offloaded KFAC layers kept resident (default: 0)')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='file saving the model, optimizer and KFAC state after each epoch')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='checkpoint file to resume the training from')
 
     # Other Parameters
     parser.add_argument('--log-dir', default=f'./logs/{datas_name}/',help='TensorBoard log directory')
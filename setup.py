@@ -5,7 +5,7 @@ setuptools.setup(
     version="0.1.0",
     author="Greg Pauloski",
     author_email="jgpauloski@uchicago.edu",
-    description="Distributed K-FAC Preconditioner for PyTorch + Horovod",
+    description="Distributed K-FAC Preconditioner for PyTorch",
     long_description=open('README.md').read(),
     url="https://github.com/gpauloski/kfac_pytorch",
     packages=["kfac"],
@@ -16,7 +16,11 @@ setuptools.setup(
     ],
     python_requires='>=3.6',
     install_requires=[
-        "torch >= 1.0",
-        "horovod",
+        "torch >= 2.1",
+        "numpy",
     ],
+    extras_require={
+        # the distributed training examples
+        "examples": ["horovod"],
+    },
 )